@@ -0,0 +1,529 @@
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+# Máximo de embeddings en caché (~3 KB cada uno con 768 dimensiones)
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "50000"))
+# Al superar el tope se expulsa hasta esta fracción, para no expulsar en cada alta
+EMBED_CACHE_EVICT_TO = 0.9
+# Caché de resultados de /search
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "256"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+# Memoria máxima (bytes) de textos de documentos en caché
+TEXT_CACHE_MAX_BYTES = int(os.getenv("TEXT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Textos a partir de este tamaño se mapean en memoria en lugar de copiarse
+TEXT_MMAP_MIN_BYTES = int(os.getenv("TEXT_MMAP_MIN_BYTES", str(4 * 1024 * 1024)))
+# Máximo de archivos mapeados abiertos a la vez
+TEXT_MMAP_MAX_FILES = 64
+# Segundos que se conserva un archivo subido a Gemini para reutilizarlo (Gemini los borra a las 48 h)
+GEMINI_FILE_TTL = float(os.getenv("GEMINI_FILE_TTL", str(24 * 3600)))
+
+def normalize_text(text: str) -> str:
+    """
+    Normaliza el texto para que variaciones triviales (espacios, saltos de línea,
+    formas Unicode) compartan la misma entrada de caché.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+class EmbeddingCache:
+    """
+    Caché persistente de embeddings en SQLite, direccionada por contenido:
+    la clave es el hash de (modelo, task_type, texto normalizado).
+    Tiene un tope de entradas con expulsión LRU y contadores de aciertos/fallos.
+    """
+    def __init__(self, path="data/embedding_cache.sqlite3", max_entries=EMBED_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        # Cota superior de las entradas (las claves reemplazadas también suman): solo se
+        # cuentan de verdad cuando la cota pasa del tope
+        self._entries = self._count()
+
+    @staticmethod
+    def make_key(model_name: str, task_type: str, text: str) -> str:
+        payload = "\0".join([model_name, task_type or "", normalize_text(text)])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Retorna {clave: vector} para las claves presentes y actualiza su uso (LRU).
+        """
+        found = {}
+        if not keys:
+            return found
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # SQLite limita el número de parámetros por consulta
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).copy()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self._conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: dict):
+        """
+        Guarda {clave: vector} y, si se supera el tope, expulsa las entradas menos usadas
+        hasta quedar en EMBED_CACHE_EVICT_TO del tope.
+        """
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, np.asarray(vec, dtype=np.float32).tobytes(), now) for key, vec in items.items()]
+            )
+            self._entries += len(items)
+            if self._entries > self.max_entries:
+                self._entries = self._count()
+                if self._entries > self.max_entries:
+                    overflow = self._entries - int(self.max_entries * EMBED_CACHE_EVICT_TO)
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                        (overflow,)
+                    )
+                    self._entries -= overflow
+            self._conn.commit()
+
+    def put(self, key: str, vector: np.ndarray):
+        self.put_many({key: vector})
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._count()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+class LRUCache:
+    """
+    Caché en memoria acotada (LRU) con expiración por TTL y contadores de aciertos.
+    Segura para usarse desde varios hilos.
+    """
+    def __init__(self, max_entries=SEARCH_CACHE_MAX_ENTRIES, ttl=SEARCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+class DocumentTextCache:
+    """
+    Acceso compartido al texto extraído de los documentos (data/uploads/{id}.txt)
+    con una caché LRU acotada por bytes. Los textos grandes se mapean en memoria
+    (mmap): ocupan caché de páginas del sistema en vez de memoria del proceso y
+    solo se decodifica la parte que se pide.
+    """
+    def __init__(self, upload_dir="data/uploads", max_bytes=TEXT_CACHE_MAX_BYTES,
+                 mmap_min_bytes=TEXT_MMAP_MIN_BYTES, max_mapped=TEXT_MMAP_MAX_FILES):
+        self.upload_dir = upload_dir
+        self.max_bytes = max_bytes
+        self.mmap_min_bytes = mmap_min_bytes
+        self.max_mapped = max_mapped
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._mapped = 0
+        # doc_id -> (str en memoria o mmap de un archivo grande, tamaño en bytes)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Cuenta escrituras e invalidaciones: una lectura de disco que se cruzó con
+        # alguna no guarda en caché lo que leyó (podría ser el texto anterior)
+        self._writes = 0
+
+    def path(self, doc_id: str) -> str:
+        return os.path.join(self.upload_dir, f"{doc_id}.txt")
+
+    def get(self, doc_id: str):
+        """
+        Texto completo del documento, o None si no tiene texto en disco.
+        """
+        raw = self._raw(doc_id)
+        if raw is None or isinstance(raw, str):
+            return raw
+        return raw.decode("utf-8")
+
+    def head(self, doc_id: str, max_chars: int):
+        """
+        Primeros max_chars caracteres del documento sin decodificar el resto.
+        """
+        raw = self._raw(doc_id, max_chars * 4)  # UTF-8: hasta 4 bytes por carácter
+        if raw is None or isinstance(raw, str):
+            return raw[:max_chars] if raw is not None else None
+        return raw.decode("utf-8", errors="ignore")[:max_chars]
+
+    def write(self, doc_id: str, text: str):
+        """
+        Guarda el texto en disco y lo deja en caché. El archivo se reemplaza de forma
+        atómica: un mapa abierto sobre el texto anterior sigue viendo el inodo viejo
+        (truncarlo en sitio haría fallar con SIGBUS a quien lo esté leyendo).
+        """
+        path = self.path(doc_id)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            self._writes += 1
+            self._evict(doc_id)
+            if size < self.mmap_min_bytes:
+                self._store(doc_id, text, size)
+
+    def invalidate(self, doc_id: str):
+        with self._lock:
+            self._writes += 1
+            self._evict(doc_id)
+
+    def clear(self):
+        with self._lock:
+            self._writes += 1
+            for doc_id in list(self._data):
+                self._evict(doc_id)
+
+    def _raw(self, doc_id: str, max_bytes: int = None):
+        """
+        str cacheado, o bytes copiados del mapa (todo o los primeros max_bytes).
+        La copia se hace bajo el candado para que una expulsión no cierre el mapa a mitad.
+        """
+        with self._lock:
+            cached = self._data.get(doc_id)
+            if cached is not None:
+                entry = cached[0]
+                self._data.move_to_end(doc_id)
+                self.hits += 1
+                if isinstance(entry, str):
+                    return entry
+                return entry[:max_bytes] if max_bytes is not None else entry[:]
+            self.misses += 1
+            writes = self._writes
+
+        path = self.path(doc_id)
+        try:
+            size = os.path.getsize(path)
+            if size >= self.mmap_min_bytes:
+                with open(path, "rb") as f:
+                    entry = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = f.read()
+        except FileNotFoundError:
+            return None
+
+        result = entry if isinstance(entry, str) else (entry[:max_bytes] if max_bytes is not None else entry[:])
+        with self._lock:
+            if self._writes == writes:
+                self._store(doc_id, entry, size)
+            elif not isinstance(entry, str):
+                entry.close()
+        return result
+
+    def _store(self, doc_id: str, entry, size: int):
+        # Requiere self._lock
+        self._evict(doc_id)
+        if isinstance(entry, str) and size > self.max_bytes:
+            return
+        self._data[doc_id] = (entry, size)
+        if isinstance(entry, str):
+            self._bytes += size
+        else:
+            self._mapped += 1
+        # Expulsar los menos usados del tipo que excede su tope
+        for doc_id, (cached, _) in list(self._data.items()):
+            over_bytes = self._bytes > self.max_bytes
+            over_mapped = self._mapped > self.max_mapped
+            if not over_bytes and not over_mapped:
+                break
+            if over_bytes if isinstance(cached, str) else over_mapped:
+                self._evict(doc_id)
+
+    def _evict(self, doc_id: str):
+        # Requiere self._lock
+        cached = self._data.pop(doc_id, None)
+        if cached is None:
+            return
+        entry, size = cached
+        if isinstance(entry, str):
+            self._bytes -= size
+        else:
+            self._mapped -= 1
+            entry.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "mapped": self._mapped,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+class FactCache:
+    """
+    Caché persistente (SQLite) de los hechos clave extraídos de cada documento para
+    las comparaciones, por documento y versión del extractor (modelo + prompt).
+    Guarda el hash del texto del que salieron: si el texto cambia (p. ej. al completarse
+    la transcripción), la entrada deja de valer.
+    """
+    def __init__(self, path="data/fact_cache.sqlite3"):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS facts (
+                doc_id TEXT NOT NULL,
+                version TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                record TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (doc_id, version)
+            )
+        """)
+        self._conn.commit()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, doc_id: str, version: str, text_hash: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT record FROM facts WHERE doc_id = ? AND version = ? AND text_hash = ?",
+                (doc_id, version, text_hash)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, doc_id: str, version: str, text_hash: str, record: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO facts (doc_id, version, text_hash, record, created_at) VALUES (?, ?, ?, ?, ?)",
+                (doc_id, version, text_hash, json.dumps(record, ensure_ascii=False), time.time())
+            )
+            self._conn.commit()
+
+    def invalidate(self, doc_id: str = None):
+        """
+        Descarta los hechos de un documento (o todos si doc_id es None).
+        """
+        with self._lock:
+            if doc_id is None:
+                self._conn.execute("DELETE FROM facts")
+            else:
+                self._conn.execute("DELETE FROM facts WHERE doc_id = ?", (doc_id,))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM facts").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+class RemoteFileRegistry:
+    """
+    Registro persistente (SQLite) de archivos subidos a Gemini, direccionado por
+    el hash del contenido: nombre remoto y hasta cuándo se puede reutilizar.
+    Las entradas vencidas o liberadas quedan pendientes de borrar en remoto.
+    """
+    def __init__(self, path="data/gemini_files.sqlite3", ttl=GEMINI_FILE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                released INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_files_hash ON files(content_hash)")
+        self._conn.commit()
+
+    def get(self, content_hash: str):
+        """
+        Nombre remoto vigente para ese contenido, o None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name FROM files WHERE content_hash = ? AND released = 0 AND expires_at > ? "
+                "ORDER BY expires_at DESC LIMIT 1",
+                (content_hash, time.time())
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, content_hash: str, name: str, remote_expires_at: float = None):
+        """
+        Registra un archivo subido; los anteriores del mismo contenido quedan para borrar.
+        Vence con el TTL local o antes si Gemini lo expira antes (con un margen para
+        no reutilizar un archivo a punto de desaparecer).
+        """
+        expires_at = time.time() + self.ttl
+        if remote_expires_at is not None:
+            expires_at = min(expires_at, remote_expires_at - 600)
+        with self._lock:
+            self._conn.execute("UPDATE files SET released = 1 WHERE content_hash = ?", (content_hash,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (name, content_hash, expires_at, released) VALUES (?, ?, ?, 0)",
+                (name, content_hash, expires_at)
+            )
+            self._conn.commit()
+
+    def release(self, content_hash: str = None):
+        """
+        Marca para borrar los archivos de ese contenido, incluidas sus partes derivadas
+        ("hash:p1-20", "hash:img...") (o todos si content_hash es None).
+        """
+        with self._lock:
+            if content_hash is None:
+                self._conn.execute("UPDATE files SET released = 1")
+            else:
+                self._conn.execute(
+                    "UPDATE files SET released = 1 WHERE content_hash = ? OR substr(content_hash, 1, ?) = ?",
+                    (content_hash, len(content_hash) + 1, content_hash + ":")
+                )
+            self._conn.commit()
+
+    def due(self) -> list:
+        """
+        Nombres remotos de los archivos vencidos o liberados.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name FROM files WHERE released = 1 OR expires_at <= ?", (time.time(),)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def remove(self, name: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM files WHERE name = ?", (name,))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            active, pending = self._conn.execute(
+                "SELECT COALESCE(SUM(released = 0 AND expires_at > ?), 0), "
+                "COALESCE(SUM(released = 1 OR expires_at <= ?), 0) FROM files",
+                (now, now)
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "active": active,
+            "pending_delete": pending,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,46 @@
+import os
+
+# Tamaño de cada pasaje en caracteres (~300 tokens) y solapamiento entre pasajes consecutivos
+PASSAGE_CHARS = int(os.getenv("PASSAGE_CHARS", "1200"))
+PASSAGE_OVERLAP = int(os.getenv("PASSAGE_OVERLAP", "200"))
+
+# Cortes preferidos, del más al menos natural para Markdown
+_BREAKS = ("\n\n", "\n", ". ", " ")
+
+def split_passages(text: str, max_chars: int = PASSAGE_CHARS, overlap: int = PASSAGE_OVERLAP) -> list:
+    """
+    Divide el texto en pasajes solapados de hasta max_chars caracteres, cortando
+    preferentemente en párrafos, líneas, frases o palabras.
+    Retorna una lista de {"start", "end", "text"} con offsets sobre el texto original.
+    """
+    passages = []
+    n = len(text)
+    start = 0
+    while start < n:
+        # Saltar espacios al inicio del pasaje
+        while start < n and text[start].isspace():
+            start += 1
+        if start >= n:
+            break
+
+        end = min(start + max_chars, n)
+        if end < n:
+            # Buscar el mejor corte en la segunda mitad de la ventana
+            floor = start + max_chars // 2
+            for sep in _BREAKS:
+                cut = text.rfind(sep, floor, end)
+                if cut != -1:
+                    end = cut + len(sep)
+                    break
+
+        chunk = text[start:end].strip()
+        if chunk:
+            passages.append({"start": start, "end": end, "text": chunk})
+        if end >= n:
+            break
+
+        # El siguiente pasaje repite el final de este, empezando en un límite de palabra
+        next_start = max(end - overlap, start + 1)
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return passages
@@ -0,0 +1,49 @@
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Pool acotado para todo el código bloqueante (SDK de Gemini, FAISS, gTTS, disco).
+# Los handlers async delegan aquí para no congelar el event loop de uvicorn.
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "8"))
+
+# Pool aparte para recorrer iteradores que esperan largo rato entre elementos (streaming
+# de Gemini, exportaciones): cada respuesta en curso ocupa un hilo de este pool y no
+# del anterior, así que muchas descargas o chats a la vez no dejan sin hilos a /search
+STREAM_WORKERS = int(os.getenv("STREAM_WORKERS", "32"))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+_stream_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix="stream")
+
+async def _run_in(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, partial(context.run, func, *args, **kwargs))
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Ejecuta una función bloqueante en el pool acotado y espera su resultado
+    sin bloquear el event loop. Conserva las variables de contexto del llamador
+    (p. ej. la prioridad de las llamadas a Gemini).
+    """
+    return await _run_in(_executor, func, *args, **kwargs)
+
+_DONE = object()
+
+async def iterate_blocking(func, *args, **kwargs):
+    """
+    Recorre en el pool de streaming un iterador bloqueante (p. ej. una respuesta de
+    Gemini por streaming) y entrega cada elemento al event loop en cuanto está disponible.
+    """
+    iterator = await _run_in(_stream_executor, lambda: iter(func(*args, **kwargs)))
+    try:
+        while True:
+            item = await _run_in(_stream_executor, next, iterator, _DONE)
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        # Si el cliente se desconecta, cerrar el generador libera sus recursos (p. ej. el turno del limitador)
+        if hasattr(iterator, "close"):
+            await _run_in(_stream_executor, iterator.close)
@@ -1,21 +1,33 @@
+import contextvars
 import google.generativeai as genai
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from rate_limiter import limiter
+
 load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
 
+# Textos por petición batchEmbedContents (máximo admitido por la API: 100)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+# Peticiones batch simultáneas
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "4"))
+
 class EmbeddingGenerator:
-    def __init__(self, model_name="models/text-embedding-004"):
+    def __init__(self, model_name="models/text-embedding-004", dimension=768, cache=None):
         print(f"Initializing Gemini Embedding Model via API: {model_name}...")
         self.model_name = model_name
+        self.dimension = dimension
+        # Caché persistente opcional (cache.EmbeddingCache)
+        self.cache = cache
         if API_KEY:
             genai.configure(api_key=API_KEY)
         else:
              print("⚠️ Warning: GEMINI_API_KEY not found. Embeddings will fail.")
 
-    def generate(self, text: str) -> np.ndarray:
+    def generate(self, text: str, task_type: str = "retrieval_document") -> np.ndarray:
         """
         Genera un vector de embedding usando Gemini API.
         Retorna un numpy array de float32.
@@ -24,25 +36,168 @@ class EmbeddingGenerator:
             # Clean text to avoid API issues with empty/whitespace
             if not text or not text.strip():
                 print("Warning: Empty text for embedding.")
-                return np.zeros(768, dtype=np.float32)
+                return np.zeros(self.dimension, dtype=np.float32)
+
+            cache_key = None
+            if self.cache is not None:
+                cache_key = self.cache.make_key(self.model_name, task_type, text)
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    return cached
 
             text = text.replace("\n", " ")
-            
-            result = genai.embed_content(
+
+            result = limiter.call(
+                self.model_name, genai.embed_content,
                 model=self.model_name,
                 content=text,
-                task_type="retrieval_document" 
+                task_type=task_type
             )
-            
-            embedding = result['embedding']
-            return np.array(embedding, dtype=np.float32)
-            
+
+            embedding = np.array(result['embedding'], dtype=np.float32)
+            if cache_key is not None:
+                self.cache.put(cache_key, embedding)
+            return embedding
+
         except Exception as e:
             print(f"❌ Error generating embedding with Gemini: {e}")
             # Retornar vector zero para no romper el flujo, aunque la búsqueda no servirá para este doc
-            return np.zeros(768, dtype=np.float32)
+            return np.zeros(self.dimension, dtype=np.float32)
+
+    def generate_batch(self, texts: list, batch_size: int = EMBED_BATCH_SIZE,
+                       max_concurrency: int = EMBED_MAX_CONCURRENCY,
+                       task_type: str = "retrieval_document"):
+        """
+        Genera embeddings para muchos textos enviando `batch_size` textos por petición
+        y hasta `max_concurrency` peticiones en paralelo.
+
+        Retorna (vectors, errors):
+          - vectors: matriz float32 contigua de forma (len(texts), dimension), en el
+            mismo orden que `texts`, lista para `faiss.Index.add`.
+          - errors: dict {índice: mensaje} con los textos que no se pudieron embeber
+            (sus filas quedan en cero y no deben indexarse).
+        """
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        errors = {}
+
+        keys = {}
+        if self.cache is not None:
+            keys = {i: self.cache.make_key(self.model_name, task_type, t)
+                    for i, t in enumerate(texts) if t and t.strip()}
+        cached = self.cache.get_many(list(keys.values())) if keys else {}
+
+        pending = []
+        for i, text in enumerate(texts):
+            if not text or not text.strip():
+                errors[i] = "Texto vacío"
+            elif keys.get(i) in cached:
+                vectors[i] = cached[keys[i]]
+            else:
+                pending.append((i, text.replace("\n", " ")))
+
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        if not batches:
+            return vectors, errors
+
+        # Cada hilo hereda el contexto del llamador (prioridad en el limitador)
+        context = contextvars.copy_context()
+        embed = lambda batch: context.copy().run(self._embed_batch, batch, task_type)
+        new_entries = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(batches)))) as pool:
+            for batch, (embeddings, batch_errors) in zip(batches, pool.map(embed, batches)):
+                for (i, _), embedding in zip(batch, embeddings):
+                    if embedding is not None:
+                        vectors[i] = embedding
+                        if i in keys:
+                            new_entries[keys[i]] = vectors[i]
+                errors.update(batch_errors)
+
+        if self.cache is not None:
+            self.cache.put_many(new_entries)
+        return vectors, errors
+
+    def _embed_batch(self, batch: list, task_type: str = "retrieval_document"):
+        """
+        Embebe un lote [(índice, texto)]. Si la petición del lote falla, reintenta
+        cada texto por separado para aislar los elementos problemáticos.
+        """
+        try:
+            result = limiter.call(
+                self.model_name, genai.embed_content,
+                model=self.model_name,
+                content=[text for _, text in batch],
+                task_type=task_type
+            )
+            return result['embedding'], {}
+        except Exception as e:
+            if len(batch) == 1:
+                return [None], {batch[0][0]: str(e)}
+            print(f"⚠️ Batch embedding failed ({len(batch)} texts), retrying one by one: {e}")
+
+        embeddings, errors = [], {}
+        for item in batch:
+            item_embeddings, item_errors = self._embed_batch([item], task_type)
+            embeddings.extend(item_embeddings)
+            errors.update(item_errors)
+        return embeddings, errors
+
+def _run_benchmark(n_texts=400, latency=0.05):
+    """
+    Compara generate() uno a uno contra generate_batch() usando un endpoint
+    REST local que imita la API de embeddings con una latencia fija por petición.
+    """
+    import json
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class FakeEmbeddingHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(latency)
+            values = [0.1] * 768
+            if self.path.split("?")[0].endswith(":batchEmbedContents"):
+                payload = {"embeddings": [{"values": values} for _ in body["requests"]]}
+            else:
+                payload = {"embedding": {"values": values}}
+            data = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEmbeddingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    genai.configure(api_key="fake", transport="rest",
+                    client_options={"api_endpoint": f"http://127.0.0.1:{server.server_port}"})
 
-if __name__ == "__main__":
     e = EmbeddingGenerator()
-    vec = e.generate("This is a test document.")
-    print(f"Vector shape: {vec.shape}")
+    texts = [f"Documento de prueba número {i}" for i in range(n_texts)]
+
+    start = time.perf_counter()
+    for text in texts:
+        e.generate(text)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectors, errors = e.generate_batch(texts)
+    batched = time.perf_counter() - start
+
+    server.shutdown()
+    print(f"{n_texts} textos, latencia simulada {latency * 1000:.0f} ms/petición")
+    print(f"  generate()       : {sequential:6.2f} s  ({n_texts / sequential:8.1f} textos/s)")
+    print(f"  generate_batch() : {batched:6.2f} s  ({n_texts / batched:8.1f} textos/s), "
+          f"shape={vectors.shape}, errores={len(errors)}")
+
+if __name__ == "__main__":
+    import sys
+    if "--bench" in sys.argv:
+        _run_benchmark()
+    else:
+        e = EmbeddingGenerator()
+        vec = e.generate("This is a test document.")
+        print(f"Vector shape: {vec.shape}")
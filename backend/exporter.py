@@ -0,0 +1,114 @@
+import io
+import queue
+import threading
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles import Font
+
+XLSX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Bytes por trozo de la respuesta
+EXPORT_CHUNK_BYTES = 64 * 1024
+# Trozos en espera entre el hilo que escribe el libro y la respuesta (contrapresión)
+EXPORT_QUEUE_CHUNKS = 16
+# Máximo de caracteres de una celda de Excel
+MAX_CELL_CHARS = 32767
+
+class _Cancelled(Exception):
+    pass
+
+class _QueueWriter(io.RawIOBase):
+    """
+    Archivo de solo escritura y sin seek que entrega lo escrito a una cola en trozos
+    de EXPORT_CHUNK_BYTES; zipfile escribe el .xlsx en modo streaming sobre él.
+    """
+    def __init__(self, chunks: queue.Queue, stop: threading.Event):
+        self.chunks = chunks
+        self.stop = stop
+        self.buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer += data
+        if len(self.buffer) >= EXPORT_CHUNK_BYTES:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            _put(self.chunks, self.stop, bytes(self.buffer))
+            self.buffer.clear()
+
+def _put(chunks: queue.Queue, stop: threading.Event, item):
+    # Si quien lee dejó de hacerlo (cliente desconectado), abortar la escritura
+    while True:
+        try:
+            chunks.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            if stop.is_set():
+                raise _Cancelled()
+
+def _cell_value(value):
+    if value is None or isinstance(value, (int, float, bool)):
+        return value
+    if isinstance(value, (list, dict)):
+        value = ", ".join(map(str, value)) if isinstance(value, list) else str(value)
+    # Excel no admite caracteres de control ni celdas de más de 32767 caracteres
+    return ILLEGAL_CHARACTERS_RE.sub("", str(value))[:MAX_CELL_CHARS]
+
+def xlsx_stream(sheet_title: str, headers: list, rows):
+    """
+    Genera un .xlsx por trozos de bytes con un libro de openpyxl en modo write_only:
+    las filas (cualquier iterable, p. ej. una consulta paginada) se escriben a medida
+    que llegan y el zip se emite sin pasar por un archivo de salida en disco.
+    La escritura corre en un hilo propio; este generador entrega lo que va produciendo.
+    """
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet(sheet_title[:31])
+            header_cells = []
+            for header in headers:
+                cell = WriteOnlyCell(sheet, value=_cell_value(header))
+                cell.font = Font(bold=True)
+                header_cells.append(cell)
+            sheet.append(header_cells)
+            for row in rows:
+                sheet.append([_cell_value(value) for value in row])
+            writer = _QueueWriter(chunks, stop)
+            workbook.save(writer)
+            writer.flush()
+            _put(chunks, stop, None)
+        except _Cancelled:
+            pass
+        except Exception as e:
+            try:
+                _put(chunks, stop, e)
+            except _Cancelled:
+                pass
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+def table_rows(records: list) -> tuple:
+    """
+    Cabeceras (unión de claves en orden de aparición) y filas de una lista de dicts.
+    """
+    headers = list(dict.fromkeys(key for record in records for key in record))
+    return headers, ([record.get(key) for key in headers] for record in records)
@@ -1,9 +1,20 @@
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+import asyncio
+import contextvars
+import hashlib
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 import os
 
+from cache import DocumentTextCache, FactCache, LRUCache, RemoteFileRegistry
+from concurrency import run_blocking
+from rate_limiter import limiter
+
 # Cargar variables de entorno desde el archivo .env
 load_dotenv()
 
@@ -16,10 +27,99 @@ if not API_KEY:
 else:
     genai.configure(api_key=API_KEY)
 
+# Modelo generativo y cubo del limitador para las operaciones de archivos
+GEMINI_MODEL = "gemini-2.5-flash"
+FILES_API = "files"
+
+# Caracteres del texto extraído localmente que se envían para clasificar y resumir
+ANALYSIS_EXCERPT_CHARS = int(os.getenv("ANALYSIS_EXCERPT_CHARS", "20000"))
+
+# Configuración de Seguridad (Desactivar bloqueo estricto para evitar falsos positivos)
+SAFETY_SETTINGS = {
+    "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
+    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
+    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
+}
+
+# Caracteres del inicio del documento para candidatos del rerank sin pasajes
+RERANK_FALLBACK_CHARS = int(os.getenv("RERANK_FALLBACK_CHARS", "3000"))
+# Presupuesto de tokens para los pasajes del documento en cada pregunta del chat
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "4000"))
+# Estimación de caracteres por token para convertir el presupuesto
+CHARS_PER_TOKEN = 4
+# Comparación map-reduce: versión del extractor de hechos (modelo + prompt; cambiarla
+# al modificar el prompt invalida la caché de hechos)
+FACTS_VERSION = f"{GEMINI_MODEL}/facts-v1"
+# Criterios que se extraen siempre de cada documento para alinear la tabla
+FACT_CRITERIA = ("Tipo de documento", "Partes", "Fecha", "Vigencia / Plazo", "Monto total", "Moneda",
+                 "Forma de pago", "Obligaciones principales", "Penalizaciones", "Jurisdicción")
+FACT_MISSING = "No especificado"
+# Caracteres por llamada del paso map; los documentos más largos se extraen por fragmentos
+COMPARE_CHUNK_CHARS = int(os.getenv("COMPARE_CHUNK_CHARS", "120000"))
+# Extracciones del paso map en paralelo (el limitador global acota igualmente las llamadas)
+COMPARE_MAP_WORKERS = int(os.getenv("COMPARE_MAP_WORKERS", "8"))
+COMPARE_SUMMARY_CHARS = 1000
+# Comparaciones (paso reduce) recientes en memoria
+COMPARE_CACHE_MAX_ENTRIES = int(os.getenv("COMPARE_CACHE_MAX_ENTRIES", "128"))
+COMPARE_CACHE_TTL = float(os.getenv("COMPARE_CACHE_TTL", "3600"))
+
+# Modelo local simulado con respuestas por streaming (pruebas sin API KEY ni red)
+GEMINI_FAKE_MODEL = os.getenv("GEMINI_FAKE_MODEL", "0") == "1"
+GEMINI_FAKE_DELAY = float(os.getenv("GEMINI_FAKE_DELAY", "0.05"))
+
+class _FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeStreamingModel:
+    """
+    Sustituto local de GenerativeModel: responde un texto fijo, en trozos con
+    retardo si se pide stream=True, para probar el streaming de extremo a extremo.
+    """
+    def __init__(self, delay: float = GEMINI_FAKE_DELAY):
+        self.delay = delay
+
+    def generate_content(self, prompt, stream: bool = False, generation_config=None, **kwargs):
+        if (generation_config or {}).get("response_mime_type") == "application/json":
+            text = json.dumps({
+                "comparison_table": [{"Criterio": "Simulado", "Documento": "Respuesta del modelo local simulado."}],
+                "analysis_note": "Análisis simulado por el modelo local.",
+                "results": [],
+                "classification": {"category": "Simulado", "confidence": 1.0},
+                "summary": "Resumen simulado por el modelo local.",
+                "facts": {"Tipo de documento": "Simulado"},
+            }, ensure_ascii=False)
+        else:
+            text = "**Respuesta simulada.** El modelo local recibió una consulta de " + \
+                   f"{len(str(prompt))} caracteres y responde palabra por palabra para probar el streaming."
+        if not stream:
+            # Sin streaming se espera la respuesta completa (la latencia de todos los trozos)
+            time.sleep(self.delay * ((len(text.split(" ")) + 2) // 3))
+            return _FakeResponse(text)
+        return self._chunks(text)
+
+    def _chunks(self, text: str):
+        words = text.split(" ")
+        for i in range(0, len(words), 3):
+            time.sleep(self.delay)
+            yield _FakeResponse(" ".join(words[i:i + 3]) + (" " if i + 3 < len(words) else ""))
+
 class GeminiService:
-    def __init__(self):
+    def __init__(self, text_cache=None, file_registry=None, fact_cache=None):
+        # Texto de los documentos (DocumentTextCache) para el rerank sin pasajes
+        self.text_cache = text_cache or DocumentTextCache()
+        # Archivos ya subidos a Gemini, por hash de contenido (RemoteFileRegistry)
+        self.file_registry = file_registry or RemoteFileRegistry()
+        # Hechos clave por documento (FactCache) y tablas ya generadas, para comparar
+        self.fact_cache = fact_cache or FactCache()
+        self.comparison_cache = LRUCache(max_entries=COMPARE_CACHE_MAX_ENTRIES, ttl=COMPARE_CACHE_TTL)
 
         print("Inicializando Servicio Gemini...")
+        if GEMINI_FAKE_MODEL:
+            print("🧪 Usando el modelo local simulado (GEMINI_FAKE_MODEL=1).")
+            self.model = FakeStreamingModel()
+            return
         if not API_KEY:
              print("❌ Error Fatal: Intentando usar GeminiService sin API KEY.")
              # No lanzamos error aquí para no tumbar todo el server, pero fallará al usarlo
@@ -29,7 +129,7 @@ class GeminiService:
         # genai.configure se llama arriba a nivel módulo si existe la key, 
         # o podemos asegurarnos aqui.
         genai.configure(api_key=API_KEY)
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        self.model = genai.GenerativeModel(GEMINI_MODEL)
         
     def summarize(self, text: str) -> str:
         """
@@ -47,7 +147,7 @@ class GeminiService:
             """
             # Truncate to avoid context limit if extremely large, though 1.5 Flash has huge context.
             
-            response = self.model.generate_content(prompt)
+            response = limiter.call(GEMINI_MODEL, self.model.generate_content, prompt)
             return response.text.strip()
         except Exception as e:
             print(f"Gemini Summary Error: {e}")
@@ -77,7 +177,9 @@ class GeminiService:
             {text[:10000]}
             """
             
-            response = self.model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+            response = limiter.call(
+                GEMINI_MODEL, self.model.generate_content, prompt, generation_config={"response_mime_type": "application/json"}
+            )
             import json
             result = json.loads(response.text)
             return result
@@ -85,26 +187,80 @@ class GeminiService:
             print(f"Gemini Classification Error: {e}")
             return {"category": "Desconocido", "confidence": 0.0, "reasoning": "Error en API"}
 
-    def analyze_file(self, file_path: str, mime_type: str = "application/pdf") -> dict:
+    async def _uploaded_file(self, file_path: str, mime_type: str, content_hash: str = None):
         """
-        Sube el archivo (PDF o Imagen) a Gemini y realiza un análisis completo.
+        Archivo remoto listo para usar: reutiliza el ya subido con el mismo contenido
+        si sigue vigente; si no, lo sube y lo registra.
         """
-        import time
-        
-        try:
+        if content_hash:
+            name = await run_blocking(self.file_registry.get, content_hash)
+            if name:
+                try:
+                    uploaded_file = await run_blocking(limiter.call, FILES_API, genai.get_file, name)
+                    if uploaded_file.state.name != "FAILED":
+                        print(f"♻️ Reutilizando el archivo ya subido a Gemini ({name}).")
+                        return await self._wait_processing(uploaded_file)
+                except google_exceptions.NotFound:
+                    pass
+                # Ya no existe en Gemini (o falló): olvidarlo y volver a subir
+                await run_blocking(self.file_registry.remove, name)
 
-            print(f"Subiendo {file_path} ({mime_type}) a Gemini...")
-            # 1. Subir Archivo
-            uploaded_file = genai.upload_file(file_path, mime_type=mime_type)
-            
-            # Esperar procesamiento
-            while uploaded_file.state.name == "PROCESSING":
-                print("Procesando archivo en Gemini...")
-                time.sleep(1)
-                uploaded_file = genai.get_file(uploaded_file.name)
+        print(f"Subiendo {file_path} ({mime_type}) a Gemini...")
+        uploaded_file = await run_blocking(limiter.call, FILES_API, genai.upload_file, file_path, mime_type=mime_type)
+        uploaded_file = await self._wait_processing(uploaded_file)
+        # Sin hash no se puede reutilizar, pero se registra igual para que el barrido lo borre
+        expiration = getattr(uploaded_file, "expiration_time", None)
+        await run_blocking(
+            self.file_registry.put, content_hash or uploaded_file.name, uploaded_file.name,
+            expiration.timestamp() if expiration else None
+        )
+        return uploaded_file
+
+    async def _wait_processing(self, uploaded_file):
+        # Esperar procesamiento (sondeo asíncrono, no bloquea otras peticiones)
+        while uploaded_file.state.name == "PROCESSING":
+            print("Procesando archivo en Gemini...")
+            await asyncio.sleep(1)
+            uploaded_file = await run_blocking(limiter.call, FILES_API, genai.get_file, uploaded_file.name)
 
-            if uploaded_file.state.name == "FAILED":
-                raise ValueError("Gemini falló al procesar el archivo.")
+        if uploaded_file.state.name == "FAILED":
+            raise ValueError("Gemini falló al procesar el archivo.")
+        return uploaded_file
+
+    def release_file(self, content_hash: str = None):
+        """
+        El archivo remoto de ese contenido (o todos) ya no hace falta: lo borra el próximo barrido.
+        """
+        self.file_registry.release(content_hash)
+
+    def sweep_files(self) -> int:
+        """
+        Borra de Gemini los archivos vencidos o liberados. Retorna cuántos se borraron.
+        """
+        deleted = 0
+        for name in self.file_registry.due():
+            try:
+                limiter.call(FILES_API, genai.delete_file, name)
+                deleted += 1
+            except google_exceptions.NotFound:
+                pass  # Gemini ya lo había expirado
+            except Exception as e:
+                print(f"⚠️ No se pudo borrar el archivo remoto {name}: {e}")
+                continue
+            self.file_registry.remove(name)
+        if deleted:
+            print(f"🧹 {deleted} archivo(s) remoto(s) borrados de Gemini.")
+        return deleted
+
+    async def analyze_file(self, file_path: str, mime_type: str = "application/pdf", content_hash: str = None) -> dict:
+        """
+        Sube el archivo (PDF o Imagen) a Gemini y realiza un análisis completo.
+        Con content_hash, un archivo idéntico ya subido se reutiliza sin volver a subirlo.
+        Las llamadas al SDK corren en el pool de hilos; las esperas son asíncronas.
+        """
+        try:
+            # 1. Subir Archivo (o reutilizar el ya subido)
+            uploaded_file = await self._uploaded_file(file_path, mime_type, content_hash)
 
             print("Archivo listo. Generando contenido...")
 
@@ -133,23 +289,15 @@ class GeminiService:
             }
             """
             
-            # Configuración de Seguridad (Desactivar bloqueo estricto para evitar falsos positivos)
-            # Configuración de Seguridad
-            safety = {
-                "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
-                "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
-                "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
-                "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
-            }
-
-            # Ayuda para reintentos en error 429
+            # Reintentos si la respuesta no es JSON válido (los 429 los gestiona el limitador)
             for attempt in range(3):
                 try:
                     # Argumentos dinámicos para la generación
-                    response = self.model.generate_content(
+                    response = await run_blocking(
+                        limiter.call, GEMINI_MODEL, self.model.generate_content,
                         [uploaded_file, prompt], 
                         generation_config={"response_mime_type": "application/json"},
-                        safety_settings=safety
+                        safety_settings=SAFETY_SETTINGS
                     )
                     
                     import json
@@ -164,16 +312,10 @@ class GeminiService:
                         
                     result = json.loads(text_resp)
                     
-                    # Limpieza (Opcional pero bueno para privacidad/almacenamiento)
-                    # uploaded_file.delete() 
+                    # El archivo remoto se conserva para reutilizarlo; el barrido lo borra al vencer
                     return result
                     
                 except Exception as e:
-                    if "429" in str(e):
-                        wait_time = 10 * (attempt + 1)
-                        print(f"Límite de Tasa (429). Esperando {wait_time}s...")
-                        time.sleep(wait_time)
-                        continue
                     # Manejar ValueError crudo si el JSON está mal
                     if "JSON" in str(e):
                          print(f"Fallo al parsear JSON: {response.text[:100]}...")
@@ -191,6 +333,89 @@ class GeminiService:
                 "summary": f"Error: {str(e)}"
             }
 
+    async def quick_analyze_file(self, file_path: str, mime_type: str = "application/pdf", content_hash: str = None) -> dict:
+        """
+        Primer nivel del análisis por niveles: categoría y resumen leyendo el archivo,
+        sin pedir la transcripción (que domina la latencia y los tokens de salida).
+        Retorna {"classification": {...}, "summary": ...}.
+        """
+        try:
+            uploaded_file = await self._uploaded_file(file_path, mime_type, content_hash)
+            prompt = """
+            Analiza este archivo (PDF o Imagen) SIN transcribirlo.
+
+            1. **CLASIFICACIÓN**: Determina la categoría del documento/imagen. **IMPORTANTE: Debes dar el nombre de la categoría EXCLUSIVAMENTE EN ESPAÑOL** (máximo 3-4 palabras).
+            2. **RESUMEN**: Genera un resumen ejecutivo en español.
+
+            Responde ÚNICAMENTE con este JSON:
+            {
+                "classification": {
+                    "category": "Nombre Categoría",
+                    "confidence": 0.95
+                },
+                "summary": "Resumen aquí..."
+            }
+            """
+            response = await run_blocking(
+                limiter.call, GEMINI_MODEL, self.model.generate_content, [uploaded_file, prompt],
+                generation_config={"response_mime_type": "application/json"}, safety_settings=SAFETY_SETTINGS
+            )
+            return json.loads(response.text)
+        except Exception as e:
+            print(f"Gemini Quick Analysis Error: {e}")
+            return {"classification": {"category": "Error", "confidence": 0.0}, "summary": f"Error: {str(e)}"}
+
+    async def transcribe_file(self, file_path: str, mime_type: str = "application/pdf", content_hash: str = None) -> str:
+        """
+        Solo OCR: transcribe a Markdown un archivo (p. ej. las páginas escaneadas de un PDF
+        cuyo resto ya se extrajo localmente). Sin clasificación ni resumen.
+        """
+        uploaded_file = await self._uploaded_file(file_path, mime_type, content_hash)
+        prompt = """
+        Actúa como un sistema experto de OCR.
+        Transcribe el contenido de este archivo a **Markdown**, en orden lógico de lectura,
+        conservando tablas y encabezados. No agregues comentarios ni resúmenes.
+        Si el contenido es una imagen sin texto, descríbela brevemente en español.
+        """
+        response = await run_blocking(
+            limiter.call, GEMINI_MODEL, self.model.generate_content,
+            [uploaded_file, prompt], safety_settings=SAFETY_SETTINGS
+        )
+        return response.text.strip()
+
+    def analyze_text(self, text: str) -> dict:
+        """
+        Clasificación y resumen de un texto ya extraído, en una sola llamada y sobre
+        un extracto acotado. Retorna {"classification": {...}, "summary": ...}.
+        """
+        try:
+            prompt = f"""
+            Analiza el siguiente documento (puede ser solo su inicio).
+            
+            1. **CLASIFICACIÓN**: Determina la categoría del documento. **IMPORTANTE: Debes dar el nombre de la categoría EXCLUSIVAMENTE EN ESPAÑOL** (máximo 3-4 palabras).
+            2. **RESUMEN**: Genera un resumen ejecutivo en español.
+            
+            Responde ÚNICAMENTE con este JSON:
+            {{
+                "classification": {{
+                    "category": "Nombre Categoría",
+                    "confidence": 0.95
+                }},
+                "summary": "Resumen aquí..."
+            }}
+            
+            Documento:
+            {text[:ANALYSIS_EXCERPT_CHARS]}
+            """
+            response = limiter.call(
+                GEMINI_MODEL, self.model.generate_content, prompt,
+                generation_config={"response_mime_type": "application/json"}, safety_settings=SAFETY_SETTINGS
+            )
+            return json.loads(response.text)
+        except Exception as e:
+            print(f"Gemini Analysis Error: {e}")
+            return {"classification": {"category": "Error", "confidence": 0.0}, "summary": f"Error: {str(e)}"}
+
     def semantic_search_rerank(self, query: str, candidates: list) -> list:
         """
         Usa Gemini para re-ordenar y filtrar inteligentemente los resultados de búsqueda.
@@ -202,26 +427,26 @@ class GeminiService:
         try:
             # Preparar el contexto para Gemini
             candidates_text = ""
-            import os
             
             for i, cand in enumerate(candidates):
                 meta = cand.get('metadata', {})
                 file_id = meta.get('id')
                 
-                # Intentar cargar contexto de TEXTO COMPLETO
                 content_context = f"Resumen: {meta.get('summary')}" # Fallback por defecto
-                
-                if file_id:
-                    txt_path = f"data/uploads/{file_id}.txt"
-                    if os.path.exists(txt_path):
-                        try:
-                            with open(txt_path, "r", encoding="utf-8") as f:
-                                # Leer hasta 20,000 chars por doc para dar contexto profundo pero ahorrar tokens
-                                # Gemini 2.5 Flash tiene contexto ENORME, así que podemos ser generosos.
-                                full_text = f.read(50000) 
-                                content_context = f"CONTENIDO COMPLETO (Extracto):\n{full_text}..."
-                        except Exception:
-                            pass
+                passages = cand.get('passages') or []
+
+                if passages:
+                    # Solo los pasajes más cercanos a la consulta, no el documento entero
+                    excerpts = "\n[...]\n".join(p['text'] for p in passages)
+                    content_context = f"Resumen: {meta.get('summary')}\nPASAJES RELEVANTES:\n{excerpts}"
+                elif file_id:
+                    # Sin pasajes (solo coincidencia por palabra clave): extracto corto del inicio
+                    try:
+                        excerpt = self.text_cache.head(file_id, RERANK_FALLBACK_CHARS)
+                        if excerpt is not None:
+                            content_context = f"Resumen: {meta.get('summary')}\nINICIO DEL DOCUMENTO:\n{excerpt}..."
+                    except Exception:
+                        pass
 
                 candidates_text += f"""
                 [ID: {i}]
@@ -258,7 +483,9 @@ class GeminiService:
             }}
             """
             
-            response = self.model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+            response = limiter.call(
+                GEMINI_MODEL, self.model.generate_content, prompt, generation_config={"response_mime_type": "application/json"}
+            )
             import json
             evaluation = json.loads(response.text)
             
@@ -280,16 +507,13 @@ class GeminiService:
             # Fallback: Retornar candidatos originales
             return candidates
 
-    def chat_with_document(self, context_text: str, query: str) -> str:
-        """
-        Permite chatear con un documento específico.
-        """
-        try:
-            prompt = f"""
+    def _chat_prompt(self, passages: list, query: str) -> str:
+        context_text = "\n[...]\n".join(p["text"] for p in passages)
+        return f"""
             Actúa como un asistente experto analizando el siguiente documento.
             
-            Documento:
-            {context_text[:50000]} 
+            Fragmentos relevantes del documento:
+            {context_text}
             
             Consulta del Usuario: "{query}"
             
@@ -298,39 +522,132 @@ class GeminiService:
             2. Si la respuesta no está en el documento, dilo claramente.
             3. Sé conciso pero útil. Usa formato Markdown (negritas, listas) si ayuda a la claridad.
             """
-            
-            response = self.model.generate_content(prompt)
+
+    def chat_with_document(self, passages: list, query: str) -> str:
+        """
+        Permite chatear con un documento específico a partir de sus pasajes
+        más relevantes para la pregunta (en orden de aparición).
+        """
+        try:
+            response = limiter.call(GEMINI_MODEL, self.model.generate_content, self._chat_prompt(passages, query))
             return response.text.strip()
         except Exception as e:
             return f"Error al procesar la pregunta: {e}"
 
-    def compare_documents(self, docs_list: list) -> dict:
+    def stream_chat_with_document(self, passages: list, query: str):
         """
-        Compara múltiples documentos y genera una estructura de datos para tabla y análisis.
-        docs_list: Lista de diccionarios [{'name': '...', 'text': '...'}]
+        Igual que chat_with_document, pero produce el texto por trozos a medida que Gemini lo genera.
         """
-        try:
-            # Construir el prompt con todos los documentos
-            docs_context = ""
-            doc_names = []
-            for i, doc in enumerate(docs_list):
-                 safe_name = doc.get('name', f'Doc_{i+1}')
-                 doc_names.append(safe_name)
-                 docs_context += f"""
-                 --- DOCUMENTO '{safe_name}' ---
-                 {doc.get('text')[:20000]}
-                 
-                 """
-            
-            prompt = f"""
+        # El turno del limitador se ocupa mientras dura la respuesta
+        with limiter.slot(GEMINI_MODEL):
+            for chunk in self.model.generate_content(self._chat_prompt(passages, query), stream=True):
+                if chunk.text:
+                    yield chunk.text
+
+    def _facts_prompt(self, name: str, text: str, part: int, parts: int) -> str:
+        fragment = f" (fragmento {part + 1} de {parts})" if parts > 1 else ""
+        criteria = "\n".join(f'                "{c}": "..."' + ("," if i < len(FACT_CRITERIA) - 1 else "")
+                             for i, c in enumerate(FACT_CRITERIA))
+        return f"""
+            Actúa como un Consultor Analista Senior.
+            Extrae los hechos clave del documento '{name}'{fragment} para compararlo después con otros.
+
+            INSTRUCCIONES:
+            1. Completa cada criterio con un valor breve (máximo 200 caracteres); si el texto no lo indica, usa "No especificado".
+            2. Agrega en "facts" hasta 10 criterios adicionales relevantes (cláusulas, condiciones, cifras, nombres).
+            3. IDIOMA: Español.
+
+            Responde ÚNICAMENTE con este JSON:
+            {{
+              "facts": {{
+{criteria}
+              }},
+              "summary": "Dos o tres frases con lo esencial del documento."
+            }}
+
+            Documento:
+            {text}
+            """
+
+    def _extract_part(self, name: str, text: str, part: int, parts: int) -> dict:
+        response = limiter.call(
+            GEMINI_MODEL, self.model.generate_content, self._facts_prompt(name, text, part, parts),
+            generation_config={"response_mime_type": "application/json"}, safety_settings=SAFETY_SETTINGS
+        )
+        record = json.loads(response.text)
+        return {"facts": record.get("facts") or {}, "summary": record.get("summary") or ""}
+
+    @staticmethod
+    def _merge_parts(records: list) -> dict:
+        """
+        Une los hechos de los fragmentos de un documento: valores distintos de un mismo
+        criterio se concatenan en orden de aparición.
+        """
+        if len(records) == 1:
+            return records[0]
+        values = {}
+        for record in records:
+            for criterion, value in record["facts"].items():
+                value = str(value).strip()
+                found = values.setdefault(criterion, [])
+                if value and value != FACT_MISSING and value not in found:
+                    found.append(value)
+        facts = {criterion: "; ".join(found) or FACT_MISSING for criterion, found in values.items()}
+        summary = " ".join(r["summary"] for r in records if r["summary"])
+        return {"facts": facts, "summary": summary[:COMPARE_SUMMARY_CHARS]}
+
+    def extract_facts(self, docs_list: list) -> list:
+        """
+        Paso map de la comparación: un registro compacto {"facts", "summary"} por documento.
+        Los documentos largos se extraen por fragmentos de COMPARE_CHUNK_CHARS sin truncarlos;
+        todos los fragmentos pendientes van en paralelo (bajo el limitador) y los registros
+        se guardan en caché por documento, versión del extractor y hash del texto.
+        """
+        records = [None] * len(docs_list)
+        pending = []
+        for i, doc in enumerate(docs_list):
+            text = doc.get("text") or ""
+            text_hash = FactCache.text_hash(text)
+            record = self.fact_cache.get(doc["id"], FACTS_VERSION, text_hash) if doc.get("id") else None
+            if record is not None:
+                records[i] = record
+                continue
+            chunks = [text[start:start + COMPARE_CHUNK_CHARS] for start in range(0, len(text), COMPARE_CHUNK_CHARS)] or [""]
+            pending.append((i, text_hash, chunks))
+
+        tasks = [(i, part, len(chunks), chunk) for i, _, chunks in pending for part, chunk in enumerate(chunks)]
+        if tasks:
+            print(f"🔎 Extrayendo hechos de {len(pending)} documento(s) en {len(tasks)} llamada(s) "
+                  f"({len(docs_list) - len(pending)} en caché).")
+            # Cada hilo hereda el contexto del llamador (prioridad en el limitador)
+            context = contextvars.copy_context()
+            extract = lambda task: context.copy().run(
+                self._extract_part, docs_list[task[0]].get("name", f"Doc_{task[0] + 1}"), task[3], task[1], task[2]
+            )
+            with ThreadPoolExecutor(max_workers=max(1, min(COMPARE_MAP_WORKERS, len(tasks)))) as pool:
+                parts = list(pool.map(extract, tasks))
+            offset = 0
+            for i, text_hash, chunks in pending:
+                records[i] = self._merge_parts(parts[offset:offset + len(chunks)])
+                offset += len(chunks)
+                if docs_list[i].get("id"):
+                    self.fact_cache.put(docs_list[i]["id"], FACTS_VERSION, text_hash, records[i])
+        return records
+
+    def _compare_prompt(self, docs_list: list, records: list) -> str:
+        # Paso reduce: solo los registros compactos, no el texto de los documentos
+        doc_names = [doc.get('name', f'Doc_{i+1}') for i, doc in enumerate(docs_list)]
+        docs_context = json.dumps(dict(zip(doc_names, records)), ensure_ascii=False, indent=1)
+        
+        return f"""
             Actúa como un Consultor Analista Senior.
-            Tu tarea es COMPARAR minuciosamente los siguientes documentos.
+            Tu tarea es COMPARAR minuciosamente los siguientes documentos a partir de sus hechos clave ya extraídos.
             
             {docs_context}
             
             INSTRUCCIONES:
             1. Identifica las similitudes y diferencias clave (fechas, montos, cláusulas, nombres, temas).
-            2. Genera una TABLA COMPARATIVA estructurada.
+            2. Genera una TABLA COMPARATIVA estructurada: una fila por criterio, unificando criterios equivalentes.
             3. Escribe una conclusión o análisis de diferencias.
             4. IDIOMA: Español.
             
@@ -347,11 +664,67 @@ class GeminiService:
                 "analysis_note": "Parrafo breve con el análisis de diferencias más críticas."
             }}
             """
+
+    def _comparison_key(self, docs_list: list, records: list) -> str:
+        # La tabla depende solo de los nombres y los registros: comparar de nuevo es un acierto
+        payload = json.dumps([[doc.get("name"), record] for doc, record in zip(docs_list, records)],
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(f"{FACTS_VERSION}\0{payload}".encode("utf-8")).hexdigest()
+
+    def compare_documents(self, docs_list: list) -> dict:
+        """
+        Compara múltiples documentos y genera una estructura de datos para tabla y análisis.
+        docs_list: Lista de diccionarios [{'id': '...', 'name': '...', 'text': '...'}]
+        Map-reduce: hechos clave por documento (en caché) y una tabla a partir de ellos.
+        """
+        try:
+            records = self.extract_facts(docs_list)
+            key = self._comparison_key(docs_list, records)
+            cached = self.comparison_cache.get(key)
+            if cached is not None:
+                return cached
+            response = limiter.call(
+                GEMINI_MODEL, self.model.generate_content,
+                self._compare_prompt(docs_list, records), generation_config={"response_mime_type": "application/json"}
+            )
+            result = json.loads(response.text)
+            self.comparison_cache.put(key, result)
+            return result
             
-            response = self.model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
-            import json
-            return json.loads(response.text)
-            
+        except Exception as e:
+            print(f"Error comparando documentos: {e}")
+            return {"comparison_table": [], "analysis_note": f"Error: {str(e)}"}
+
+    def stream_compare_documents(self, docs_list: list):
+        """
+        Produce por trozos el JSON de la comparación a medida que Gemini lo genera
+        (tras el paso map); el JSON completo se interpreta al final con parse_comparison.
+        Una comparación ya hecha se entrega de una vez desde la caché.
+        """
+        records = self.extract_facts(docs_list)
+        key = self._comparison_key(docs_list, records)
+        cached = self.comparison_cache.get(key)
+        if cached is not None:
+            yield json.dumps(cached, ensure_ascii=False)
+            return
+        parts = []
+        with limiter.slot(GEMINI_MODEL):
+            stream = self.model.generate_content(
+                self._compare_prompt(docs_list, records), generation_config={"response_mime_type": "application/json"}, stream=True
+            )
+            for chunk in stream:
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+        try:
+            self.comparison_cache.put(key, json.loads("".join(parts)))
+        except ValueError:
+            pass
+
+    @staticmethod
+    def parse_comparison(text: str) -> dict:
+        try:
+            return json.loads(text)
         except Exception as e:
             print(f"Error comparando documentos: {e}")
             return {"comparison_table": [], "analysis_note": f"Error: {str(e)}"}
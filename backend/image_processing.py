@@ -0,0 +1,81 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+# Preprocesar las imágenes antes de subirlas a Gemini (0 = se suben tal cual)
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") == "1"
+# Lado mayor máximo en píxeles (Gemini cobra por teselas de 768 px: 1536 px son 4 teselas)
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1536"))
+# Calidad de recodificación JPEG/WEBP
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# Procesos que recodifican imágenes en paralelo
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Tipos MIME que se preprocesan y formato de salida de cada uno
+_FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+_pool = None
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _pool
+
+def supports(mime_type: str) -> bool:
+    return mime_type in _FORMATS
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+def _process(src_path: str, dst_base: str, mime_type: str, max_edge: int, quality: int) -> dict:
+    """
+    Corrige la orientación EXIF, reduce al lado máximo, recodifica y descarta los
+    metadatos (corre en un proceso del pool). Un PNG sin transparencia (p. ej. una
+    foto guardada como PNG) se recodifica como JPEG.
+    """
+    with Image.open(src_path) as image:
+        original_size = image.size
+        # JPEG: decodificar ya reducido (escalado DCT) en lugar de a resolución completa
+        image.draft("RGB", (max_edge, max_edge))
+        had_metadata = bool(image.info.get("exif") or image.getexif())
+        icc_profile = image.info.get("icc_profile")
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        fmt = _FORMATS[mime_type]
+        if fmt == "PNG" and not _has_alpha(image):
+            fmt = "JPEG"
+        if fmt == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        dst_path = f"{dst_base}.{_EXTENSIONS[fmt]}"
+        # Sin exif= ni pnginfo= Pillow no copia metadatos; se conserva solo el perfil de color
+        options = {"icc_profile": icc_profile} if icc_profile else {}
+        if fmt == "PNG":
+            image.save(dst_path, fmt, optimize=True, **options)
+        else:
+            image.save(dst_path, fmt, quality=quality, optimize=True, **options)
+        size = image.size
+
+    original_bytes = os.path.getsize(src_path)
+    processed_bytes = os.path.getsize(dst_path)
+    if processed_bytes >= original_bytes and size == original_size and not had_metadata:
+        # Ya era pequeña y limpia: se sube el original
+        os.remove(dst_path)
+        return {"path": src_path, "mime_type": mime_type, "original_bytes": original_bytes,
+                "processed_bytes": original_bytes, "size": list(original_size)}
+    return {"path": dst_path, "mime_type": _MIME_TYPES[fmt], "original_bytes": original_bytes,
+            "processed_bytes": processed_bytes, "size": list(size)}
+
+def preprocess_image(src_path: str, mime_type: str, max_edge: int = IMAGE_MAX_EDGE,
+                     quality: int = IMAGE_QUALITY) -> dict:
+    """
+    Prepara una imagen para subirla a Gemini en un proceso del pool, sin tocar el original.
+    Retorna {"path", "mime_type", "original_bytes", "processed_bytes", "size"}; si la
+    imagen no necesita cambios, "path" es el propio original.
+    """
+    return _get_pool().submit(_process, src_path, f"{src_path}.gemini", mime_type, max_edge, quality).result()
@@ -0,0 +1,172 @@
+import math
+import os
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+
+# Tipo de índice: flat | ivf_flat | hnsw | ivf_pq | auto (según el tamaño del corpus)
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "auto")
+# Umbrales del modo automático
+AUTO_HNSW_MIN = int(os.getenv("VECTOR_AUTO_HNSW_MIN", "20000"))
+# IVF-PQ comprime mucho pero pierde recall: solo para corpus donde HNSW no cabe en memoria
+AUTO_IVF_PQ_MIN = int(os.getenv("VECTOR_AUTO_IVF_PQ_MIN", "5000000"))
+# Vectores mínimos para entrenar cada tipo; por debajo se usa flat
+IVF_MIN_TRAIN = 1000
+IVF_PQ_MIN_TRAIN = 10000
+# Parámetros de construcción y de búsqueda por defecto
+HNSW_M = int(os.getenv("VECTOR_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", "200"))
+DEFAULT_NPROBE = int(os.getenv("VECTOR_NPROBE", "16"))
+DEFAULT_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH", "64"))
+
+def effective_index_type(configured: str, n: int) -> str:
+    """
+    Tipo de índice a usar para un corpus de n vectores. En modo 'auto' depende del
+    tamaño; los tipos IVF caen a 'flat' mientras no haya datos para entrenarlos.
+    """
+    index_type = configured
+    if configured == "auto":
+        if n >= AUTO_IVF_PQ_MIN:
+            index_type = "ivf_pq"
+        elif n >= AUTO_HNSW_MIN:
+            index_type = "hnsw"
+        else:
+            index_type = "flat"
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Tipo de índice desconocido: {configured}")
+    if index_type == "ivf_flat" and n < IVF_MIN_TRAIN:
+        return "flat"
+    if index_type == "ivf_pq" and n < IVF_PQ_MIN_TRAIN:
+        return "flat"
+    return index_type
+
+def index_type_of(index) -> str:
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+def nlist_for(n: int) -> int:
+    # ~4·sqrt(n) listas, con al menos 39 vectores de entrenamiento por centroide
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+def needs_retrain(index, n: int) -> bool:
+    """
+    Un índice IVF entrenado con un corpus mucho menor queda con muy pocas listas.
+    """
+    if index_type_of(index) not in ("ivf_flat", "ivf_pq"):
+        return False
+    return nlist_for(n) >= 2 * faiss.extract_index_ivf(index).nlist
+
+def build_index(index_type: str, dimension: int, vectors: np.ndarray, ids: np.ndarray):
+    """
+    Crea un índice del tipo pedido, lo entrena con `vectors` si hace falta
+    y los agrega con sus ids estables (int64). Los IVF guardan los ids de forma
+    nativa; Flat y HNSW van envueltos en un IndexIDMap.
+    """
+    n = len(vectors)
+    if index_type == "flat":
+        index = faiss.IndexIDMap(faiss.IndexFlatL2(dimension))
+    elif index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dimension, HNSW_M)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index = faiss.IndexIDMap(hnsw)
+    elif index_type == "ivf_flat":
+        index = faiss.index_factory(dimension, f"IVF{nlist_for(n)},Flat")
+    elif index_type == "ivf_pq":
+        # Subcuantizadores de 8 dimensiones, 8 bits cada uno (96 bytes por vector con 768 dims)
+        index = faiss.index_factory(dimension, f"IVF{nlist_for(n)},PQ{dimension // 8}")
+    else:
+        raise ValueError(f"Tipo de índice desconocido: {index_type}")
+
+    if not index.is_trained:
+        min_train = IVF_PQ_MIN_TRAIN if index_type == "ivf_pq" else IVF_MIN_TRAIN
+        if n < min_train:
+            raise ValueError(f"Se necesitan al menos {min_train} vectores para entrenar '{index_type}'.")
+        index.train(vectors)
+    if n:
+        index.add_with_ids(vectors, np.asarray(ids, dtype='int64'))
+    return index
+
+def supports_remove(index) -> bool:
+    # HNSW no admite borrar vectores: sus bajas quedan como lápidas hasta compactar
+    return index_type_of(index) != "hnsw"
+
+def index_ids(index) -> np.ndarray:
+    """
+    Ids estables presentes en el índice.
+    """
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map)
+    invlists = faiss.extract_index_ivf(index).invlists
+    ids = [
+        faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+        for l in range(invlists.nlist) if invlists.list_size(l)
+    ]
+    return np.concatenate(ids) if ids else np.empty(0, dtype='int64')
+
+def search_params(index, nprobe: int = None, ef_search: int = None, sel=None):
+    """
+    Parámetros de búsqueda por consulta (no modifican el índice compartido).
+    sel: IDSelector opcional para excluir ids (lápidas).
+    """
+    index_type = index_type_of(index)
+    extra = {"sel": sel} if sel is not None else {}
+    if index_type in ("ivf_flat", "ivf_pq"):
+        return faiss.SearchParametersIVF(nprobe=nprobe or DEFAULT_NPROBE, **extra)
+    if index_type == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=ef_search or DEFAULT_EF_SEARCH, **extra)
+    return faiss.SearchParameters(**extra) if extra else None
+
+def _run_benchmark(n=100_000, n_queries=500, k=10, dimension=768):
+    """
+    Recall@k y latencia por consulta de cada tipo de índice frente a la búsqueda
+    exacta (flat), sobre un corpus sintético de vectores agrupados en clústeres.
+    """
+    import time
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(200, dimension)).astype('float32')
+    corpus = centers[rng.integers(0, len(centers), n)] + 0.3 * rng.normal(size=(n, dimension)).astype('float32')
+    queries = centers[rng.integers(0, len(centers), n_queries)] + 0.3 * rng.normal(size=(n_queries, dimension)).astype('float32')
+    corpus = np.ascontiguousarray(corpus, dtype='float32')
+    queries = np.ascontiguousarray(queries, dtype='float32')
+
+    ids = np.arange(n, dtype='int64')
+    flat = build_index("flat", dimension, corpus, ids)
+    start = time.perf_counter()
+    _, truth = flat.search(queries, k)
+    flat_ms = (time.perf_counter() - start) * 1000 / n_queries
+    print(f"Corpus sintético: {n} vectores de {dimension} dims, {n_queries} consultas, recall@{k}")
+    print(f"  {'flat':<9} {'':<14} recall=1.000  {flat_ms:7.3f} ms/consulta")
+
+    def recall(found):
+        return np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+
+    for index_type, knob, values in (
+        ("ivf_flat", "nprobe", (1, 8, 32)),
+        ("hnsw", "efSearch", (16, 64, 256)),
+        ("ivf_pq", "nprobe", (1, 8, 32)),
+    ):
+        start = time.perf_counter()
+        index = build_index(index_type, dimension, corpus, ids)
+        build_s = time.perf_counter() - start
+        for value in values:
+            params = search_params(index, nprobe=value, ef_search=value)
+            start = time.perf_counter()
+            _, found = index.search(queries, k, params=params)
+            ms = (time.perf_counter() - start) * 1000 / n_queries
+            print(f"  {index_type:<9} {knob + '=' + str(value):<14} recall={recall(found):.3f}  {ms:7.3f} ms/consulta"
+                  f"  (construcción {build_s:.1f} s)")
+
+if __name__ == "__main__":
+    import sys
+    if "--bench" in sys.argv:
+        _run_benchmark()
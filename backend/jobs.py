@@ -0,0 +1,211 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from concurrency import run_blocking
+
+# Número de ingestas que corren en paralelo
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Trabajos terminados que se conservan al compactar el journal
+MAX_FINISHED_JOBS = int(os.getenv("MAX_FINISHED_JOBS", "500"))
+# Tamaño del journal que dispara una compactación (o el doble de lo que ocupó la última)
+JOB_JOURNAL_MAX_BYTES = int(os.getenv("JOB_JOURNAL_MAX_BYTES", str(16 * 1024 * 1024)))
+
+ACTIVE_STATUSES = ("queued", "running")
+
+class JobManager:
+    """
+    Cola de trabajos de ingesta con un pool de workers asíncronos.
+    Cada cambio de estado se anexa a un journal JSONL en disco, de modo que los
+    trabajos pendientes se reanudan si el backend se reinicia. Las escrituras las hace
+    un hilo propio, en orden y fuera del event loop, y el journal se compacta cuando
+    crece más de JOB_JOURNAL_MAX_BYTES.
+    """
+    def __init__(self, handler, journal_path="data/jobs.jsonl", concurrency=INGEST_WORKERS):
+        # handler: async def handler(job: dict, report) -> dict (resultado)
+        self.handler = handler
+        self.journal_path = journal_path
+        self.concurrency = concurrency
+        self.jobs = {}
+        self.queue = None
+        self.workers = []
+        # Hilo escritor del journal (uno solo: los registros se escriben en orden)
+        self._writer = None
+        self._journal_bytes = 0
+        self._compact_at = JOB_JOURNAL_MAX_BYTES
+
+    async def start(self):
+        """
+        Carga el journal, re-encola los trabajos no terminados y arranca los workers.
+        """
+        self.queue = asyncio.Queue()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs-journal")
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._load)
+        self._compact()
+
+        pending = sorted(
+            (j for j in self.jobs.values() if j["status"] in ACTIVE_STATUSES),
+            key=lambda j: j["created_at"]
+        )
+        for job in pending:
+            # Un trabajo 'running' al apagar se reinicia desde el principio
+            self._update(job["id"], status="queued", stage="queued", progress=0.0)
+            self.queue.put_nowait(job["id"])
+        if pending:
+            print(f"🔁 Reanudando {len(pending)} trabajo(s) de ingesta pendientes.")
+
+        self.workers = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+
+    async def stop(self):
+        for w in self.workers:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self._writer is not None:
+            # Esperar a que el journal quede escrito
+            await run_blocking(self._writer.shutdown)
+            self._writer = None
+
+    def submit(self, payload: dict, result: dict = None) -> dict:
+        """
+        Registra un nuevo trabajo y lo encola. Retorna el trabajo creado.
+        Si ya se conoce el resultado (p. ej. un duplicado), el trabajo nace terminado.
+        """
+        now = time.time()
+        done = result is not None
+        job = {
+            "id": str(uuid.uuid4()),
+            "status": "done" if done else "queued",
+            "stage": "done" if done else "queued",
+            "progress": 1.0 if done else 0.0,
+            "payload": payload,
+            "result": result,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        self.jobs[job["id"]] = job
+        self._append(job)
+        if not done:
+            self.queue.put_nowait(job["id"])
+        return job
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def list(self, status: str = None):
+        jobs = sorted(self.jobs.values(), key=lambda j: j["created_at"], reverse=True)
+        if status:
+            jobs = [j for j in jobs if j["status"] == status]
+        return jobs
+
+    def find_active(self, **payload_fields):
+        """
+        Busca un trabajo pendiente cuyo payload coincida con los campos dados.
+        """
+        for job in self.jobs.values():
+            if job["status"] not in ACTIVE_STATUSES:
+                continue
+            if all(job["payload"].get(k) == v for k, v in payload_fields.items()):
+                return job
+        return None
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if not job or job["status"] != "queued":
+            return
+
+        self._update(job_id, status="running")
+
+        def report(stage: str, progress: float = None, **extra):
+            fields = {"stage": stage, **extra}
+            if progress is not None:
+                fields["progress"] = round(progress, 3)
+            self._update(job_id, **fields)
+
+        try:
+            result = await self.handler(job, report)
+            self._update(job_id, status="done", stage="done", progress=1.0, result=result)
+        except Exception as e:
+            print(f"❌ Trabajo {job_id} falló: {e}")
+            self._update(job_id, status="error", error=str(e))
+
+    def _update(self, job_id: str, **fields):
+        job = self.jobs[job_id]
+        job.update(fields)
+        job["updated_at"] = time.time()
+        self._append(job)
+
+    def _append(self, job: dict):
+        line = json.dumps(job, ensure_ascii=False) + "\n"
+        self._journal_bytes += len(line.encode("utf-8"))
+        if self._journal_bytes > self._compact_at:
+            self._compact()
+        else:
+            self._write(self._append_lines, [line])
+
+    def _write(self, func, lines: list):
+        # Se serializa en el event loop (estado consistente); el disco, en el hilo escritor
+        if self._writer is None:
+            func(lines)
+        else:
+            self._writer.submit(self._safe_write, func, lines)
+
+    def _safe_write(self, func, lines: list):
+        try:
+            func(lines)
+        except Exception as e:
+            print(f"❌ Error escribiendo el journal de trabajos: {e}")
+
+    def _append_lines(self, lines: list):
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    def _rewrite(self, lines: list):
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.journal_path)
+
+    def _load(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    job = json.loads(line)
+                except json.JSONDecodeError:
+                    # Línea truncada por un apagado brusco: ignorar
+                    continue
+                self.jobs[job["id"]] = job
+
+    def _compact(self):
+        """
+        Reescribe el journal con el último estado de cada trabajo (escritura atómica)
+        y descarta los trabajos terminados más antiguos. Se ejecuta al arrancar y cuando
+        el journal pasa del umbral de tamaño.
+        """
+        finished = sorted(
+            (j for j in self.jobs.values() if j["status"] not in ACTIVE_STATUSES),
+            key=lambda j: j["updated_at"], reverse=True
+        )
+        for job in finished[MAX_FINISHED_JOBS:]:
+            del self.jobs[job["id"]]
+
+        lines = [json.dumps(job, ensure_ascii=False) + "\n"
+                 for job in sorted(self.jobs.values(), key=lambda j: j["created_at"])]
+        self._journal_bytes = sum(len(line.encode("utf-8")) for line in lines)
+        # Si lo vigente ya ocupa mucho, no compactar de nuevo hasta que doble su tamaño
+        self._compact_at = max(JOB_JOURNAL_MAX_BYTES, 2 * self._journal_bytes)
+        self._write(self._rewrite, lines)
@@ -1,18 +1,32 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Body
+from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-import shutil
+from fastapi.responses import StreamingResponse
+import asyncio
+import glob
+import hashlib
+import json
+import mimetypes
 import os
+import re
 import uuid
 import uvicorn
-from gtts import gTTS
+from contextlib import asynccontextmanager
 
 # Módulos Principales
-# from extractor import extract_text_from_pdf
+from extractor import extract_text_from_pdf, page_count, page_runs, shard_runs, write_pdf_pages, PDF_LOCAL_EXTRACTION, PDF_SHARD_PAGES
 # MODELOS LOCALES REEMPLAZADOS POR GEMINI
-from gemini_service import GeminiService
+from image_processing import preprocess_image, supports as image_supported, IMAGE_MAX_EDGE, IMAGE_PREPROCESS, IMAGE_QUALITY
+from gemini_service import GeminiService, CHAT_CONTEXT_TOKENS, CHARS_PER_TOKEN
 from embeddings import EmbeddingGenerator
 from vector_store import VectorStore
+from metadata_store import TIER_FULL, TIER_QUICK
+from concurrency import BLOCKING_WORKERS, iterate_blocking, run_blocking
+from cache import DocumentTextCache, EmbeddingCache, LRUCache, normalize_text, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL
+from jobs import JobManager
+from rate_limiter import BULK, call_priority, limiter
+from chunking import split_passages
+from exporter import table_rows, xlsx_stream, XLSX_MIME_TYPE
+from tts import TTSService
 
 app = FastAPI(title="Document AI API - Gemini Powered")
 
@@ -30,13 +44,16 @@ gemini_service = None
 embedder = None
 vector_store = None
 
+# Caché de resultados de /search, invalidada por la generación del índice
+search_cache = LRUCache(max_entries=SEARCH_CACHE_MAX_ENTRIES, ttl=SEARCH_CACHE_TTL)
+
 def get_services():
     global gemini_service, embedder, vector_store
     if gemini_service is None:
         print("⚡ Cargando Servicios de IA (Primera Ejecución)...")
         try:
-            gemini_service = GeminiService()
-            embedder = EmbeddingGenerator()
+            gemini_service = GeminiService(text_cache=text_cache)
+            embedder = EmbeddingGenerator(cache=EmbeddingCache())
             vector_store = VectorStore()
             print("✅ Servicios de IA listos.")
         except Exception as e:
@@ -44,29 +61,482 @@ def get_services():
             raise e
     return gemini_service, embedder, vector_store
 
+# Segundos entre reconciliaciones de los documentos con el disco (0 = desactivado)
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "900"))
+# Segundos entre barridos de archivos subidos a Gemini que ya no se necesitan (0 = desactivado)
+GEMINI_FILE_SWEEP_INTERVAL = int(os.getenv("GEMINI_FILE_SWEEP_INTERVAL", "600"))
+# Análisis por niveles: primero categoría y resumen, la transcripción completa después (0 = una sola pasada)
+ANALYSIS_TIERED = os.getenv("ANALYSIS_TIERED", "1") == "1"
+# Transcribir en segundo plano los documentos del nivel rápido (0 = solo cuando chat o comparación la necesitan)
+TRANSCRIBE_IN_BACKGROUND = os.getenv("TRANSCRIBE_IN_BACKGROUND", "1") == "1"
+# Reintentos del OCR de cada fragmento de páginas de un PDF (aparte de los reintentos por 429)
+PDF_SHARD_RETRIES = int(os.getenv("PDF_SHARD_RETRIES", "2"))
+# Fragmentos de PDF en OCR a la vez en todo el proceso: cada uno ocupa un hilo del pool
+# bloqueante mientras espera turno en el limitador, y búsqueda y chat necesitan el resto
+PDF_SHARD_CONCURRENCY = int(os.getenv("PDF_SHARD_CONCURRENCY", str(max(1, BLOCKING_WORKERS // 4))))
+shard_slots = asyncio.Semaphore(PDF_SHARD_CONCURRENCY)
+
 # Asegurar directorios
 UPLOAD_DIR = "data/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Texto extraído de los documentos, compartido por rerank, chat y comparación
+text_cache = DocumentTextCache(UPLOAD_DIR)
+# Audios de /generate_audio, en caché por hash de (texto, idioma)
+tts_service = TTSService()
+# Los audios no cambian nunca (la URL y el ETag son el hash del contenido)
+AUDIO_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def _save_upload(src, path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Copia el archivo subido a disco por bloques y calcula su SHA-256 al vuelo.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "wb") as buffer:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            buffer.write(chunk)
+    return sha256.hexdigest()
+
+def _split_document(text: str, summary: str) -> list:
+    """
+    Pasajes a indexar de un documento; si no hay texto extraído, el resumen.
+    """
+    passages = split_passages(text) if text else []
+    if not passages and summary:
+        passages = [{"start": None, "end": None, "text": summary}]
+    return passages
+
+# Aviso en lugar del texto de un documento del nivel rápido. No se guarda en
+# data/uploads (versiones anteriores sí lo hacían: /reindex lo ignora)
+PENDING_TEXT = "Transcripción completa pendiente."
+
+def _analysis_response(meta: dict, text: str) -> dict:
+    return {
+        "id": meta["id"],
+        "filename": meta["filename"],
+        "category": meta.get("category"),
+        "category_score": meta.get("category_score", 0.0),
+        "summary": meta.get("summary"),
+        "tier": meta.get("tier"),
+        "text_preview": text[:500] + "..."
+    }
+
+async def _transcribe_shard(gemini_service, file_path: str, start: int, end: int, content_hash: str = None) -> str:
+    """
+    OCR con Gemini de las páginas [start, end) de un PDF, guardadas como PDF aparte.
+    Reintenta los fallos que no son de límite de tasa (esos ya los reintenta el limitador).
+    """
+    shard_path = f"{file_path}.p{start + 1}-{end}.pdf"
+    shard_hash = f"{content_hash}:p{start + 1}-{end}" if content_hash else None
+    await run_blocking(write_pdf_pages, file_path, start, end, shard_path)
+    try:
+        for attempt in range(PDF_SHARD_RETRIES + 1):
+            try:
+                async with shard_slots:
+                    return await gemini_service.transcribe_file(shard_path, content_hash=shard_hash)
+            except Exception as e:
+                if attempt == PDF_SHARD_RETRIES:
+                    raise
+                print(f"⚠️ OCR de las páginas {start + 1}-{end} fallido ({e}): reintento {attempt + 1}/{PDF_SHARD_RETRIES}.")
+                await asyncio.sleep(2 ** attempt)
+    finally:
+        await run_blocking(os.remove, shard_path)
+
+async def _extract_pdf(file_path: str):
+    """
+    Extracción local de la capa de texto de un PDF, o None si está desactivada o falla.
+    """
+    if not PDF_LOCAL_EXTRACTION:
+        return None
+    try:
+        return await run_blocking(extract_text_from_pdf, file_path)
+    except Exception as e:
+        print(f"⚠️ Extracción local fallida, se usa Gemini: {e}")
+        return None
+
+async def _transcribe_pdf(gemini_service, file_path: str, content_hash: str = None, report=None, extraction=None):
+    """
+    Texto completo de un PDF por páginas: el de las páginas digitales se extrae localmente
+    y las escaneadas se transcriben con Gemini en fragmentos de PDF_SHARD_PAGES páginas,
+    en paralelo (bajo el limitador) y reintentando cada fragmento por separado. El texto
+    se une en orden de página. Como mucho PDF_SHARD_CONCURRENCY fragmentos (de todos los
+    documentos) esperan a Gemini a la vez. Retorna None si conviene enviar el PDF entero a Gemini
+    (escaneado y de pocas páginas, o ilegible localmente).
+    """
+    if extraction is None:
+        extraction = await _extract_pdf(file_path)
+
+    if extraction and extraction["text"].strip():
+        pages = list(extraction["pages"])
+        scanned = extraction["scanned_pages"]
+        print(f"📄 Texto extraído localmente: {extraction['page_count'] - len(scanned)} de {extraction['page_count']} páginas.")
+    else:
+        try:
+            n = extraction["page_count"] if extraction else await run_blocking(page_count, file_path)
+        except Exception as e:
+            print(f"⚠️ No se pudo leer el PDF localmente, se envía entero a Gemini: {e}")
+            return None
+        if n <= PDF_SHARD_PAGES:
+            return None
+        pages = [""] * n
+        scanned = list(range(n))
+
+    shards = shard_runs(page_runs(scanned), PDF_SHARD_PAGES)
+    if len(shards) > 1:
+        print(f"📚 {len(scanned)} páginas a transcribir en {len(shards)} fragmentos.")
+    progress = {"done": 0, "failed": 0}
+
+    async def transcribe(start: int, end: int) -> str:
+        try:
+            return await _transcribe_shard(gemini_service, file_path, start, end, content_hash)
+        except Exception:
+            progress["failed"] += 1
+            raise
+        finally:
+            progress["done"] += 1
+            if report:
+                report("analyzing", 0.1 + 0.4 * progress["done"] / len(shards),
+                       shards_done=progress["done"], shards_total=len(shards), shards_failed=progress["failed"])
+
+    results = await asyncio.gather(*(transcribe(start, end) for start, end in shards), return_exceptions=True)
+    for (start, end), result in zip(shards, results):
+        if isinstance(result, Exception):
+            print(f"❌ OCR de las páginas {start + 1}-{end} fallido: {result}")
+            # Se conserva lo que haya de capa de texto y se marca el hueco
+            pages[start] = "\n\n".join(filter(None, [
+                f"[Páginas {start + 1}-{end}: transcripción no disponible]", *(p.strip() for p in pages[start:end])
+            ]))
+        else:
+            # El texto del fragmento va en su primera página para conservar el orden
+            pages[start] = result
+        for i in range(start + 1, end):
+            pages[i] = ""
+
+    if shards and progress["failed"] == len(shards) and not (extraction and extraction["text"].strip()):
+        raise RuntimeError(f"No se pudo transcribir ninguno de los {len(shards)} fragmentos del PDF.")
+
+    return "\n\n".join(page for page in pages if page.strip())
+
+async def _analyze_pdf(gemini_service, file_path: str, content_hash: str = None, report=None):
+    """
+    Análisis completo de un PDF por páginas (ver _transcribe_pdf); la clasificación y el
+    resumen se hacen sobre el texto ya unido. Retorna un resultado con la forma de
+    analyze_file, o None si conviene enviar el PDF entero a Gemini.
+    """
+    text = await _transcribe_pdf(gemini_service, file_path, content_hash, report)
+    if text is None:
+        return None
+    analysis = await run_blocking(gemini_service.analyze_text, text)
+    return {"full_text_extracted": text, **analysis}
+
+@asynccontextmanager
+async def _prepared_image(file_path: str, mime_type: str, content_hash: str = None, report=None):
+    """
+    Reduce y limpia una imagen (orientación EXIF, lado máximo, recodificación sin metadatos)
+    para subirla a Gemini; entrega (ruta, tipo MIME, hash) de la copia preparada y la borra
+    al salir. El original queda en disco para la vista previa; si la imagen no se puede
+    preparar (o el preprocesamiento está desactivado), se entrega el original.
+    """
+    if not (IMAGE_PREPROCESS and image_supported(mime_type)):
+        yield file_path, mime_type, content_hash
+        return
+    try:
+        prepared = await run_blocking(preprocess_image, file_path, mime_type)
+    except Exception as e:
+        print(f"⚠️ Preprocesamiento de imagen fallido, se sube el original: {e}")
+        yield file_path, mime_type, content_hash
+        return
+
+    saved = prepared["original_bytes"] - prepared["processed_bytes"]
+    print(f"🖼️ Imagen preparada: {prepared['original_bytes'] / 1e6:.2f} MB → {prepared['processed_bytes'] / 1e6:.2f} MB "
+          f"({prepared['size'][0]}x{prepared['size'][1]}).")
+    if report:
+        report("analyzing", 0.2, image_original_bytes=prepared["original_bytes"],
+               image_processed_bytes=prepared["processed_bytes"], image_bytes_saved=saved)
+    try:
+        # El hash incluye los ajustes: con otros ajustes la imagen subida es distinta
+        prepared_hash = f"{content_hash}:img{IMAGE_MAX_EDGE}q{IMAGE_QUALITY}" if content_hash else None
+        yield prepared["path"], prepared["mime_type"], prepared_hash
+    finally:
+        if prepared["path"] != file_path:
+            await run_blocking(os.remove, prepared["path"])
+
+async def _full_analysis(gemini_service, file_path: str, mime_type: str, content_hash: str = None, report=None) -> dict:
+    """
+    Análisis en una sola pasada: transcripción completa, clasificación y resumen.
+    """
+    if mime_type == "application/pdf":
+        result = await _analyze_pdf(gemini_service, file_path, content_hash, report)
+        if result is not None:
+            return result
+    print(f"Enviando {file_path} ({mime_type}) a Gemini para Análisis Completo...")
+    async with _prepared_image(file_path, mime_type, content_hash, report) as (path, upload_mime, upload_hash):
+        return await gemini_service.analyze_file(path, mime_type=upload_mime, content_hash=upload_hash)
+
+async def _quick_analysis(gemini_service, file_path: str, mime_type: str, content_hash: str = None, report=None):
+    """
+    Primer nivel del análisis por niveles: categoría y resumen sin la transcripción completa
+    (el texto local de un PDF mixto, si lo hay, se indexa ya). Retorna (resultado, nivel):
+    los PDFs sin páginas escaneadas salen ya con el nivel completo.
+    """
+    if mime_type == "application/pdf":
+        extraction = await _extract_pdf(file_path)
+        if extraction and extraction["text"].strip():
+            text = extraction["text"]
+            analysis = await run_blocking(gemini_service.analyze_text, text)
+            if not extraction["scanned_pages"]:
+                return {"full_text_extracted": text, **analysis}, TIER_FULL
+            # Con mayoría de páginas escaneadas el texto local no basta para resumir
+            if len(extraction["scanned_pages"]) * 2 <= extraction["page_count"]:
+                return {"full_text_extracted": text, **analysis}, TIER_QUICK
+    async with _prepared_image(file_path, mime_type, content_hash, report) as (path, upload_mime, upload_hash):
+        result = await gemini_service.quick_analyze_file(path, mime_type=upload_mime, content_hash=upload_hash)
+    return result, TIER_QUICK
+
+async def _transcribe_document(gemini_service, file_path: str, mime_type: str, content_hash: str = None, report=None) -> str:
+    """
+    Segundo nivel del análisis por niveles: solo la transcripción completa.
+    """
+    if mime_type == "application/pdf":
+        text = await _transcribe_pdf(gemini_service, file_path, content_hash, report)
+        if text is not None:
+            return text
+    async with _prepared_image(file_path, mime_type, content_hash, report) as (path, upload_mime, upload_hash):
+        return await gemini_service.transcribe_file(path, mime_type=upload_mime, content_hash=upload_hash)
+
+async def _embed_passages(embedder, text: str, summary: str) -> list:
+    # Un embedding por pasaje solapado (el texto completo excede lo que el modelo representa)
+    passages = _split_document(text, summary)
+    vectors, errors = await run_blocking(embedder.generate_batch, [p["text"] for p in passages])
+    if errors:
+        print(f"⚠️ {len(errors)} de {len(passages)} pasajes sin embedding: se omiten.")
+    passages = [dict(p, vector=vectors[i]) for i, p in enumerate(passages) if i not in errors]
+    if not passages:
+        raise RuntimeError("No se pudieron generar embeddings del documento.")
+    return passages
+
+async def run_ingestion(job: dict, report) -> dict:
+    """
+    Pipeline de ingesta de un archivo ya guardado en disco.
+    Lo ejecutan los workers del JobManager; `report` publica etapa y progreso.
+    """
+    gemini_service, embedder, vector_store = get_services()
+    # La ingesta cede el paso a búsquedas y chat en el limitador de Gemini
+    call_priority.set(BULK)
+    payload = job["payload"]
+    file_id = payload["file_id"]
+    file_path = payload["file_path"]
+    mime_type = payload["mime_type"]
+    original_name = payload["filename"]
+    content_hash = payload.get("content_hash")
+
+    # 1. PIPELINE DE ANÁLISIS (Gemini Multimodal: OCR + Clasificación + Resumen)
+    report("analyzing", 0.1)
+    if ANALYSIS_TIERED:
+        # Primero categoría y resumen; la transcripción completa se hace después
+        analysis_result, tier = await _quick_analysis(gemini_service, file_path, mime_type, content_hash, report)
+    else:
+        analysis_result = await _full_analysis(gemini_service, file_path, mime_type, content_hash, report)
+        tier = TIER_FULL
+
+    extracted = analysis_result.get("full_text_extracted", "")
+    text = extracted
+    if not text:
+         text = PENDING_TEXT if tier == TIER_QUICK else "Texto no encontrado por Gemini."
+         
+    classification = analysis_result.get("classification", {})
+    category = classification.get("category", "Uncategorized")
+    score = classification.get("confidence", 0.0)
+    
+    summary = analysis_result.get("summary", "Resumen no disponible.")
+    
+    # 2. Almacenar Resultado
+    report("embedding", 0.6)
+    print("Generando embeddings...")
+    
+    # GUARDAR TEXTO COMPLETO EN DISCO para Contexto de Búsqueda Semántica
+    # (sin texto en el nivel rápido: lo escribe la transcripción completa)
+    if extracted or tier != TIER_QUICK:
+        await run_blocking(text_cache.write, file_id, text)
+        
+    passages = await _embed_passages(embedder, extracted, summary)
+    
+    # 3. Almacenar en FAISS (idempotente: un trabajo reanudado no duplica el documento)
+    report("storing", 0.9)
+    metadata = {
+        "id": file_id,
+        "filename": original_name,
+        "path": file_path,
+        "mime_type": mime_type,
+        "category": category,
+        "category_score": score,
+        "summary": summary,
+        "content_hash": content_hash,
+        "tier": tier,
+        "deleted": False
+    }
+    if not await run_blocking(vector_store.get_document, file_id):
+        await run_blocking(vector_store.add_document, metadata, passages, extracted)
+
+    if tier == TIER_QUICK and TRANSCRIBE_IN_BACKGROUND and not job_manager.find_active(kind="transcribe", file_id=file_id):
+        job_manager.submit({"kind": "transcribe", "file_id": file_id})
+    
+    return _analysis_response(metadata, text)
+
+# Transcripciones completas en curso por documento (compartidas entre el trabajo
+# en segundo plano y las peticiones que necesitan el texto)
+transcription_tasks = {}
+
+async def _complete_document(meta: dict, report=None):
+    """
+    Transcribe por completo un documento del nivel rápido y reemplaza su texto y pasajes.
+    """
+    gemini_service, embedder, vector_store = get_services()
+    mime_type = meta.get("mime_type") or mimetypes.guess_type(meta["path"])[0] or "application/pdf"
+    text = await _transcribe_document(gemini_service, meta["path"], mime_type, meta.get("content_hash"), report)
+    if report:
+        report("embedding", 0.6)
+    passages = await _embed_passages(embedder, text, meta.get("summary"))
+    if report:
+        report("storing", 0.9)
+    if await run_blocking(vector_store.complete_document, meta["id"], passages, text):
+        await run_blocking(text_cache.write, meta["id"], text)
+        print(f"✅ Transcripción completa de {meta['filename']} lista.")
+
+async def ensure_full_text(doc_identifier: str, report=None):
+    """
+    Garantiza que el documento (id o nombre de archivo) tenga la transcripción completa:
+    si está en el nivel rápido, la ejecuta ahora o espera la que ya esté en curso.
+    """
+    _, _, vector_store = get_services()
+    meta = await run_blocking(vector_store.get_document, doc_identifier) \
+        or await run_blocking(vector_store.find_by_filename, doc_identifier)
+    if not meta or meta.get("tier") != TIER_QUICK:
+        return
+    doc_id = meta["id"]
+    task = transcription_tasks.get(doc_id)
+    if task is None:
+        task = asyncio.create_task(_complete_document(meta, report))
+        transcription_tasks[doc_id] = task
+        task.add_done_callback(lambda _: transcription_tasks.pop(doc_id, None))
+    # Si la petición que espera se cancela, la transcripción sigue para los demás
+    await asyncio.shield(task)
+
+async def _try_full_text(doc_identifier: str):
+    # Chat y comparación usan el texto disponible si la transcripción completa falla
+    try:
+        await ensure_full_text(doc_identifier)
+    except Exception as e:
+        print(f"⚠️ Transcripción completa de {doc_identifier} fallida, se usa el texto disponible: {e}")
+
+async def run_transcription(job: dict, report) -> dict:
+    """
+    Trabajo en segundo plano del análisis por niveles: transcripción completa de un documento.
+    """
+    call_priority.set(BULK)
+    doc_id = job["payload"]["file_id"]
+    report("analyzing", 0.1)
+    await ensure_full_text(doc_id, report)
+    return {"id": doc_id, "tier": TIER_FULL}
+
+async def run_job(job: dict, report) -> dict:
+    if job["payload"].get("kind") == "transcribe":
+        return await run_transcription(job, report)
+    return await run_ingestion(job, report)
+
+job_manager = JobManager(run_job)
+reconcile_task = None
+sweep_task = None
+
+async def reconcile_loop():
+    """
+    Marca periódicamente los documentos cuyo archivo desapareció del disco,
+    para que listados y búsquedas no tengan que comprobarlo en cada petición.
+    """
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        if vector_store is None:
+            continue
+        try:
+            await run_blocking(vector_store.reconcile)
+        except Exception as e:
+            print(f"❌ Error en la reconciliación: {e}")
+
+async def sweep_files_loop():
+    """
+    Borra periódicamente de Gemini los archivos subidos vencidos o liberados.
+    """
+    while True:
+        await asyncio.sleep(GEMINI_FILE_SWEEP_INTERVAL)
+        if gemini_service is None:
+            continue
+        try:
+            await run_blocking(gemini_service.sweep_files)
+        except Exception as e:
+            print(f"❌ Error barriendo archivos de Gemini: {e}")
+
+@app.on_event("startup")
+async def start_job_manager():
+    global reconcile_task, sweep_task
+    await job_manager.start()
+    if RECONCILE_INTERVAL > 0:
+        reconcile_task = asyncio.create_task(reconcile_loop())
+    if GEMINI_FILE_SWEEP_INTERVAL > 0:
+        sweep_task = asyncio.create_task(sweep_files_loop())
+    # Audios sueltos de versiones anteriores de /generate_audio (ahora viven en la caché de TTS)
+    legacy_audio = glob.glob(os.path.join(UPLOAD_DIR, "audio_*.mp3"))
+    for path in legacy_audio:
+        await run_blocking(os.remove, path)
+    if legacy_audio:
+        print(f"🧹 {len(legacy_audio)} audio(s) antiguos eliminados de {UPLOAD_DIR}.")
+
+@app.on_event("shutdown")
+async def stop_job_manager():
+    for task in (reconcile_task, sweep_task):
+        if task is not None:
+            task.cancel()
+    await job_manager.stop()
+    if vector_store is not None:
+        await run_blocking(vector_store.close)
+
 @app.post("/analyze")
 async def analyze_document(file: UploadFile = File(...)):
-    msg_services = get_services()
-    gemini_service, embedder, vector_store = msg_services
+    """
+    Guarda el archivo y encola su ingesta. Retorna el id del trabajo de inmediato;
+    el progreso y el resultado se consultan en /jobs/{job_id}.
+    """
+    _, _, vector_store = get_services()
     try:
-        # 0. Verificar Duplicados
-        if vector_store.check_file_exists(file.filename):
+        # 0. Verificar Duplicados (ya almacenados o en cola)
+        if await run_blocking(vector_store.check_file_exists, file.filename) or job_manager.find_active(filename=file.filename):
              raise HTTPException(status_code=400, detail=f"El archivo '{file.filename}' ya existe en el sistema.")
              
-        # 1. Guardar Archivo
+        # 1. Guardar Archivo (calculando su hash de contenido al vuelo)
         file_id = str(uuid.uuid4())
         file_ext = file.filename.split(".")[-1]
         filename = f"{file_id}.{file_ext}"
         file_path = f"data/uploads/{filename}"
         
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
-        # 1. PIPELINE DE ANÁLISIS (Gemini Multimodal: OCR + Clasificación + Resumen)
+        content_hash = await run_blocking(_save_upload, file.file, file_path)
+
+        # 1b. Mismo contenido con otro nombre: reutilizar el análisis existente
+        # sin llamar a Gemini ni agregar vectores nuevos
+        existing = await run_blocking(vector_store.find_by_hash, content_hash)
+        in_flight = None if existing else job_manager.find_active(content_hash=content_hash)
+        if existing or in_flight:
+            await run_blocking(os.remove, file_path)
+        if in_flight:
+            return {"job_id": in_flight["id"], "status": in_flight["status"], "filename": file.filename}
+        if existing:
+            text = await run_blocking(text_cache.get, existing['id']) or ""
+            result = {**_analysis_response(existing, text), "duplicate_of": existing["id"]}
+            job = job_manager.submit({"filename": file.filename, "content_hash": content_hash}, result=result)
+            print(f"♻️ '{file.filename}' es idéntico a '{existing['filename']}': se reutiliza su análisis.")
+            return {"job_id": job["id"], "status": job["status"], "filename": file.filename, "duplicate_of": existing["id"]}
         
         # Detectar Tipo MIME
         mime_type = file.content_type
@@ -75,236 +545,494 @@ async def analyze_document(file: UploadFile = File(...)):
              elif file_ext == "png": mime_type = "image/png"
              elif file_ext == "webp": mime_type = "image/webp"
              else: mime_type = "application/pdf"
-             
-        print(f"Enviando {filename} ({mime_type}) a Gemini para Análisis Completo...")
-        
-        analysis_result = gemini_service.analyze_file(file_path, mime_type=mime_type)
-        
-        # Verificar si falló
-        if "error" in analysis_result:
-             # ¿Fallback? O solo retornar error
-             pass 
-
-        text = analysis_result.get("full_text_extracted", "")
-        if not text:
-             text = "Texto no encontrado por Gemini."
-             
-        classification = analysis_result.get("classification", {})
-        category = classification.get("category", "Uncategorized")
-        score = classification.get("confidence", 0.0)
-        
-        summary = analysis_result.get("summary", "Resumen no disponible.")
-        
-        # 2. Almacenar Resultado (Embeddings siguen siendo locales)
-        print("Generando embeddings (Local)...")
-        
-        # GUARDAR TEXTO COMPLETO EN DISCO para Contexto de Búsqueda Semántica
-        txt_path = f"data/uploads/{file_id}.txt"
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(text)
-            
-        # El generador de embeddings necesita texto. Gemini provee texto de alta calidad ahora.
-        vector = embedder.generate(text)
-        
-        # 3. Almacenar en FAISS
-        metadata = {
-            "id": file_id,
-            "filename": file.filename,
-            "path": file_path,
-            "category": category,
-            "summary": summary,
-            "deleted": False
-        }
-        vector_store.add_document(vector, metadata)
-        
-        return {
+
+        # 2. Encolar Ingesta
+        job = job_manager.submit({
+            "file_id": file_id,
+            "file_path": file_path,
+            "mime_type": mime_type,
             "filename": file.filename,
-            "category": category,
-            "category_score": score,
-            "summary": summary,
-            "text_preview": text[:500] + "...",
-            "full_text": text
-        }
+            "content_hash": content_hash,
+        })
+        return {"job_id": job["id"], "status": job["status"], "filename": file.filename}
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error: {e}")
         return {"error": str(e)}
 
+@app.get("/jobs")
+async def list_jobs(status: str = None):
+    # El listado omite el texto completo para mantener la respuesta ligera
+    # (los resultados de diarios anteriores aún pueden traerlo)
+    jobs = []
+    for job in job_manager.list(status):
+        result = job.get("result")
+        if result and "full_text" in result:
+            result = {k: v for k, v in result.items() if k != "full_text"}
+        jobs.append({**job, "result": result})
+    return jobs
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    # El resultado guardado no incluye el texto completo: se lee de la caché de textos
+    result = job.get("result")
+    if result and result.get("id"):
+        text = await run_blocking(text_cache.get, result["id"]) or ""
+        job = {**job, "result": {**result, "full_text": text}}
+    return job
+
 @app.get("/search")
-async def search_documents(query: str):
+async def search_documents(query: str, response: Response, nprobe: int = None, ef_search: int = None):
+    """
+    nprobe (índices IVF) y ef_search (HNSW) opcionales: más alto = mejor recall, más latencia.
+    """
     gemini_service, embedder, vector_store = get_services()
     try:
+        # 0. Caché de resultados: la clave incluye la generación del índice,
+        # así cualquier alta/baja de documentos invalida las entradas anteriores
+        cache_key = (normalize_text(query).lower(), vector_store.generation, nprobe, ef_search)
+        cached = search_cache.get(cache_key)
+        if cached is not None:
+            response.headers["X-Cache"] = "HIT"
+            return cached
+
         # La búsqueda es Híbrida + Rerank con Gemini:
         # 1. Embed query (Modelo Local)
-        query_embedding = embedder.generate(query)
+        query_embedding = await run_blocking(embedder.generate, query)
         
         # 2. Búsqueda en FAISS + Coincidencia de Palabras Clave
         # Obtener más candidatos (k=15) para dar a Gemini un buen grupo para filtrar
-        raw_candidates = vector_store.search(query_embedding, query_text=query, k=15)
+        raw_candidates = await run_blocking(
+            vector_store.search, query_embedding, query_text=query, k=15, nprobe=nprobe, ef_search=ef_search
+        )
         
         # 3. Reranking Semántico con Gemini
         # Pedir a Gemini que filtre el ruido y encuentre las coincidencias verdaderas
-        refined_results = gemini_service.semantic_search_rerank(query, raw_candidates)
+        refined_results = await run_blocking(gemini_service.semantic_search_rerank, query, raw_candidates)
         
+        # No cachear el fallback sin rerank (error de Gemini)
+        if not raw_candidates or any("ai_score" in r for r in refined_results):
+            search_cache.put(cache_key, refined_results)
+        response.headers["X-Cache"] = "MISS"
         return refined_results
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/stats")
+async def get_stats():
+    """
+    Estadísticas de cachés e índice para dimensionarlos.
+    """
+    gemini_service, embedder, vector_store = get_services()
+    return {
+        "embedding_cache": await run_blocking(embedder.cache.stats) if embedder.cache else None,
+        "search_cache": search_cache.stats(),
+        "text_cache": text_cache.stats(),
+        "gemini_files": await run_blocking(gemini_service.file_registry.stats),
+        "fact_cache": await run_blocking(gemini_service.fact_cache.stats),
+        "comparison_cache": gemini_service.comparison_cache.stats(),
+        "rate_limiter": limiter.stats(),
+        "tts": await run_blocking(tts_service.stats),
+        "index": await run_blocking(vector_store.index_info),
+    }
+
 @app.get("/documents")
 async def get_documents():
     _, _, vector_store = get_services()
     try:
-        return vector_store.list_documents()
+        return await run_blocking(vector_store.list_documents)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/documents/{doc_id}/text")
+async def get_document_text(doc_id: str):
+    """
+    Texto completo del documento. Si solo tiene el análisis rápido, espera su
+    transcripción completa (la inicia o se une a la que ya está en curso).
+    """
+    _, _, vector_store = get_services()
+    if not await run_blocking(vector_store.get_document, doc_id):
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+    try:
+        await ensure_full_text(doc_id)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Transcripción completa fallida: {e}")
+    meta = await run_blocking(vector_store.get_document, doc_id)
+    text = await run_blocking(text_cache.get, doc_id) or ""
+    return {"id": doc_id, "filename": meta["filename"], "tier": meta.get("tier"), "text": text}
+
 @app.delete("/documents/{doc_id}")
 async def delete_document(doc_id: str):
-    _, _, vector_store = get_services()
+    gemini_service, _, vector_store = get_services()
     try:
-        success = vector_store.delete_document(doc_id)
+        meta = await run_blocking(vector_store.get_document, doc_id)
+        success = await run_blocking(vector_store.delete_document, doc_id)
         if not success:
              raise HTTPException(status_code=404, detail="Archivo no encontrado")
+        text_cache.invalidate(doc_id)
+        await run_blocking(gemini_service.fact_cache.invalidate, doc_id)
+        if meta.get("content_hash"):
+            # La copia subida a Gemini ya no se necesita
+            await run_blocking(gemini_service.release_file, meta["content_hash"])
         return {"status": "eliminado", "id": doc_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/documents")
 async def delete_all_documents():
-    _, _, vector_store = get_services()
+    gemini_service, _, vector_store = get_services()
     try:
-        vector_store.clear_all()
+        # Cerrar los archivos mapeados antes de borrarlos
+        text_cache.clear()
+        await run_blocking(vector_store.clear_all)
+        await run_blocking(gemini_service.fact_cache.invalidate)
+        await run_blocking(gemini_service.release_file)
         return {"status": "todos_eliminados"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/documents/reconcile")
+async def reconcile_documents(repair: bool = False):
+    """
+    Comprueba en disco los archivos de los documentos y actualiza su estado.
+    repair=true además elimina del almacén los documentos cuyo archivo falta.
+    """
+    _, _, vector_store = get_services()
+    try:
+        result = await run_blocking(vector_store.reconcile, repair)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    for doc_id in result["removed"]:
+        text_cache.invalidate(doc_id)
+    return {"status": "reconciliado", **result}
+
+@app.post("/reindex")
+async def reindex_documents():
+    """
+    Vuelve a dividir en pasajes todos los documentos activos, recalcula sus
+    embeddings en lotes y reemplaza sus pasajes en el índice FAISS.
+    """
+    _, embedder, vector_store = get_services()
+    # Trabajo masivo: no debe adelantarse a búsquedas y chat
+    call_priority.set(BULK)
+    try:
+        docs = await run_blocking(vector_store.list_documents)
+        passages_per_doc = []
+        texts_by_id = {}
+        for doc in docs:
+            text = await run_blocking(text_cache.get, doc['id']) or ""
+            if doc.get('tier') == TIER_QUICK and text == PENDING_TEXT:
+                text = ""  # Sin texto todavía: conserva el pasaje del resumen
+            texts_by_id[doc['id']] = text
+            passages_per_doc.append(_split_document(text, doc.get('summary', '')))
+
+        all_passages = [p for passages in passages_per_doc for p in passages]
+        vectors, errors = await run_blocking(embedder.generate_batch, [p["text"] for p in all_passages])
+
+        # Los documentos con algún pasaje fallido conservan sus pasajes anteriores
+        passages_by_id = {}
+        failed = []
+        offset = 0
+        for doc, passages in zip(docs, passages_per_doc):
+            positions = range(offset, offset + len(passages))
+            offset += len(passages)
+            doc_errors = [errors[i] for i in positions if i in errors]
+            if doc_errors or not passages:
+                failed.append({"id": doc['id'], "filename": doc['filename'],
+                               "error": doc_errors[0] if doc_errors else "Sin texto"})
+                continue
+            passages_by_id[doc['id']] = [dict(p, vector=vectors[i]) for p, i in zip(passages, positions)]
+
+        total = await run_blocking(vector_store.reindex, passages_by_id, texts_by_id)
+        return {
+            "status": "reindexado",
+            "documents": total,
+            "passages": len(all_passages),
+            "failed": failed
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/index/rebuild")
+async def rebuild_index(index_type: str = None):
+    """
+    Reconstruye el índice vectorial desde los vectores guardados, opcionalmente
+    cambiando de tipo (flat, ivf_flat, hnsw, ivf_pq o auto) hasta el próximo reinicio.
+    """
+    _, _, vector_store = get_services()
+    try:
+        built = await run_blocking(vector_store.rebuild_index, index_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "reconstruido", "type": built, "index": await run_blocking(vector_store.index_info)}
+
+@app.post("/index/compact")
+async def compact_index():
+    """
+    Purga los documentos borrados y reconstruye el índice si quedaron lápidas (HNSW).
+    """
+    _, _, vector_store = get_services()
+    try:
+        purged = await run_blocking(vector_store.compact)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "compactado", "purged": purged, "index": await run_blocking(vector_store.index_info)}
+
+async def _chat_request(payload: dict) -> tuple:
+    """
+    Valida la petición de chat. Retorna (doc_id, query, metadatos del documento).
+    """
+    _, _, vector_store = get_services()
+    doc_id = payload.get("doc_id")
+    query = payload.get("query")
+    
+    if not doc_id or not query:
+         raise HTTPException(status_code=400, detail="Faltan parámetros doc_id o query")
+         
+    meta = await run_blocking(vector_store.get_document, doc_id)
+    if not meta:
+         raise HTTPException(status_code=404, detail="Documento no encontrado")
+    return doc_id, query, meta
+
+async def _chat_passages(doc_id: str, query: str) -> list:
+    """
+    Pasajes del documento más cercanos a la pregunta, dentro del presupuesto de contexto.
+    """
+    _, embedder, vector_store = get_services()
+    max_chars = CHAT_CONTEXT_TOKENS * CHARS_PER_TOKEN
+    query_embedding = await run_blocking(embedder.generate, query)
+    passages = await run_blocking(vector_store.search_document, doc_id, query_embedding, max_chars)
+    if not passages:
+        # Documentos sin pasajes con texto (formato anterior): inicio del texto extraído
+        text = await run_blocking(text_cache.head, doc_id, max_chars)
+        if text is None:
+             raise HTTPException(status_code=404, detail="Documento no encontrado")
+        passages = [{"position": 0, "start": 0, "end": len(text), "text": text}]
+    return passages
+
+def _passage_offsets(passages: list) -> list:
+    return [{"position": p["position"], "start": p["start"], "end": p["end"]} for p in passages]
+
+def _ndjson(event: dict) -> bytes:
+    return (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _ndjson_stream(head, chunks=None, tail=None, notice: dict = None):
+    """
+    Respuesta NDJSON: un evento inicial, un evento "delta" por cada trozo de texto
+    del modelo y uno final "done" (con `tail(texto_completo)` si se indica) o "error".
+    Sin `chunks`, `head` es una corrutina que retorna (evento inicial, trozos) y se
+    espera ya dentro de la respuesta, después de enviar el evento `notice`.
+    """
+    async def events():
+        nonlocal head, chunks
+        if notice is not None:
+            yield _ndjson(notice)
+        parts = []
+        try:
+            if chunks is None:
+                head, chunks = await head
+            yield _ndjson(head)
+            async for text in chunks:
+                parts.append(text)
+                yield _ndjson({"type": "delta", "text": text})
+            done = {"type": "done"}
+            if tail is not None:
+                done.update(await run_blocking(tail, "".join(parts)))
+            yield _ndjson(done)
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            print(f"❌ Error en la respuesta por streaming: {detail}")
+            yield _ndjson({"type": "error", "detail": detail})
+
+    # X-Accel-Buffering: que un proxy intermedio no retenga los trozos
+    return StreamingResponse(events(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
 @app.post("/chat_document")
 async def chat_document(payload: dict = Body(...)):
     gemini_service, _, _ = get_services()
     try:
-        doc_id = payload.get("doc_id")
-        query = payload.get("query")
-        
-        if not doc_id or not query:
-             raise HTTPException(status_code=400, detail="Faltan parámetros doc_id o query")
-             
-        # Leer texto del documento
-        txt_path = f"data/uploads/{doc_id}.txt"
-        if not os.path.exists(txt_path):
-             raise HTTPException(status_code=404, detail="Documento no encontrado")
-             
-        with open(txt_path, "r", encoding="utf-8") as f:
-            context_text = f.read()
+        doc_id, query, _ = await _chat_request(payload)
+        # Documento del nivel rápido: la transcripción completa se hace ahora
+        await _try_full_text(doc_id)
+        passages = await _chat_passages(doc_id, query)
             
         # Llamar a Gemini
-        answer = gemini_service.chat_with_document(context_text, query)
-        return {"answer": answer}
+        answer = await run_blocking(gemini_service.chat_with_document, passages, query)
+        return {"answer": answer, "passages": _passage_offsets(passages)}
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/chat_document/stream")
+async def chat_document_stream(payload: dict = Body(...)):
+    """
+    Variante por streaming (NDJSON) de /chat_document: primero los pasajes usados,
+    después la respuesta por trozos a medida que Gemini la genera. Un documento del
+    nivel rápido empieza con un evento "transcribing" mientras se transcribe completo.
+    """
+    gemini_service, _, _ = get_services()
+    try:
+        doc_id, query, meta = await _chat_request(payload)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    async def start():
+        # La transcripción se espera con la respuesta ya iniciada
+        await _try_full_text(doc_id)
+        passages = await _chat_passages(doc_id, query)
+        chunks = iterate_blocking(gemini_service.stream_chat_with_document, passages, query)
+        return {"type": "passages", "passages": _passage_offsets(passages)}, chunks
+
+    notice = {"type": "transcribing"} if meta.get("tier") == TIER_QUICK else None
+    return _ndjson_stream(start(), notice=notice)
+
+def _audio_response(key: str, audio: bytes = None) -> Response:
+    headers = {"ETag": f'"{key}"', "Cache-Control": AUDIO_CACHE_CONTROL, "X-Audio-Key": key}
+    if audio is None:
+        return Response(status_code=304, headers=headers)
+    return Response(content=audio, media_type="audio/mpeg", headers=headers)
+
 @app.post("/generate_audio")
 async def generate_audio(payload: dict = Body(...)):
-    try:
-        text = payload.get("text")
-        if not text:
-             raise HTTPException(status_code=400, detail="Falta texto")
-        
-        # Generar Audio
-        # Truncar si es muy largo para TTS rápido (max 500 chars para demo rápida)
-        # O dejarlo todo si se quiere leer el resumen completo.
-        # Usaremos el resumen completo.
-        
-        tts = gTTS(text=text, lang='es')
-        audio_filename = f"audio_{uuid.uuid4()}.mp3"
-        audio_path = f"data/uploads/{audio_filename}"
-        tts.save(audio_path)
-        
-        # Deberíamos servir el archivo estático o devolverlo como FileResponse
-        # Para simplificar, devolveremos la URL local relativa si Streamlit pudiera leerla
-        # Pero como backend y frontend están separados en ejecución, mejor devolver el path 
-        # y que streamlit lo lea si comparte FS, o devolver el archivo binario.
-        
-        # Vamos a devolver la ruta, asumiendo que Streamlit corre localmente y tiene acceso a "data/uploads"
-        return {"audio_path": audio_path} 
+    """
+    Devuelve en el cuerpo de la respuesta el MP3 del texto, sintetizado solo si no está
+    en caché. La cabecera Content-Location apunta a GET /audio/{clave}, el recurso
+    cacheable del mismo audio (ETag = clave, 304 con If-None-Match).
+    """
+    text = payload.get("text")
+    lang = payload.get("lang", "es")
+    if not text:
+        raise HTTPException(status_code=400, detail="Falta texto")
 
+    try:
+        key, audio = await run_blocking(tts_service.synthesize, text, lang)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    response = _audio_response(key, audio)
+    response.headers["Content-Location"] = f"/audio/{key}"
+    return response
+
+@app.get("/audio/{key}")
+async def get_audio(key: str, request: Request):
+    if request.headers.get("if-none-match") == f'"{key}"':
+        return _audio_response(key)
+    audio = await run_blocking(tts_service.read, key) if re.fullmatch(r"[0-9a-f]{64}", key) else None
+    if audio is None:
+        raise HTTPException(status_code=404, detail="Audio no encontrado")
+    return _audio_response(key, audio)
+
+async def _compare_docs(payload: dict) -> list:
+    """
+    Resuelve los documentos a comparar (por ID o nombre) y carga su texto.
+    """
+    _, _, vector_store = get_services()
+    doc_ids = payload.get("doc_ids") # Lista de IDs o Filenames
+    if not doc_ids or len(doc_ids) < 2:
+         raise HTTPException(status_code=400, detail="Se requieren al menos 2 documentos para comparar.")
 
+    # Transcripción completa (en paralelo) de los documentos que solo tienen el nivel rápido
+    await asyncio.gather(*(_try_full_text(doc_identifier) for doc_identifier in doc_ids))
+         
+    docs_data = []
+    for doc_identifier in doc_ids:
+        # Intentar encontrar archivo .txt
+        # Asumimos que doc_identifier puede ser ID o Filename. 
+        # Si es filename, necesitamos buscar su ID o asumir que filename == ID si usamos backend simple.
+        # En v1, usabamos ID. Pero frontend a veces tiene solo filename.
+        # Vamos a buscar el .txt directamente si existe
+        
+        # Caso ideal: Es el ID directo
+        doc_id = doc_identifier
+        text = await run_blocking(text_cache.get, doc_identifier)
+        
+        # Caso 2: Es filename, buscar en metadatos (consulta indexada por nombre)
+        if text is None:
+             d = await run_blocking(vector_store.find_by_filename, doc_identifier)
+             if not d:
+                 continue # Skip si no se encuentra
+             doc_id = d['id']
+             text = await run_blocking(text_cache.get, doc_id)
+             doc_identifier = d['filename'] # Usar nombre real para display
+        
+        if text is not None:
+            # El id identifica los hechos ya extraídos del documento (caché del paso map)
+            docs_data.append({"id": doc_id, "name": doc_identifier, "text": text})
 
+    if len(docs_data) < 2:
+         raise HTTPException(status_code=400, detail="No se encontraron suficientes textos válidos para comparar.")
+    return docs_data
 
 @app.post("/compare")
 async def compare_documents(payload: dict = Body(...)):
-    gemini_service, _, vector_store = get_services()
+    gemini_service, _, _ = get_services()
     try:
-        doc_ids = payload.get("doc_ids") # Lista de IDs o Filenames
-        if not doc_ids or len(doc_ids) < 2:
-             raise HTTPException(status_code=400, detail="Se requieren al menos 2 documentos para comparar.")
-             
-        docs_data = []
-        for doc_identifier in doc_ids:
-            # Intentar encontrar archivo .txt
-            # Asumimos que doc_identifier puede ser ID o Filename. 
-            # Si es filename, necesitamos buscar su ID o asumir que filename == ID si usamos backend simple.
-            # En v1, usabamos ID. Pero frontend a veces tiene solo filename.
-            # Vamos a buscar el .txt directamente si existe
-            
-            # Caso ideal: Es el ID directo
-            txt_path = f"data/uploads/{doc_identifier}.txt"
-            
-            # Caso 2: Es filename, buscar en metadatos (lento pero seguro)
-            if not os.path.exists(txt_path):
-                 # Lookup simple
-                 found = False
-                 all_docs = vector_store.list_documents()
-                 for d in all_docs:
-                     if d['filename'] == doc_identifier:
-                         txt_path = f"data/uploads/{d['id']}.txt"
-                         doc_identifier = d['filename'] # Usar nombre real para display
-                         found = True
-                         break
-                 if not found:
-                     continue # Skip si no se encuentra
-            
-            if os.path.exists(txt_path):
-                with open(txt_path, "r", encoding="utf-8") as f:
-                    text = f.read()
-                    docs_data.append({"name": doc_identifier, "text": text})
-
-        if len(docs_data) < 2:
-             raise HTTPException(status_code=400, detail="No se encontraron suficientes textos válidos para comparar.")
+        docs_data = await _compare_docs(payload)
 
         # Llamar a Gemini
-        comparison_data = gemini_service.compare_documents(docs_data)
+        comparison_data = await run_blocking(gemini_service.compare_documents, docs_data)
         return {"comparison": comparison_data}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/export_comparison_excel")
-async def export_comparison_excel(payload: dict = Body(...)):
+@app.post("/compare/stream")
+async def compare_documents_stream(payload: dict = Body(...)):
+    """
+    Variante por streaming (NDJSON) de /compare: el JSON de la comparación llega
+    por trozos y el evento final trae la comparación ya interpretada.
+    """
+    gemini_service, _, _ = get_services()
     try:
-        data = payload.get("comparison_table")
-        if not data:
-            raise HTTPException(status_code=400, detail="No hay datos para exportar")
-            
-        import pandas as pd
-        
-        # Crear DataFrame
-        df = pd.DataFrame(data)
-        
-        # Guardar Excel
-        filename = f"comparacion_{uuid.uuid4()}.xlsx"
-        file_path = f"data/uploads/{filename}"
-        
-        # Guardar usando openpyxl engine
-        df.to_excel(file_path, index=False, engine='openpyxl')
-        
-        return {"excel_path": file_path}
-        
+        docs_data = await _compare_docs(payload)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error Exporting Excel: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    chunks = iterate_blocking(gemini_service.stream_compare_documents, docs_data)
+    tail = lambda text: {"comparison": gemini_service.parse_comparison(text)}
+    return _ndjson_stream({"type": "documents", "documents": [d["name"] for d in docs_data]}, chunks, tail)
+
+def _xlsx_response(filename: str, chunks) -> StreamingResponse:
+    return StreamingResponse(chunks, media_type=XLSX_MIME_TYPE,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.post("/export_comparison_excel")
+async def export_comparison_excel(payload: dict = Body(...)):
+    """
+    Tabla comparativa como .xlsx, generada por trozos directamente en la respuesta.
+    """
+    data = payload.get("comparison_table")
+    if not data:
+        raise HTTPException(status_code=400, detail="No hay datos para exportar")
+    headers, rows = table_rows(data)
+    return _xlsx_response("comparacion.xlsx", iterate_blocking(xlsx_stream, "Comparación", headers, rows))
+
+@app.get("/documents/export")
+async def export_documents():
+    """
+    Lista de todos los documentos (nombre, categoría, confianza, nivel y resumen) como .xlsx;
+    los documentos se leen por páginas a medida que se escribe la respuesta.
+    """
+    _, _, vector_store = get_services()
+    headers = ["ID", "Archivo", "Categoría", "Confianza", "Nivel", "Resumen"]
+    rows = (
+        [doc["id"], doc["filename"], doc.get("category"), doc.get("category_score"), doc.get("tier"), doc.get("summary")]
+        for doc in vector_store.iter_documents()
+    )
+    return _xlsx_response("documentos.xlsx", iterate_blocking(xlsx_stream, "Documentos", headers, rows))
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
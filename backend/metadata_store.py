@@ -0,0 +1,411 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# Columnas con índice propio; cualquier otro campo de metadatos va en `extra` (JSON)
+COLUMNS = ("id", "filename", "path", "category", "category_score", "summary", "content_hash", "deleted", "tier")
+# Niveles del análisis: "quick" = categoría y resumen (transcripción completa pendiente), "full" = completo
+TIER_QUICK = "quick"
+TIER_FULL = "full"
+# Pesos BM25 por campo del índice de texto: nombre de archivo, resumen, texto extraído
+KEYWORD_WEIGHTS = (3.0, 2.0, 1.0)
+
+class MetadataStore:
+    """
+    Metadatos de documentos en SQLite, con índices por id, nombre de archivo,
+    hash de contenido, categoría y fila del índice FAISS (mapeo fila -> documento explícito).
+    La "fila" es el id estable del vector en FAISS: no cambia al borrar ni al compactar.
+    Cada documento tiene uno o más pasajes en la tabla `vectors` (fila, offsets, texto
+    y vector); documents.vector_row es la fila de su primer pasaje.
+    La búsqueda por palabras clave usa un índice invertido FTS5 (BM25) sobre nombre,
+    resumen y texto extraído, sin distinguir tildes ni mayúsculas.
+    documents.missing marca los documentos cuyo archivo falta en disco (lo mantiene
+    VectorStore.reconcile); listados y búsquedas los excluyen sin tocar el disco.
+    documents.tier indica el nivel del análisis completado (TIER_QUICK o TIER_FULL).
+    """
+    def __init__(self, path="data/metadata.sqlite3"):
+        self.path = path
+        self._lock = threading.RLock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        fts_exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'documents_fts'"
+        ).fetchone() is not None
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id TEXT PRIMARY KEY,
+                vector_row INTEGER NOT NULL UNIQUE,
+                filename TEXT NOT NULL,
+                path TEXT,
+                category TEXT,
+                category_score REAL,
+                summary TEXT,
+                content_hash TEXT,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                extra TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_documents_filename ON documents(filename);
+            CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents(content_hash);
+            CREATE INDEX IF NOT EXISTS idx_documents_category ON documents(category);
+            -- Pasajes por fila FAISS (pasaje -> documento): fuente para entrenar y reconstruir índices
+            CREATE TABLE IF NOT EXISTS vectors (
+                vector_row INTEGER PRIMARY KEY,
+                doc_id TEXT NOT NULL,
+                vector BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_vectors_doc_id ON vectors(doc_id);
+            -- Índice invertido; rowid = documents.rowid. unicode61 con remove_diacritics
+            -- pliega tildes y mayúsculas ("Camión" = "camion")
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                filename, summary, body, tokenize = 'unicode61 remove_diacritics 2'
+            );
+        """)
+        if not fts_exists:
+            # Bases anteriores: indexar nombre y resumen (el texto completo entra con /reindex)
+            self._conn.execute(
+                "INSERT INTO documents_fts (rowid, filename, summary, body) "
+                "SELECT rowid, filename, COALESCE(summary, ''), '' FROM documents WHERE deleted = 0"
+            )
+        existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(documents)")}
+        if "missing" not in existing:
+            self._conn.execute("ALTER TABLE documents ADD COLUMN missing INTEGER NOT NULL DEFAULT 0")
+        if "tier" not in existing:
+            self._conn.execute(f"ALTER TABLE documents ADD COLUMN tier TEXT NOT NULL DEFAULT '{TIER_FULL}'")
+        # Columnas de pasaje (bases creadas con un vector por documento no las tienen)
+        existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(vectors)")}
+        for column, decl in (("position", "INTEGER NOT NULL DEFAULT 0"), ("start_char", "INTEGER"),
+                             ("end_char", "INTEGER"), ("text", "TEXT")):
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE vectors ADD COLUMN {column} {decl}")
+        self._conn.commit()
+
+    def _to_row(self, meta: dict, vector_row: int) -> tuple:
+        extra = {k: v for k, v in meta.items() if k not in COLUMNS}
+        return (
+            meta["id"], vector_row, meta.get("filename", ""), meta.get("path"),
+            meta.get("category"), meta.get("category_score"), meta.get("summary"),
+            meta.get("content_hash"), 1 if meta.get("deleted") else 0, meta.get("tier") or TIER_FULL, time.time(),
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+        )
+
+    def _to_meta(self, row: sqlite3.Row) -> dict:
+        meta = {
+            "id": row["id"],
+            "filename": row["filename"],
+            "path": row["path"],
+            "category": row["category"],
+            "category_score": row["category_score"] or 0.0,
+            "summary": row["summary"],
+            "content_hash": row["content_hash"],
+            "deleted": bool(row["deleted"]),
+            "tier": row["tier"],
+        }
+        if row["extra"]:
+            meta.update(json.loads(row["extra"]))
+        return meta
+
+    def add(self, meta: dict, vector_row: int, passages: list = None, text: str = ""):
+        """
+        Inserta un documento, sus pasajes (filas vector_row, vector_row + 1, ...) y su
+        texto en el índice de palabras clave. Ignora ids ya existentes
+        (la reproducción del log es idempotente).
+        """
+        self.add_many([(meta, vector_row, passages, text)])
+
+    def add_many(self, items: list):
+        """
+        items: lista de (metadatos, fila FAISS del primer pasaje, pasajes o None, texto).
+        Cada pasaje es {"vector", "start", "end", "text"}.
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO documents "
+                "(id, vector_row, filename, path, category, category_score, summary, content_hash, deleted, tier, created_at, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [self._to_row(meta, vector_row) for meta, vector_row, _, _ in items]
+            )
+            self._insert_passages([
+                (meta["id"], vector_row, passages) for meta, vector_row, passages, _ in items if passages
+            ])
+            self._conn.executemany(
+                "INSERT INTO documents_fts (rowid, filename, summary, body) "
+                "SELECT d.rowid, d.filename, COALESCE(d.summary, ''), ? FROM documents d "
+                "WHERE d.id = ? AND d.deleted = 0 AND NOT EXISTS (SELECT 1 FROM documents_fts f WHERE f.rowid = d.rowid)",
+                [(text or "", meta["id"]) for meta, _, _, text in items]
+            )
+            self._conn.commit()
+
+    def set_texts(self, texts_by_id: dict):
+        """
+        Reemplaza el texto indexado por palabras clave de cada documento ({doc_id: texto}).
+        """
+        with self._lock:
+            for doc_id, text in texts_by_id.items():
+                self._conn.execute(
+                    "DELETE FROM documents_fts WHERE rowid = (SELECT rowid FROM documents WHERE id = ?)", (doc_id,)
+                )
+                self._conn.execute(
+                    "INSERT INTO documents_fts (rowid, filename, summary, body) "
+                    "SELECT rowid, filename, COALESCE(summary, ''), ? FROM documents WHERE id = ? AND deleted = 0",
+                    (text or "", doc_id)
+                )
+            self._conn.commit()
+
+    def _insert_passages(self, items: list):
+        # Llamar con self._lock tomado
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO vectors (vector_row, doc_id, vector, position, start_char, end_char, text) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(first_row + i, doc_id, np.asarray(p["vector"], dtype=np.float32).tobytes(),
+              i, p.get("start"), p.get("end"), p.get("text"))
+             for doc_id, first_row, passages in items for i, p in enumerate(passages)]
+        )
+
+    def replace_passages(self, passages_by_id: dict):
+        """
+        Reemplaza los pasajes de cada documento: {doc_id: (fila del primer pasaje, pasajes)}.
+        """
+        with self._lock:
+            for doc_id, (first_row, _) in passages_by_id.items():
+                self._conn.execute("DELETE FROM vectors WHERE doc_id = ?", (doc_id,))
+                self._conn.execute("UPDATE documents SET vector_row = ? WHERE id = ?", (first_row, doc_id))
+            self._insert_passages([(doc_id, first_row, passages) for doc_id, (first_row, passages) in passages_by_id.items()])
+            self._conn.commit()
+
+    def put_vectors(self, vectors_by_row: dict):
+        """
+        Reemplaza los vectores guardados {fila FAISS: vector} (reindexado, migración).
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors (vector_row, doc_id, vector) "
+                "SELECT ?, id, ? FROM documents WHERE vector_row = ?",
+                [(row, np.asarray(vec, dtype=np.float32).tobytes(), row) for row, vec in vectors_by_row.items()]
+            )
+            self._conn.commit()
+
+    def live_vectors(self, dimension: int, min_row: int = 0, rows: list = None):
+        """
+        Vectores de los pasajes de documentos activos con fila >= min_row
+        (o solo de las filas dadas). Retorna (filas int64, matriz float32), ordenados por fila.
+        """
+        sql = ("SELECT v.vector_row, v.vector FROM vectors v JOIN documents d ON d.id = v.doc_id "
+               "WHERE d.deleted = 0 AND v.vector_row >= ?")
+        found = []
+        if rows is None:
+            found = self._query(sql + " ORDER BY v.vector_row", (min_row,))
+        else:
+            rows = [int(r) for r in rows]
+            for i in range(0, len(rows), 500):
+                chunk = rows[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                found += self._query(sql + f" AND v.vector_row IN ({placeholders})", [min_row] + chunk)
+            found.sort(key=lambda r: r[0])
+        ids = np.array([row for row, _ in found], dtype=np.int64)
+        matrix = np.zeros((len(found), dimension), dtype=np.float32)
+        for i, (_, blob) in enumerate(found):
+            matrix[i] = np.frombuffer(blob, dtype=np.float32)
+        return ids, matrix
+
+    def live_rows(self) -> np.ndarray:
+        """
+        Filas FAISS de todos los pasajes de documentos activos.
+        """
+        rows = self._query(
+            "SELECT v.vector_row FROM vectors v JOIN documents d ON d.id = v.doc_id WHERE d.deleted = 0"
+        )
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    def doc_rows(self, doc_id: str) -> list:
+        return [row[0] for row in self._query("SELECT vector_row FROM vectors WHERE doc_id = ?", (doc_id,))]
+
+    def passages_by_rows(self, vector_rows: list) -> dict:
+        """
+        Retorna {fila FAISS: pasaje} para los pasajes de documentos activos (y con archivo) en esas filas.
+        Pasaje: {"doc_id", "position", "start", "end", "text"}.
+        """
+        result = {}
+        vector_rows = [int(r) for r in vector_rows]
+        for i in range(0, len(vector_rows), 500):
+            chunk = vector_rows[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in self._query(
+                "SELECT v.vector_row, v.doc_id, v.position, v.start_char, v.end_char, v.text "
+                f"FROM vectors v JOIN documents d ON d.id = v.doc_id WHERE v.vector_row IN ({placeholders}) "
+                "AND d.deleted = 0 AND d.missing = 0",
+                chunk
+            ):
+                result[row["vector_row"]] = {
+                    "doc_id": row["doc_id"], "position": row["position"],
+                    "start": row["start_char"], "end": row["end_char"], "text": row["text"],
+                }
+        return result
+
+    def passages_for_doc(self, doc_id: str, with_vectors: bool = False) -> list:
+        """
+        Pasajes de un documento en orden; con with_vectors incluye su embedding ("vector").
+        """
+        rows = self._query(
+            "SELECT vector_row, position, start_char, end_char, text, vector FROM vectors "
+            "WHERE doc_id = ? ORDER BY position",
+            (doc_id,)
+        )
+        passages = []
+        for row in rows:
+            passage = {"row": row["vector_row"], "position": row["position"], "start": row["start_char"],
+                       "end": row["end_char"], "text": row["text"]}
+            if with_vectors:
+                passage["vector"] = np.frombuffer(row["vector"], dtype=np.float32)
+            passages.append(passage)
+        return passages
+
+    def next_vector_row(self) -> int:
+        """
+        Siguiente fila FAISS libre (última fila asignada + 1).
+        """
+        return self._query(
+            "SELECT MAX(COALESCE((SELECT MAX(vector_row) FROM documents), -1), "
+            "COALESCE((SELECT MAX(vector_row) FROM vectors), -1)) + 1"
+        )[0][0]
+
+    def stored_vector_count(self) -> int:
+        return self._query("SELECT COUNT(*) FROM vectors")[0][0]
+
+    def _query(self, sql: str, params=()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get(self, doc_id: str):
+        rows = self._query("SELECT * FROM documents WHERE id = ? AND deleted = 0", (doc_id,))
+        return self._to_meta(rows[0]) if rows else None
+
+    def find_by_filename(self, filename: str):
+        rows = self._query("SELECT * FROM documents WHERE filename = ? AND deleted = 0 LIMIT 1", (filename,))
+        return self._to_meta(rows[0]) if rows else None
+
+    def find_by_hash(self, content_hash: str):
+        rows = self._query("SELECT * FROM documents WHERE content_hash = ? AND deleted = 0 LIMIT 1", (content_hash,))
+        return self._to_meta(rows[0]) if rows else None
+
+    def get_many(self, doc_ids: list) -> dict:
+        """
+        Retorna {doc_id: metadatos} para los documentos activos con esos ids
+        (sin los que tienen el archivo faltante).
+        """
+        result = {}
+        doc_ids = list(doc_ids)
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in self._query(
+                f"SELECT * FROM documents WHERE id IN ({placeholders}) AND deleted = 0 AND missing = 0", chunk
+            ):
+                result[row["id"]] = self._to_meta(row)
+        return result
+
+    def keyword_search(self, query: str, limit: int = 20) -> list:
+        """
+        Búsqueda BM25 en el índice invertido (cualquiera de los términos de la consulta).
+        Retorna [(doc_id, puntuación)] de mayor a menor relevancia.
+        """
+        terms = re.findall(r"\w+", query)
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        rows = self._query(
+            "SELECT d.id, bm25(documents_fts, ?, ?, ?) AS rank FROM documents_fts "
+            "JOIN documents d ON d.rowid = documents_fts.rowid "
+            "WHERE documents_fts MATCH ? AND d.deleted = 0 AND d.missing = 0 ORDER BY rank LIMIT ?",
+            (*KEYWORD_WEIGHTS, match, limit)
+        )
+        # bm25() de FTS5 es negativo: más negativo = más relevante
+        return [(row["id"], -row["rank"]) for row in rows]
+
+    def list_active(self) -> list:
+        rows = self._query("SELECT * FROM documents WHERE deleted = 0 AND missing = 0 ORDER BY vector_row")
+        return [self._to_meta(row) for row in rows]
+
+    def iter_active(self, batch_size: int = 500):
+        """
+        Recorre los documentos activos por páginas (orden de alta), sin cargarlos todos en memoria.
+        """
+        last = 0
+        while True:
+            rows = self._query(
+                "SELECT rowid, * FROM documents WHERE deleted = 0 AND missing = 0 AND rowid > ? ORDER BY rowid LIMIT ?",
+                (last, batch_size)
+            )
+            for row in rows:
+                yield self._to_meta(row)
+            if len(rows) < batch_size:
+                return
+            last = rows[-1]["rowid"]
+
+    def paths(self) -> list:
+        """
+        [(doc_id, ruta, missing)] de los documentos activos, para reconciliar con el disco.
+        """
+        rows = self._query("SELECT id, path, missing FROM documents WHERE deleted = 0")
+        return [(row["id"], row["path"], bool(row["missing"])) for row in rows]
+
+    def set_missing(self, doc_ids: list, missing: bool):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE documents SET missing = ? WHERE id = ?", [(1 if missing else 0, doc_id) for doc_id in doc_ids]
+            )
+            self._conn.commit()
+
+    def set_tier(self, doc_id: str, tier: str):
+        with self._lock:
+            self._conn.execute("UPDATE documents SET tier = ? WHERE id = ?", (tier, doc_id))
+            self._conn.commit()
+
+    def missing_ids(self) -> list:
+        return [row[0] for row in self._query("SELECT id FROM documents WHERE deleted = 0 AND missing = 1")]
+
+    def mark_deleted(self, doc_id: str) -> bool:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM documents_fts WHERE rowid = (SELECT rowid FROM documents WHERE id = ? AND deleted = 0)",
+                (doc_id,)
+            )
+            cursor = self._conn.execute(
+                "UPDATE documents SET deleted = 1 WHERE id = ? AND deleted = 0", (doc_id,)
+            )
+            self._conn.commit()
+            return cursor.rowcount > 0
+
+    def purge_deleted(self) -> int:
+        """
+        Elimina definitivamente los documentos marcados como borrados y sus vectores.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM vectors WHERE doc_id IN (SELECT id FROM documents WHERE deleted = 1)")
+            cursor = self._conn.execute("DELETE FROM documents WHERE deleted = 1")
+            self._conn.commit()
+            return cursor.rowcount
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM documents")
+            self._conn.execute("DELETE FROM vectors")
+            self._conn.execute("DELETE FROM documents_fts")
+            self._conn.commit()
+
+    def count(self, include_deleted: bool = False) -> int:
+        sql = "SELECT COUNT(*) FROM documents" + ("" if include_deleted else " WHERE deleted = 0")
+        return self._query(sql)[0][0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,217 @@
+import contextvars
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from google.api_core import exceptions as google_exceptions
+
+# Peticiones por minuto por modelo ("modelo:rpm,modelo:rpm"); el resto usa GEMINI_DEFAULT_RPM
+GEMINI_RATE_LIMITS = os.getenv("GEMINI_RATE_LIMITS", "gemini-2.5-flash:60,text-embedding-004:1500,files:60")
+GEMINI_DEFAULT_RPM = float(os.getenv("GEMINI_DEFAULT_RPM", "60"))
+# Llamadas a Gemini en curso a la vez en todo el proceso
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+# Reintentos de una llamada rechazada por límite de tasa (429)
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+# AIMD: el ritmo se reduce a la mitad con cada 429 y recupera este % del máximo por éxito
+RATE_DECREASE_FACTOR = 0.5
+RATE_RECOVERY_STEP = 0.05
+# Ritmo mínimo (fracción del máximo) al que puede bajar un modelo
+RATE_MIN_FRACTION = 0.05
+# Espera tras un 429 sin indicación del servidor
+DEFAULT_RETRY_AFTER = 2.0
+
+# Prioridades: el tráfico interactivo (búsqueda, chat) pasa antes que la ingesta
+INTERACTIVE = 0
+BULK = 1
+# Prioridad de las llamadas del contexto actual (la ingesta la fija a BULK)
+call_priority = contextvars.ContextVar("gemini_call_priority", default=INTERACTIVE)
+
+def _model_key(model: str) -> str:
+    return model.split("/")[-1]
+
+def _parse_limits(spec: str) -> dict:
+    limits = {}
+    for item in spec.split(","):
+        if ":" in item:
+            model, rpm = item.rsplit(":", 1)
+            limits[_model_key(model.strip())] = float(rpm)
+    return limits
+
+def is_rate_limited(exc: Exception) -> bool:
+    return isinstance(exc, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)) \
+        or "429" in str(exc)
+
+def retry_after(exc: Exception):
+    """
+    Segundos de espera que sugiere el servidor en un 429 (RetryInfo, cabecera
+    Retry-After o "retry in Ns" en el mensaje), o None.
+    """
+    for detail in getattr(exc, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    response = getattr(exc, "response", None)
+    header = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    match = re.search(r"retry in ([\d.]+)\s*s", str(exc), re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+class _Bucket:
+    """
+    Token bucket de un modelo con ritmo adaptativo (AIMD).
+    """
+    def __init__(self, rpm: float):
+        self.max_rate = rpm / 60.0
+        self.rate = self.max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.calls = 0
+        self.throttled = 0
+
+    def refill(self, now: float):
+        # Ráfaga de hasta 1 segundo de ritmo (al menos una petición)
+        capacity = max(1.0, self.rate)
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """
+    Limitador global de las llamadas a Gemini: un token bucket por modelo y un tope
+    de llamadas simultáneas. Ante un 429 el ritmo del modelo baja a la mitad y se
+    respeta la espera que indique el servidor; cada éxito lo recupera poco a poco.
+    Mientras haya llamadas interactivas esperando, las de ingesta no avanzan, y
+    la ingesta nunca ocupa el último hueco de concurrencia.
+    """
+    def __init__(self, limits: dict = None, default_rpm=GEMINI_DEFAULT_RPM,
+                 max_concurrency=GEMINI_MAX_CONCURRENCY, max_retries=GEMINI_MAX_RETRIES):
+        self.limits = _parse_limits(GEMINI_RATE_LIMITS) if limits is None else limits
+        self.default_rpm = default_rpm
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.active = 0
+        self.waiting = {INTERACTIVE: 0, BULK: 0}
+        self._buckets = {}
+        self._cond = threading.Condition()
+
+    def _bucket(self, model: str) -> _Bucket:
+        key = _model_key(model)
+        if key not in self._buckets:
+            self._buckets[key] = _Bucket(self.limits.get(key, self.default_rpm))
+        return self._buckets[key]
+
+    def acquire(self, model: str, priority: int = None):
+        """
+        Bloquea hasta que haya un token del modelo y un hueco de concurrencia.
+        """
+        priority = call_priority.get() if priority is None else priority
+        with self._cond:
+            bucket = self._bucket(model)
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    bucket.refill(now)
+                    wait = bucket.wait_time(now)
+                    if priority == BULK:
+                        slots = max(1, self.max_concurrency - 1)
+                        yields = self.waiting[INTERACTIVE] > 0
+                    else:
+                        slots, yields = self.max_concurrency, False
+                    if not yields and self.active < slots and wait == 0:
+                        bucket.tokens -= 1
+                        bucket.calls += 1
+                        self.active += 1
+                        return
+                    # Los huecos y la cola de prioridad se notifican; el ritmo, por tiempo
+                    self._cond.wait(wait if wait > 0 else None)
+            finally:
+                self.waiting[priority] -= 1
+                if priority == INTERACTIVE and not self.waiting[INTERACTIVE]:
+                    # La ingesta que cedía el paso puede continuar
+                    self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, model: str, priority: int = None):
+        """
+        Ocupa un turno del modelo durante el bloque (p. ej. mientras dura un streaming).
+        Un 429 dentro del bloque ajusta el ritmo del modelo antes de propagarse.
+        """
+        self.acquire(model, priority)
+        try:
+            yield
+        except Exception as e:
+            if is_rate_limited(e):
+                self.throttled(model, retry_after(e))
+            raise
+        else:
+            self.succeeded(model)
+        finally:
+            self.release()
+
+    def call(self, model: str, func, /, *args, **kwargs):
+        """
+        Ejecuta func(*args, **kwargs) con turno del modelo, reintentando los 429
+        (la espera sugerida por el servidor se aplica a todas las llamadas del modelo).
+        model y func son solo posicionales: kwargs puede llevar su propio model=
+        (p. ej. genai.embed_content).
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.slot(model):
+                    return func(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                print(f"Límite de Tasa (429) en {_model_key(model)}: reintento {attempt + 1}/{self.max_retries}.")
+
+    def throttled(self, model: str, delay: float = None):
+        with self._cond:
+            bucket = self._bucket(model)
+            bucket.throttled += 1
+            bucket.rate = max(bucket.max_rate * RATE_MIN_FRACTION, bucket.rate * RATE_DECREASE_FACTOR)
+            bucket.tokens = min(bucket.tokens, 0.0)
+            pause = delay if delay is not None else DEFAULT_RETRY_AFTER
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + pause)
+
+    def succeeded(self, model: str):
+        with self._cond:
+            bucket = self._bucket(model)
+            bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate * RATE_RECOVERY_STEP)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "active": self.active,
+                "max_concurrency": self.max_concurrency,
+                "waiting_interactive": self.waiting[INTERACTIVE],
+                "waiting_bulk": self.waiting[BULK],
+                "models": {
+                    key: {
+                        "rpm": round(bucket.rate * 60, 2),
+                        "max_rpm": round(bucket.max_rate * 60, 2),
+                        "calls": bucket.calls,
+                        "throttled": bucket.throttled,
+                    }
+                    for key, bucket in self._buckets.items()
+                },
+            }
+
+# Instancia compartida por todo el proceso
+limiter = RateLimiter()
@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+# Los módulos del backend se importan por nombre (como al ejecutar backend/main.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Todo lo que el backend guarda en data/ va a un directorio temporal
+os.chdir(tempfile.mkdtemp(prefix="backend-tests-"))
+
+# Sin red ni API KEY: modelo de Gemini y motor de voz locales, sin tareas periódicas
+os.environ.update({
+    "GEMINI_FAKE_MODEL": "1",
+    "GEMINI_FAKE_DELAY": "0.005",
+    "GEMINI_RATE_LIMITS": "gemini-2.5-flash:60000,text-embedding-004:60000,files:60000",
+    "TTS_BACKEND": "fake",
+    "RECONCILE_INTERVAL": "0",
+    "GEMINI_FILE_SWEEP_INTERVAL": "0",
+})
+
+class FakeEmbedder:
+    """
+    Embeddings deterministas sin red: bolsa de palabras con hash, normalizada.
+    """
+    cache = None
+    dimension = 768
+
+    def generate(self, text: str, task_type: str = "retrieval_document") -> np.ndarray:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in text.lower().split():
+            vector[hash(word) % self.dimension] += 1
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def generate_batch(self, texts: list, **kwargs):
+        vectors = np.array([self.generate(t) for t in texts], dtype=np.float32).reshape(len(texts), self.dimension)
+        return vectors, {}
+
+@pytest.fixture(scope="session")
+def backend():
+    """
+    Módulo main con servicios locales (modelo simulado, embeddings deterministas).
+    """
+    import main
+    from gemini_service import GeminiService
+    from vector_store import VectorStore
+
+    main.gemini_service = GeminiService(text_cache=main.text_cache)
+    main.embedder = FakeEmbedder()
+    main.vector_store = VectorStore()
+    return main
+
+@pytest.fixture(scope="session")
+def client(backend):
+    from fastapi.testclient import TestClient
+
+    with TestClient(backend.app) as test_client:
+        yield test_client
@@ -0,0 +1,94 @@
+import asyncio
+import io
+import time
+import types
+
+import google.generativeai as genai
+from PIL import Image
+
+import extractor
+from concurrency import BLOCKING_WORKERS, iterate_blocking, run_blocking
+
+# Latencia simulada de cada subida a Gemini (la llamada ocupa un hilo del pool bloqueante)
+UPLOAD_SECONDS = 0.5
+# Latencia máxima aceptable de /search mientras hay ingestas en curso
+MAX_SEARCH_SECONDS = 0.5
+
+def _scanned_pdf(pages: int, color: str) -> bytes:
+    image = io.BytesIO()
+    Image.new("RGB", (60, 80), color).save(image, "JPEG")
+    path = f"data/scanned-{color}.pdf"
+    extractor._write_test_pdf(path, [("image", image.getvalue(), 60, 80)] * pages)
+    with open(path, "rb") as f:
+        return f.read()
+
+def _slow_upload(path, mime_type=None):
+    time.sleep(UPLOAD_SECONDS)
+    return types.SimpleNamespace(name=f"files/{path}", state=types.SimpleNamespace(name="ACTIVE"),
+                                 expiration_time=None)
+
+def _wait_jobs(client, job_ids, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        jobs = [client.get(f"/jobs/{job_id}").json() for job_id in job_ids]
+        if all(job["status"] not in ("queued", "running") for job in jobs):
+            return jobs
+        time.sleep(0.1)
+    raise AssertionError("Las ingestas no terminaron a tiempo")
+
+def test_search_stays_responsive_while_analyses_are_in_flight(client, backend, monkeypatch):
+    monkeypatch.setattr(genai, "upload_file", _slow_upload)
+    monkeypatch.setattr(genai, "get_file", lambda name: _slow_upload(name))
+    # Análisis en una pasada de PDFs escaneados: OCR por fragmentos de 2 páginas
+    monkeypatch.setattr(backend, "ANALYSIS_TIERED", False)
+    monkeypatch.setattr(backend, "PDF_SHARD_PAGES", 2)
+
+    job_ids = []
+    for color in ("white", "gray"):
+        response = client.post("/analyze", files={"file": (f"{color}.pdf", _scanned_pdf(24, color), "application/pdf")})
+        job_ids.append(response.json()["job_id"])
+
+    deadline = time.monotonic() + 5
+    while not any(client.get(f"/jobs/{job_id}").json()["stage"] == "analyzing" for job_id in job_ids):
+        assert time.monotonic() < deadline, "Las ingestas no empezaron"
+        time.sleep(0.05)
+    time.sleep(UPLOAD_SECONDS / 2)
+
+    latencies = []
+    for i in range(5):
+        start = time.perf_counter()
+        response = client.get("/search", params={"query": f"consulta de prueba {i}"})
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200
+        assert response.headers["X-Cache"] == "MISS"
+
+    # Las búsquedas se midieron con las ingestas todavía en curso
+    assert any(client.get(f"/jobs/{job_id}").json()["status"] == "running" for job_id in job_ids)
+    assert max(latencies) < MAX_SEARCH_SECONDS, latencies
+
+    jobs = _wait_jobs(client, job_ids)
+    assert [job["status"] for job in jobs] == ["done", "done"]
+    assert jobs[0]["shards_total"] == 12
+
+def test_streams_do_not_take_the_blocking_pool():
+    def slow_chunks():
+        # Como una respuesta de Gemini por streaming: cada trozo tarda en llegar
+        for i in range(3):
+            time.sleep(0.3)
+            yield i
+
+    async def consume():
+        return [chunk async for chunk in iterate_blocking(slow_chunks)]
+
+    async def scenario():
+        streams = [asyncio.create_task(consume()) for _ in range(BLOCKING_WORKERS * 2)]
+        await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        await run_blocking(lambda: None)
+        latency = time.perf_counter() - start
+        results = await asyncio.gather(*streams)
+        return latency, results
+
+    latency, results = asyncio.run(scenario())
+    assert latency < 0.1
+    assert results == [[0, 1, 2]] * (BLOCKING_WORKERS * 2)
@@ -0,0 +1,26 @@
+import time
+
+import extractor
+
+def _text_pdf(name: str, lines: list) -> bytes:
+    path = f"data/{name}"
+    extractor._write_test_pdf(path, [("text", lines)])
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_job_result_reads_full_text_from_the_text_cache(client, backend, monkeypatch):
+    monkeypatch.setattr(backend, "ANALYSIS_TIERED", False)
+    lines = ["Contrato de mantenimiento de ascensores.", "Vigencia de 24 meses."]
+    response = client.post("/analyze", files={"file": ("ascensores.pdf", _text_pdf("ascensores.pdf", lines), "application/pdf")})
+    job_id = response.json()["job_id"]
+
+    deadline = time.monotonic() + 30
+    while (job := client.get(f"/jobs/{job_id}").json())["status"] in ("queued", "running"):
+        assert time.monotonic() < deadline, "La ingesta no terminó"
+        time.sleep(0.05)
+
+    assert job["status"] == "done"
+    assert "Vigencia de 24 meses." in job["result"]["full_text"]
+    # El gestor guarda (en memoria y en su diario) el resultado sin el texto completo
+    assert "full_text" not in backend.job_manager.get(job_id)["result"]
+    assert "full_text" not in next(j for j in client.get("/jobs").json() if j["id"] == job_id)["result"]
@@ -0,0 +1,66 @@
+import json
+import uuid
+
+import pytest
+
+from chunking import split_passages
+from metadata_store import TIER_FULL
+
+def _seed_document(backend, filename: str, text: str) -> str:
+    """
+    Documento ya analizado (nivel completo) con sus pasajes y su texto en disco.
+    """
+    doc_id = str(uuid.uuid4())
+    path = f"data/uploads/{doc_id}.txt"
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    backend.text_cache.write(doc_id, text)
+    passages = [dict(p, vector=backend.embedder.generate(p["text"])) for p in split_passages(text)]
+    backend.vector_store.add_document({
+        "id": doc_id, "filename": filename, "path": path, "mime_type": "text/plain",
+        "category": "Contrato", "category_score": 0.9, "summary": text[:100],
+        "tier": TIER_FULL, "deleted": False,
+    }, passages, text)
+    return doc_id
+
+@pytest.fixture(scope="module")
+def documents(backend):
+    return [
+        _seed_document(backend, "arriendo.pdf", "Contrato de arrendamiento por 12 meses con un canon de 900 euros."),
+        _seed_document(backend, "servicios.pdf", "Contrato de servicios de limpieza por 6 meses, pago mensual de 300 euros."),
+    ]
+
+def _read_ndjson(client, url: str, payload: dict) -> list:
+    with client.stream("POST", url, json=payload) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        return [json.loads(line) for line in response.iter_lines() if line]
+
+def test_chat_stream_relays_partial_chunks_then_done(client, documents):
+    events = _read_ndjson(client, "/chat_document/stream", {"doc_id": documents[0], "query": "¿Cuál es el canon?"})
+
+    assert events[0]["type"] == "passages"
+    assert events[0]["passages"] and {"position", "start", "end"} <= set(events[0]["passages"][0])
+    deltas = [e["text"] for e in events[1:-1]]
+    assert all(e["type"] == "delta" for e in events[1:-1])
+    # El modelo simulado responde de a tres palabras por trozo
+    assert len(deltas) > 1
+    assert "".join(deltas).startswith("**Respuesta simulada.**")
+    assert events[-1] == {"type": "done"}
+
+def test_compare_stream_ends_with_parsed_comparison(client, documents):
+    # El frontend compara por nombre de archivo
+    events = _read_ndjson(client, "/compare/stream", {"doc_ids": ["arriendo.pdf", "servicios.pdf"]})
+
+    assert events[0] == {"type": "documents", "documents": ["arriendo.pdf", "servicios.pdf"]}
+    deltas = [e["text"] for e in events[1:-1]]
+    assert len(deltas) > 1 and all(e["type"] == "delta" for e in events[1:-1])
+    done = events[-1]
+    assert done["type"] == "done"
+    # El evento final trae el JSON unido de los trozos ya interpretado
+    assert done["comparison"] == json.loads("".join(deltas))
+    assert done["comparison"]["comparison_table"]
+
+def test_chat_stream_unknown_document_is_404(client):
+    response = client.post("/chat_document/stream", json={"doc_id": "no-existe", "query": "hola"})
+    assert response.status_code == 404
@@ -0,0 +1,37 @@
+import builtins
+import mmap
+
+from cache import DocumentTextCache
+
+def test_rewrite_keeps_open_maps_readable(tmp_path):
+    texts = DocumentTextCache(str(tmp_path), mmap_min_bytes=1024)
+    texts.write("doc", "texto largo " * 1000)
+    # Mapa abierto por una lectura en curso (fuera del candado, como en _raw)
+    with open(texts.path("doc"), "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # La transcripción completa reemplaza el texto mientras se lee
+    texts.write("doc", "corto")
+    assert mapped[:11] == b"texto largo"
+    assert len(mapped[:]) == len("texto largo " * 1000)
+    mapped.close()
+    assert texts.get("doc") == "corto"
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_read_racing_a_write_does_not_cache_the_old_text(tmp_path, monkeypatch):
+    texts = DocumentTextCache(str(tmp_path))
+    texts.write("doc", "anterior")
+    texts.invalidate("doc")
+
+    real_open = builtins.open
+    def open_then_write(path, mode="r", *args, **kwargs):
+        f = real_open(path, mode, *args, **kwargs)
+        if str(path) == texts.path("doc") and "r" in mode:
+            # La escritura llega después de que la lectura abrió el archivo anterior
+            monkeypatch.setattr(builtins, "open", real_open)
+            texts.write("doc", "nuevo")
+        return f
+    monkeypatch.setattr(builtins, "open", open_then_write)
+
+    assert texts.get("doc") == "anterior"
+    assert texts.get("doc") == "nuevo"
@@ -0,0 +1,98 @@
+import asyncio
+import io
+import json
+import time
+import uuid
+
+from PIL import Image
+
+import extractor
+from metadata_store import TIER_QUICK
+
+def _seed_quick_document(backend, filename: str, lines: list, summary: str, legacy_text: str = None) -> str:
+    """
+    Documento del nivel rápido: solo el pasaje del resumen, sin transcripción completa.
+    legacy_text simula el .txt que escribían versiones anteriores.
+    """
+    doc_id = str(uuid.uuid4())
+    path = f"data/uploads/{doc_id}.pdf"
+    extractor._write_test_pdf(path, [("text", lines)])
+    if legacy_text is not None:
+        backend.text_cache.write(doc_id, legacy_text)
+    passages = [{"start": None, "end": None, "text": summary, "vector": backend.embedder.generate(summary)}]
+    backend.vector_store.add_document({
+        "id": doc_id, "filename": filename, "path": path, "mime_type": "application/pdf",
+        "category": "Contrato", "category_score": 0.9, "summary": summary,
+        "tier": TIER_QUICK, "deleted": False,
+    }, passages, "")
+    return doc_id
+
+def _passage_texts(backend, doc_id: str) -> list:
+    query = backend.embedder.generate("contrato")
+    return [p["text"] for p in backend.vector_store.search_document(doc_id, query, 10_000)]
+
+def test_reindex_keeps_the_summary_of_quick_documents(client, backend):
+    summary = "Resumen: contrato de vigilancia nocturna."
+    doc_id = _seed_quick_document(backend, "vigilancia.pdf", ["Contrato de vigilancia."], summary,
+                                  legacy_text=backend.PENDING_TEXT)
+
+    response = client.post("/reindex")
+
+    assert response.status_code == 200
+    assert doc_id not in [f["id"] for f in response.json()["failed"]]
+    assert _passage_texts(backend, doc_id) == [summary]
+
+def test_quick_ingestion_does_not_store_the_pending_notice(client, backend, monkeypatch):
+    monkeypatch.setattr(backend, "ANALYSIS_TIERED", True)
+    monkeypatch.setattr(backend, "TRANSCRIBE_IN_BACKGROUND", False)
+    image = io.BytesIO()
+    Image.new("RGB", (60, 80), "white").save(image, "JPEG")
+    extractor._write_test_pdf("data/escaneado.pdf", [("image", image.getvalue(), 60, 80)])
+    with open("data/escaneado.pdf", "rb") as f:
+        response = client.post("/analyze", files={"file": ("escaneado.pdf", f.read(), "application/pdf")})
+    job_id = response.json()["job_id"]
+
+    deadline = time.monotonic() + 30
+    while (job := client.get(f"/jobs/{job_id}").json())["status"] in ("queued", "running"):
+        assert time.monotonic() < deadline, "La ingesta no terminó"
+        time.sleep(0.05)
+
+    assert job["result"]["tier"] == TIER_QUICK
+    assert backend.text_cache.get(job["result"]["id"]) is None
+    assert _passage_texts(backend, job["result"]["id"]) == [job["result"]["summary"]]
+
+def test_document_text_waits_for_the_full_transcription(client, backend):
+    doc_id = _seed_quick_document(backend, "limpieza.pdf", ["Contrato de limpieza de oficinas.", "Pago trimestral."],
+                                  "Resumen: contrato de limpieza.")
+
+    response = client.get(f"/documents/{doc_id}/text")
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["tier"] == "full"
+    assert "Pago trimestral." in body["text"]
+    assert client.get("/documents/no-existe/text").status_code == 404
+
+def test_chat_stream_announces_the_transcription_before_waiting(backend, monkeypatch):
+    doc_id = _seed_quick_document(backend, "jardineria.pdf", ["Contrato de jardinería.", "Canon de 200 euros."],
+                                  "Resumen: contrato de jardinería.")
+    transcribe = backend._transcribe_document
+    async def slow_transcribe(*args, **kwargs):
+        await asyncio.sleep(1)
+        return await transcribe(*args, **kwargs)
+    monkeypatch.setattr(backend, "_transcribe_document", slow_transcribe)
+
+    async def read_stream():
+        response = await backend.chat_document_stream({"doc_id": doc_id, "query": "¿Cuál es el canon?"})
+        body = response.body_iterator
+        # El primer evento llega sin esperar a la transcripción
+        first = await asyncio.wait_for(body.__anext__(), 0.5)
+        return [json.loads(first)] + [json.loads(line) async for line in body]
+
+    events = asyncio.run(read_stream())
+
+    assert events[0] == {"type": "transcribing"}
+    assert events[1]["type"] == "passages"
+    # Pasajes del texto completo (el del resumen no tiene offsets)
+    assert events[1]["passages"][0]["start"] is not None
+    assert events[-1] == {"type": "done"}
@@ -0,0 +1,63 @@
+import uuid
+
+from tts import FakeTTSBackend, TTSService
+
+def test_generate_audio_caches_by_text_and_language(client, backend):
+    text = f"Resumen del documento {uuid.uuid4()}. Segunda frase del resumen."
+    before = backend.tts_service.stats()
+
+    first = client.post("/generate_audio", json={"text": text})
+    second = client.post("/generate_audio", json={"text": f"  {text}\n"})
+    other_lang = client.post("/generate_audio", json={"text": text, "lang": "en"})
+
+    after = backend.tts_service.stats()
+    assert first.status_code == second.status_code == other_lang.status_code == 200
+    assert first.headers["content-type"] == "audio/mpeg"
+    assert first.content[:2] == b"\xff\xfb"
+    # Mismo texto normalizado: acierto de caché con el mismo audio y la misma clave
+    assert second.content == first.content
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert other_lang.headers["ETag"] != first.headers["ETag"]
+    assert after["misses"] - before["misses"] == 2
+    assert after["hits"] - before["hits"] == 1
+
+def test_audio_etag_and_conditional_get(client):
+    response = client.post("/generate_audio", json={"text": f"Texto para el ETag {uuid.uuid4()}."})
+    key = response.headers["X-Audio-Key"]
+    etag = response.headers["ETag"]
+    assert etag == f'"{key}"'
+    assert response.headers["Content-Location"] == f"/audio/{key}"
+
+    # POST no es una petición condicional: siempre devuelve el audio
+    again = client.post("/generate_audio", json={"text": "x"}, headers={"If-None-Match": etag})
+    assert again.status_code == 200 and again.content
+
+    cached = client.get(f"/audio/{key}")
+    assert cached.status_code == 200
+    assert cached.content == response.content
+    assert cached.headers["ETag"] == etag
+    assert "immutable" in cached.headers["Cache-Control"]
+
+    not_modified = client.get(f"/audio/{key}", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+
+    assert client.get(f"/audio/{'0' * 64}").status_code == 404
+    assert client.get("/audio/no-es-una-clave").status_code == 404
+
+def test_trim_does_not_break_audio_being_served(tmp_path):
+    backend = FakeTTSBackend()
+    one_audio = len(backend.synthesize("a" * 60, "es"))
+    service = TTSService(backend=backend, cache_dir=str(tmp_path), max_bytes=one_audio)
+
+    key_a, audio_a = service.synthesize("a" * 60)
+    # El segundo audio expulsa al primero de la caché
+    key_b, audio_b = service.synthesize("b" * 60)
+    assert service.read(key_a) is None
+    assert service.read(key_b) == audio_b
+    # Lo ya entregado no depende del archivo: el primer audio sigue completo
+    assert len(audio_a) == one_audio
+
+    # Pedirlo otra vez es un fallo de caché que lo vuelve a sintetizar
+    assert service.synthesize("a" * 60) == (key_a, audio_a)
+    assert service.stats()["misses"] == 3
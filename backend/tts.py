@@ -0,0 +1,188 @@
+import hashlib
+import io
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import normalize_text
+
+# Motor de síntesis: "gtts" (Google Translate TTS) o "fake" (local, para pruebas sin red)
+TTS_BACKEND = os.getenv("TTS_BACKEND", "gtts")
+# Audios sintetizados, por hash de (motor, idioma, texto)
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "data/tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+# Caracteres por fragmento (frases completas) que se sintetizan en paralelo
+TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "400"))
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4"))
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…;:])\s+")
+
+def split_sentences(text: str, max_chars: int = TTS_CHUNK_CHARS) -> list:
+    """
+    Agrupa las frases del texto en fragmentos de hasta max_chars caracteres; una frase
+    más larga se corta entre palabras.
+    """
+    chunks = []
+    current = ""
+    for sentence in _SENTENCE_END.split(normalize_text(text)):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current} {sentence}".strip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+class GTTSBackend:
+    name = "gtts"
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        from gtts import gTTS
+        buffer = io.BytesIO()
+        gTTS(text=text, lang=lang).write_to_fp(buffer)
+        return buffer.getvalue()
+
+class FakeTTSBackend:
+    """
+    Sustituto local: MP3 de silencio (tramas MPEG-1 Layer III mono de 32 kbps a 32 kHz,
+    36 ms cada una) con una duración proporcional al texto.
+    """
+    name = "fake"
+    FRAME = bytes([0xFF, 0xFB, 0x18, 0xC4]) + bytes(140)
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        # ~15 caracteres por segundo de habla
+        return self.FRAME * max(1, round(len(text) / 15 / 0.036))
+
+BACKENDS = {"gtts": GTTSBackend, "fake": FakeTTSBackend}
+
+class TTSService:
+    """
+    Síntesis de voz con caché en disco direccionada por contenido: la clave es el hash
+    de (motor, idioma, texto normalizado) y el archivo es el MP3 completo. Los textos
+    largos se sintetizan por fragmentos de frases en paralelo y se concatenan (las
+    tramas MP3 se pueden concatenar). La caché expulsa los audios menos usados al
+    superar TTS_CACHE_MAX_BYTES.
+    """
+    def __init__(self, backend=None, cache_dir=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES,
+                 chunk_chars=TTS_CHUNK_CHARS, workers=TTS_WORKERS):
+        # backend: cualquier objeto con `name` y synthesize(texto, idioma) -> bytes MP3
+        self.backend = backend or BACKENDS[TTS_BACKEND]()
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.chunk_chars = chunk_chars
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Un candado por clave: dos peticiones del mismo audio lo sintetizan una sola vez
+        self._key_locks = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, text: str, lang: str) -> str:
+        payload = "\0".join([self.backend.name, lang, normalize_text(text)])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.mp3")
+
+    def read(self, key: str):
+        """
+        MP3 en caché (y lo marca como usado), o None. Se lee de una vez desde el archivo
+        abierto: un recorte de la caché en otro hilo puede borrarlo en cualquier momento.
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return audio
+
+    def synthesize(self, text: str, lang: str = "es") -> tuple:
+        """
+        Retorna (clave, bytes del MP3), sintetizándolo solo si no está en caché.
+        """
+        key = self.key(text, lang)
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                audio = self.read(key)
+                if audio is not None:
+                    with self._lock:
+                        self.hits += 1
+                    return key, audio
+                with self._lock:
+                    self.misses += 1
+                audio = self._synthesize_chunks(text, lang)
+                path = self.path(key)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(audio)
+                os.replace(tmp_path, path)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._key_locks.pop(key, None)
+        self._trim(keep=path)
+        return key, audio
+
+    def _synthesize_chunks(self, text: str, lang: str) -> bytes:
+        chunks = split_sentences(text, self.chunk_chars)
+        if len(chunks) <= 1:
+            return self.backend.synthesize(" ".join(chunks), lang)
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(chunks)))) as pool:
+            return b"".join(pool.map(lambda chunk: self.backend.synthesize(chunk, lang), chunks))
+
+    def _files(self) -> list:
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _trim(self, keep: str = None):
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Ya borrado por otro recorte (o abierto, en Windows)
+                continue
+            total -= size
+
+    def clear(self):
+        for _, _, path in self._files():
+            os.remove(path)
+
+    def stats(self) -> dict:
+        files = self._files()
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend.name,
+            "entries": len(files),
+            "bytes": sum(size for _, size, _ in files),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -1,138 +1,512 @@
 import faiss
 import numpy as np
+import base64
+import glob
+import json
 import pickle
 import os
+import threading
+
+from metadata_store import MetadataStore, TIER_FULL
+from index_factory import (
+    INDEX_TYPES, VECTOR_INDEX_TYPE, build_index, effective_index_type, index_ids, index_type_of, needs_retrain,
+    search_params, supports_remove
+)
+
+# Operaciones del log entre checkpoints completos
+CHECKPOINT_EVERY = int(os.getenv("VECTOR_CHECKPOINT_EVERY", "500"))
+# fsync de cada registro del log (durabilidad ante cortes de energía)
+LOG_FSYNC = os.getenv("VECTOR_LOG_FSYNC", "1") == "1"
+# Proporción de documentos borrados (o lápidas en HNSW) que dispara una compactación
+COMPACT_RATIO = float(os.getenv("VECTOR_COMPACT_RATIO", "0.2"))
+# Mejores pasajes por documento que devuelve la búsqueda (los que ve el reranker)
+SEARCH_PASSAGES_PER_DOC = int(os.getenv("SEARCH_PASSAGES_PER_DOC", "3"))
+# Constante k de Reciprocal Rank Fusion: score = Σ 1 / (k + posición) en cada ranking
+SEARCH_RRF_K = int(os.getenv("SEARCH_RRF_K", "60"))
 
 class VectorStore:
-    def __init__(self, index_path="data/faiss_index.bin", metadata_path="data/metadata.pkl", dimension=768):
+    """
+    Índice FAISS con persistencia incremental + metadatos indexados en SQLite.
+    Cada alta/baja (y cada sustitución de los pasajes de un documento) se anexa a un
+    log (data/vector_store.log) y periódicamente se escribe un checkpoint del índice a
+    un archivo temporal que se renombra de forma atómica. Al arrancar se carga el
+    checkpoint y se reproduce el log.
+    Los metadatos viven en MetadataStore, que guarda la fila FAISS de cada documento
+    y su vector original; con ellos se entrenan y reconstruyen los índices ANN
+    (IVF, HNSW, IVF-PQ) cuando cambia el tipo configurado o crece el corpus.
+    La fila es un id estable (IndexIDMap o ids nativos de IVF): las bajas quitan el
+    vector del índice, salvo en HNSW, donde quedan como lápidas excluidas de la
+    búsqueda hasta la siguiente compactación.
+    """
+    def __init__(self, index_path="data/faiss_index.bin", metadata_path="data/metadata.pkl", dimension=768,
+                 checkpoint_path="data/vector_store.ckpt", log_path="data/vector_store.log",
+                 checkpoint_every=CHECKPOINT_EVERY, metadata_db_path="data/metadata.sqlite3",
+                 index_type=VECTOR_INDEX_TYPE):
+        # index_path/metadata_path: formato anterior, solo se leen para migrar
         self.index_path = index_path
         self.metadata_path = metadata_path
+        self.checkpoint_path = checkpoint_path
+        self.log_path = log_path
+        self.checkpoint_every = checkpoint_every
         self.dimension = dimension
-        self.metadata = [] # List of dicts corresponding to index IDs
-        
-        if os.path.exists(self.index_path) and os.path.exists(self.metadata_path):
+        if index_type != "auto" and index_type not in INDEX_TYPES:
+            raise ValueError(f"Tipo de índice desconocido: {index_type}")
+        self.index_type = index_type
+        # Los handlers llaman al almacén desde el pool de hilos: serializar accesos
+        self._lock = threading.RLock()
+        # Generación del índice: cambia con cada escritura para invalidar cachés de búsqueda
+        self.generation = 0
+        # Número de secuencia de la última operación registrada en el log
+        self.seq = 0
+        self._ops_since_checkpoint = 0
+        # Un solo checkpoint a la vez (puede liberarse desde el hilo de escritura)
+        self._checkpoint_lock = threading.Lock()
+        # Una sola reconstrucción del índice a la vez
+        self._rebuild_lock = threading.Lock()
+        # Cambia con cada borrado total: una reconstrucción en curso queda obsoleta
+        self._clear_epoch = 0
+        # Siguiente id estable a asignar (nunca se reutiliza)
+        self.next_row = 0
+        # Ids borrados que siguen en un índice HNSW, y su selector de exclusión
+        self._tombstones = set()
+        self._tombstone_sel = None
+        # Documentos marcados como borrados en SQLite pendientes de purgar
+        self._deleted_docs = 0
+        self._log_file = None
+
+        os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+        self.metadata = MetadataStore(metadata_db_path)
+        self.index = self._empty_index()
+        if os.path.exists(self.checkpoint_path) or self._log_segments():
             self.load()
-        else:
-            self.index = faiss.IndexFlatL2(self.dimension)
+        elif os.path.exists(self.index_path) and os.path.exists(self.metadata_path):
+            self._migrate_legacy()
+        self._sync_with_metadata()
+        self._log_file = open(self.log_path, "a", encoding="utf-8")
+        self._maybe_rebuild()
 
-    def add_document(self, embedding: np.ndarray, doc_metadata: dict):
+    def add_document(self, doc_metadata: dict, passages: list, text: str = ""):
         """
-        Agrega un embedding de documento y sus metadatos al almacén.
+        Agrega un documento con sus pasajes ({"vector", "start", "end", "text"}),
+        cada uno con su propia fila en el índice, y su texto completo al índice
+        de palabras clave.
         """
-        # Faiss espera float32
-        vector = np.array([embedding]).astype('float32')
-        self.index.add(vector)
-        self.metadata.append(doc_metadata)
-        self.save()
+        with self._lock:
+            # Primero el log (durable), luego el estado en memoria y SQLite
+            row = self.next_row
+            self._append_log({
+                "op": "add",
+                "row": row,
+                "meta": doc_metadata,
+                "passages": [
+                    {"start": p.get("start"), "end": p.get("end"), "text": p.get("text"),
+                     "vector": base64.b64encode(np.asarray(p["vector"], dtype='float32').tobytes()).decode("ascii")}
+                    for p in passages
+                ],
+                "text": text,
+            })
+            self._apply_add(doc_metadata, passages, row, text)
+        self._after_write()
+
+    def _apply_add(self, doc_metadata: dict, passages: list, row: int, text: str = ""):
+        if passages:
+            # Faiss espera float32
+            vectors = np.array([p["vector"] for p in passages], dtype='float32').reshape(len(passages), -1)
+            self.index.add_with_ids(vectors, np.arange(row, row + len(passages), dtype='int64'))
+        self.metadata.add(doc_metadata, row, passages, text)
+        self.next_row = max(self.next_row, row + max(len(passages), 1))
+        self.generation += 1
 
-    def search(self, query_embedding: np.ndarray, query_text: str = None, k=5):
+    def search(self, query_embedding: np.ndarray, query_text: str = None, k=5, nprobe: int = None,
+               ef_search: int = None, passages_per_doc: int = SEARCH_PASSAGES_PER_DOC):
         """
-        Busca los k vecinos más cercanos usando Búsqueda Híbrida (Vector + Palabra Clave).
+        Busca los k documentos más relevantes usando Búsqueda Híbrida (Vector + BM25),
+        combinando ambos rankings con Reciprocal Rank Fusion.
+        La búsqueda vectorial es por pasajes: cada documento se ordena por su mejor pasaje
+        y trae sus `passages_per_doc` pasajes más cercanos.
+        nprobe (IVF) y ef_search (HNSW) ajustan recall/latencia solo para esta consulta.
         """
         vector = np.array([query_embedding]).astype('float32')
-        distances, indices = self.index.search(vector, k * 2)
-        
+        # Varios pasajes pueden ser del mismo documento: pedir más hasta cubrir k documentos
+        fetch = k * 4
+        while True:
+            with self._lock:
+                params = search_params(self.index, nprobe=nprobe, ef_search=ef_search, sel=self._exclude_selector())
+                distances, indices = self.index.search(vector, fetch, params=params)
+                ntotal = self.index.ntotal
+            hits = [(int(idx), float(dist)) for idx, dist in zip(indices[0], distances[0]) if idx != -1]
+            passages = self.metadata.passages_by_rows([row for row, _ in hits])
+            if len({p["doc_id"] for p in passages.values()}) >= k or fetch >= ntotal:
+                break
+            fetch *= 4
+
+        # Agregar pasajes por documento (los hits vienen ordenados por distancia)
         vector_results = {}
-        for i, idx in enumerate(indices[0]):
-            if idx != -1 and idx < len(self.metadata):
-                vector_results[idx] = float(distances[0][i])
-
-        keyword_matches = set()
-        if query_text:
-            query_lower = query_text.lower()
-            for idx, meta in enumerate(self.metadata):
-                # saltar eliminados
-                if meta.get('deleted'): continue
-                
-                if query_lower in meta['filename'].lower() or \
-                   (meta.get('summary') and query_lower in meta['summary'].lower()):
-                    keyword_matches.add(idx)
+        doc_passages = {}
+        for row, dist in hits:
+            passage = passages.get(row)
+            if not passage:
+                continue
+            doc_id = passage["doc_id"]
+            vector_results.setdefault(doc_id, dist)
+            selected = doc_passages.setdefault(doc_id, [])
+            # Los pasajes sin texto son vectores de documento completo (formato anterior)
+            if passage["text"] and len(selected) < passages_per_doc:
+                selected.append({"start": passage["start"], "end": passage["end"],
+                                 "text": passage["text"], "distance": dist})
+
+        keyword_results = dict(self.metadata.keyword_search(query_text, limit=k * 4)) if query_text else {}
+
+        # Reciprocal Rank Fusion: solo importan las posiciones, no las escalas de L2 y BM25
+        fused = {}
+        for ranking in (vector_results, keyword_results):
+            for rank, doc_id in enumerate(ranking):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (SEARCH_RRF_K + rank + 1)
+
+        docs_by_id = self.metadata.get_many(list(fused.keys()))
 
         final_candidates = []
-        all_indices = set(vector_results.keys()) | keyword_matches
-        
-        for idx in all_indices:
-            if idx >= len(self.metadata): continue
-            meta = self.metadata[idx]
-            
-            # Verificar bandera de eliminado O archivo faltante
-            if meta.get('deleted') or not os.path.exists(meta['path']):
+        for doc_id in sorted(fused, key=fused.get, reverse=True):
+            # get_many ya excluye los documentos con el archivo faltante (sin tocar el disco)
+            meta = docs_by_id.get(doc_id)
+            if not meta:
                 continue
-                
-            score = vector_results.get(idx, 1.5) 
-            
-            if idx in keyword_matches:
-                score *= 0.5
-                if query_text and query_text.lower() in meta['filename'].lower():
-                    score = 0.0
-                    
+
             final_candidates.append({
                 "metadata": meta,
-                "distance": score
+                "score": round(fused[doc_id], 6),
+                "distance": vector_results.get(doc_id),
+                "keyword_score": keyword_results.get(doc_id),
+                "passages": doc_passages.get(doc_id, []),
             })
-            
-        final_candidates.sort(key=lambda x: x['distance'])
-        return final_candidates[:k]
+            if len(final_candidates) == k:
+                break
+        return final_candidates
+
+    def search_document(self, doc_id: str, query_embedding: np.ndarray, max_chars: int) -> list:
+        """
+        Pasajes de un solo documento más cercanos a la consulta, tomados de mejor a peor
+        hasta llenar max_chars caracteres y devueltos en el orden del documento.
+        Usa los vectores de pasaje guardados en la ingesta (búsqueda exacta: pocos pasajes por documento).
+        """
+        passages = [p for p in self.metadata.passages_for_doc(doc_id, with_vectors=True) if p["text"]]
+        if not passages:
+            return []
+        matrix = np.stack([p["vector"] for p in passages])
+        query = np.asarray(query_embedding, dtype=np.float32)
+        distances = ((matrix - query) ** 2).sum(axis=1)
+
+        selected, used = [], 0
+        for i in np.argsort(distances):
+            passage = passages[i]
+            text = passage["text"]
+            if selected and used + len(text) > max_chars:
+                continue
+            # El mejor pasaje entra siempre, recortado si excede el presupuesto
+            if not selected:
+                text = text[:max_chars]
+            used += len(text)
+            selected.append({"position": passage["position"], "start": passage["start"], "end": passage["end"],
+                             "text": text, "distance": float(distances[i])})
+        return sorted(selected, key=lambda p: p["position"])
 
     def list_documents(self):
         """
-        Retorna una lista de todos los documentos activos.
+        Retorna una lista de todos los documentos activos con su archivo presente.
         """
-        valid_docs = []
-        for meta in self.metadata:
-            if not meta.get('deleted') and os.path.exists(meta['path']):
-                valid_docs.append(meta)
-        return valid_docs
+        return self.metadata.list_active()
 
-    def delete_document(self, doc_id: str):
+    def iter_documents(self):
         """
-        Deletes a document by ID.
+        Como list_documents, pero por páginas (exportaciones grandes).
         """
-        for i, meta in enumerate(self.metadata):
-            if meta.get('id') == doc_id:
-                # Remove file from disk
-                if os.path.exists(meta['path']):
-                    try:
-                        os.remove(meta['path'])
-                    except Exception as e:
-                        print(f"Error removing file {meta['path']}: {e}")
-                
-                
+        return self.metadata.iter_active()
+
+    def reconcile(self, repair: bool = False) -> dict:
+        """
+        Compara los documentos activos con el disco y actualiza su marca de archivo
+        faltante (también la quita si el archivo reapareció).
+        Con repair=True elimina del almacén los documentos cuyo archivo falta.
+        """
+        newly_missing, restored = [], []
+        docs = self.metadata.paths()
+        for doc_id, path, missing in docs:
+            exists = os.path.exists(path)
+            if missing and exists:
+                restored.append(doc_id)
+            elif not missing and not exists:
+                newly_missing.append(doc_id)
+
+        if newly_missing or restored:
+            with self._lock:
+                self.metadata.set_missing(newly_missing, True)
+                self.metadata.set_missing(restored, False)
+                self.generation += 1
+
+        missing = self.metadata.missing_ids()
+        removed = [doc_id for doc_id in missing if repair and self.delete_document(doc_id)]
+        if newly_missing or removed:
+            print(f"🩺 Reconciliación: {len(newly_missing)} archivo(s) faltante(s), {len(removed)} documento(s) eliminados.")
+        return {
+            "checked": len(docs),
+            "missing": [doc_id for doc_id in missing if doc_id not in removed],
+            "restored": restored,
+            "removed": removed,
+        }
+
+    def get_document(self, doc_id: str):
+        """
+        Retorna los metadatos de un documento activo por ID, o None.
+        """
+        return self.metadata.get(doc_id)
+
+    def find_by_hash(self, content_hash: str):
+        """
+        Retorna los metadatos del documento activo con ese hash de contenido, o None.
+        """
+        return self.metadata.find_by_hash(content_hash)
+
+    def find_by_filename(self, filename: str):
+        """
+        Retorna los metadatos del documento activo con ese nombre de archivo, o None.
+        """
+        return self.metadata.find_by_filename(filename)
+
     def check_file_exists(self, filename: str) -> bool:
         """
         Verifica si un archivo con el nombre dado ya existe y está activo.
         """
-        for meta in self.metadata:
-            if not meta.get('deleted') and meta.get('filename') == filename:
-                return True
-        return False
-        
+        return self.metadata.find_by_filename(filename) is not None
+
     def delete_document(self, doc_id: str):
         """
-        Elimina un documento por ID.
-        Usa Borrado Suave (marcar como eliminado) para preservar la alineación del índice FAISS.
+        Elimina un documento por ID: quita su vector del índice y lo marca como
+        eliminado en SQLite (la fila se purga en la siguiente compactación).
         """
-        for i, meta in enumerate(self.metadata):
-            if meta.get('id') == doc_id:
-                # 1. Intentar eliminar archivo físico
-                if os.path.exists(meta['path']):
-                    try:
-                        os.remove(meta['path'])
-                    except Exception as e:
-                        print(f"Advertencia: No se pudo eliminar el archivo {meta['path']}: {e}")
-                
-                # 2. Marcar como eliminado en metadatos
-                meta['deleted'] = True
-                
-                # 3. Guardar metadatos
-                self.save()
-                return True
-        return False
-
-    def _rebuild_index(self):
-        # Obsoleto: Ya no reconstruimos el índice para evitar perder vectores.
-        # Confiamos en el filtro de la bandera 'deleted' durante la búsqueda/listado.
-        pass
+        with self._lock:
+            meta = self.metadata.get(doc_id)
+            if not meta:
+                return False
+
+            # 1. Intentar eliminar archivo físico
+            if os.path.exists(meta['path']):
+                try:
+                    os.remove(meta['path'])
+                except Exception as e:
+                    print(f"Advertencia: No se pudo eliminar el archivo {meta['path']}: {e}")
+
+            # 2. Registrar la baja y marcar como eliminado en metadatos
+            self._append_log({"op": "delete", "id": doc_id})
+            self._apply_delete(doc_id)
+        self._after_write()
+        return True
+
+    def _apply_delete(self, doc_id: str):
+        rows = self.metadata.doc_rows(doc_id)
+        if self.metadata.mark_deleted(doc_id):
+            self._deleted_docs += 1
+        self._drop_from_index(rows)
+        self.generation += 1
+
+    def _drop_from_index(self, ids: list):
+        # Llamar con self._lock tomado
+        if not len(ids):
+            return
+        if supports_remove(self.index):
+            self.index.remove_ids(np.asarray(ids, dtype='int64'))
+        else:
+            self._tombstones.update(int(i) for i in ids)
+            self._tombstone_sel = None
+
+    def _exclude_selector(self):
+        # Llamar con self._lock tomado (el selector debe vivir durante la búsqueda)
+        if not self._tombstones:
+            return None
+        if self._tombstone_sel is None:
+            batch = faiss.IDSelectorBatch(np.array(sorted(self._tombstones), dtype='int64'))
+            self._tombstone_sel = (batch, faiss.IDSelectorNot(batch))
+        return self._tombstone_sel[1]
+
+    def _live_count(self) -> int:
+        return self.index.ntotal - len(self._tombstones)
+
+    def reindex(self, passages_by_id: dict, texts_by_id: dict = None):
+        """
+        Reemplaza los pasajes de los documentos de `passages_by_id` ({doc_id: pasajes})
+        y, si se da, su texto en el índice de palabras clave ({doc_id: texto}).
+        Los pasajes nuevos reciben filas nuevas y los anteriores salen del índice
+        (en HNSW quedan como lápidas hasta la compactación).
+        """
+        with self._lock:
+            old_rows = []
+            replaced = {}
+            for doc_id, passages in passages_by_id.items():
+                old_rows += self.metadata.doc_rows(doc_id)
+                replaced[doc_id] = (self.next_row, passages)
+                self.next_row += max(len(passages), 1)
+            self.metadata.replace_passages(replaced)
+            if texts_by_id:
+                self.metadata.set_texts(texts_by_id)
+            for doc_id, (first_row, passages) in replaced.items():
+                if passages:
+                    vectors = np.array([p["vector"] for p in passages], dtype='float32').reshape(len(passages), -1)
+                    self.index.add_with_ids(vectors, np.arange(first_row, first_row + len(passages), dtype='int64'))
+            self._drop_from_index(old_rows)
+            self.generation += 1
+        # El reindexado no pasa por el log: checkpoint completo
+        self.checkpoint()
+        self._maybe_rebuild()
+        return self.metadata.count()
+
+    def complete_document(self, doc_id: str, passages: list, text: str, tier: str = TIER_FULL) -> bool:
+        """
+        Sustituye los pasajes y el texto de un documento al completarse un nivel del
+        análisis (p. ej. la transcripción completa) y registra el nivel. Como un alta,
+        pasa por el log: el checkpoint llega con la cadencia normal.
+        Retorna False si el documento se borró mientras tanto.
+        """
+        with self._lock:
+            if not self.metadata.get(doc_id):
+                return False
+            row = self.next_row
+            self._append_log({
+                "op": "replace",
+                "id": doc_id,
+                "row": row,
+                "passages": [
+                    {"start": p.get("start"), "end": p.get("end"), "text": p.get("text"),
+                     "vector": base64.b64encode(np.asarray(p["vector"], dtype='float32').tobytes()).decode("ascii")}
+                    for p in passages
+                ],
+                "text": text,
+                "tier": tier,
+            })
+            self._apply_replace(doc_id, passages, row, text, tier)
+        self._after_write()
+        return True
+
+    def _apply_replace(self, doc_id: str, passages: list, row: int, text: str, tier: str):
+        if not self.metadata.get(doc_id):
+            return
+        new_rows = range(row, row + max(len(passages), 1))
+        # Al reproducir el log, SQLite puede tener ya las filas nuevas: no son lápidas
+        old_rows = [r for r in self.metadata.doc_rows(doc_id) if r not in new_rows]
+        self.metadata.replace_passages({doc_id: (row, passages)})
+        self.metadata.set_texts({doc_id: text})
+        self.metadata.set_tier(doc_id, tier)
+        self._drop_from_index(old_rows)
+        if passages:
+            vectors = np.array([p["vector"] for p in passages], dtype='float32').reshape(len(passages), -1)
+            self.index.add_with_ids(vectors, np.arange(row, row + len(passages), dtype='int64'))
+        self.next_row = max(self.next_row, new_rows.stop)
+        self.generation += 1
+
+    def rebuild_index(self, index_type: str = None, background: bool = False):
+        """
+        Reconstruye el índice desde los vectores guardados en SQLite, con el tipo
+        configurado (o `index_type`, que pasa a ser el nuevo tipo configurado).
+        También compacta: el índice nuevo solo tiene documentos vivos.
+        Retorna el tipo construido (None si no se hizo).
+        """
+        if index_type is not None:
+            if index_type != "auto" and index_type not in INDEX_TYPES:
+                raise ValueError(f"Tipo de índice desconocido: {index_type}")
+            self.index_type = index_type
+        if not self._rebuild_lock.acquire(blocking=not background):
+            return None  # Ya hay una reconstrucción en curso
+        try:
+            target, _ = self._rebuild()
+        finally:
+            self._rebuild_lock.release()
+        if target:
+            # El índice cambió por completo: checkpoint completo en lugar de log
+            self.checkpoint(background=background)
+        return target
+
+    def compact(self, background: bool = False):
+        """
+        Purga de SQLite los documentos borrados y, si hay lápidas en un índice HNSW,
+        lo reconstruye sin ellas. Las búsquedas no se bloquean mientras tanto.
+        Retorna el número de documentos purgados (None si ya había una compactación en curso).
+        """
+        if not self._rebuild_lock.acquire(blocking=not background):
+            return None
+        try:
+            with self._lock:
+                has_tombstones = bool(self._tombstones)
+            if has_tombstones:
+                target, purged = self._rebuild()
+            else:
+                target = None
+                with self._lock:
+                    purged = self.metadata.purge_deleted()
+                    self._deleted_docs = 0
+        finally:
+            self._rebuild_lock.release()
+        if target:
+            self.checkpoint(background=background)
+        if purged:
+            print(f"🧹 VectorStore compactado: {purged} documento(s) borrado(s) purgados.")
+        return purged
+
+    def _rebuild(self):
+        """
+        Construye un índice nuevo con los vectores vivos y lo pone en lugar del actual.
+        El entrenamiento y la construcción ocurren fuera del lock, así las búsquedas
+        siguen usando el índice anterior; al final se aplican las altas y bajas
+        ocurridas mientras tanto. Llamar con self._rebuild_lock tomado.
+        Retorna (tipo construido, documentos purgados).
+        """
+        with self._lock:
+            start_row = self.next_row
+            epoch = self._clear_epoch
+        ids, vectors = self.metadata.live_vectors(self.dimension)
+        keep = ids < start_row
+        ids, vectors = ids[keep], vectors[keep]
+        target = effective_index_type(self.index_type, len(ids))
+        new_index = build_index(target, self.dimension, vectors, ids)
+
+        with self._lock:
+            if epoch != self._clear_epoch:
+                return None, 0  # Se borró todo durante la construcción
+            new_ids, new_vectors = self.metadata.live_vectors(self.dimension, min_row=start_row)
+            if len(new_ids):
+                new_index.add_with_ids(new_vectors, new_ids)
+            stale = np.setdiff1d(index_ids(new_index), self.metadata.live_rows())
+
+            self.index = new_index
+            self._tombstones = set()
+            self._tombstone_sel = None
+            self._drop_from_index(stale)
+            purged = self.metadata.purge_deleted()
+            self._deleted_docs = 0
+            self.generation += 1
+        print(f"🧭 Índice reconstruido como '{target}' ({new_index.ntotal} vectores).")
+        return target, purged
+
+    def _index_outdated(self) -> bool:
+        with self._lock:
+            n = self._live_count()
+            return index_type_of(self.index) != effective_index_type(self.index_type, n) or needs_retrain(self.index, n)
+
+    def _needs_compaction(self) -> bool:
+        with self._lock:
+            pending = max(self._deleted_docs, len(self._tombstones))
+            total = self._live_count() + pending
+            return pending > 0 and pending / total >= COMPACT_RATIO
+
+    def index_info(self) -> dict:
+        with self._lock:
+            info = {
+                "configured_type": self.index_type,
+                "type": index_type_of(self.index),
+                "vectors": self._live_count(),
+                "tombstones": len(self._tombstones),
+                "deleted_pending": self._deleted_docs,
+            }
+            if info["type"] in ("ivf_flat", "ivf_pq"):
+                info["nlist"] = faiss.extract_index_ivf(self.index).nlist
+        return info
 
     def clear_all(self):
         """
@@ -143,23 +517,291 @@ class VectorStore:
         if os.path.exists(upload_dir):
             for f in os.listdir(upload_dir):
                 os.remove(os.path.join(upload_dir, f))
-        
+
         # 2. Reiniciar Índice y Metadatos
-        self.index = faiss.IndexFlatL2(self.dimension)
-        self.metadata = []
-        self.save()
+        with self._lock:
+            self._append_log({"op": "clear"})
+            self._apply_clear()
+        self.checkpoint()
         return True
 
-    def save(self):
-        faiss.write_index(self.index, self.index_path)
-        with open(self.metadata_path, 'wb') as f:
-            pickle.dump(self.metadata, f)
+    def _apply_clear(self):
+        self.index = self._empty_index()
+        self.metadata.clear()
+        self._tombstones = set()
+        self._tombstone_sel = None
+        self._deleted_docs = 0
+        self.generation += 1
+        self._clear_epoch += 1
+
+    def _empty_index(self):
+        return build_index("flat", self.dimension, np.empty((0, self.dimension), dtype='float32'), np.empty(0, dtype='int64'))
+
+    # --- Persistencia: log de operaciones + checkpoints atómicos ---
+
+    def _append_log(self, record: dict):
+        # Llamar con self._lock tomado
+        self.seq += 1
+        record["seq"] = self.seq
+        self._log_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._log_file.flush()
+        if LOG_FSYNC:
+            os.fsync(self._log_file.fileno())
+        self._ops_since_checkpoint += 1
+
+    def _after_write(self):
+        """
+        Tras cada alta/baja: checkpoint periódico y, si el corpus cruzó un umbral
+        del modo automático (o un IVF quedó con pocas listas), reconstrucción en segundo
+        plano; si hay demasiados borrados pendientes, compactación.
+        """
+        if self._ops_since_checkpoint >= self.checkpoint_every:
+            self.checkpoint(background=True)
+        self._maybe_rebuild()
+
+    def _maybe_rebuild(self):
+        # Mientras se construye, las búsquedas siguen usando el índice actual
+        if self._rebuild_lock.locked():
+            return
+        if self._index_outdated():
+            threading.Thread(target=self.rebuild_index, kwargs={"background": True}, daemon=True).start()
+        elif self._needs_compaction():
+            threading.Thread(target=self.compact, kwargs={"background": True}, daemon=True).start()
+
+    def checkpoint(self, background: bool = False):
+        """
+        Escribe un checkpoint completo del índice de forma atómica.
+        La instantánea se toma bajo el lock; la escritura a disco puede ir en un
+        hilo aparte para no bloquear lecturas ni nuevas altas.
+        """
+        if not self._checkpoint_lock.acquire(blocking=not background):
+            return  # Ya hay un checkpoint en curso
+        try:
+            with self._lock:
+                state = {"seq": self.seq, "next_row": self.next_row, "index": faiss.serialize_index(self.index)}
+                # Rotar el log: las operaciones nuevas van a un segmento nuevo
+                self._log_file.close()
+                if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > 0:
+                    os.replace(self.log_path, f"{self.log_path}.{self.seq}")
+                self._log_file = open(self.log_path, "a", encoding="utf-8")
+                self._ops_since_checkpoint = 0
+        except Exception:
+            self._checkpoint_lock.release()
+            raise
+
+        if background:
+            threading.Thread(target=self._write_checkpoint, args=(state,), daemon=True).start()
+        else:
+            self._write_checkpoint(state)
+
+    def _write_checkpoint(self, state: dict):
+        seq = state["seq"]
+        try:
+            tmp_path = self.checkpoint_path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.checkpoint_path)
+
+            # Los segmentos ya incluidos en el checkpoint sobran
+            for segment_seq, path in self._log_segments():
+                if segment_seq <= seq:
+                    os.remove(path)
+        except Exception as e:
+            print(f"❌ Error escribiendo checkpoint del índice: {e}")
+        finally:
+            self._checkpoint_lock.release()
+
+    def _log_segments(self):
+        segments = []
+        for path in glob.glob(glob.escape(self.log_path) + ".*"):
+            suffix = path.rsplit(".", 1)[-1]
+            if suffix.isdigit():
+                segments.append((int(suffix), path))
+        return sorted(segments)
 
     def load(self):
-        self.index = faiss.read_index(self.index_path)
+        """
+        Carga el último checkpoint y reproduce las operaciones posteriores del log.
+        SQLite ya es durable por sí mismo; la reproducción solo completa lo que
+        faltara (altas con INSERT OR IGNORE, bajas idempotentes).
+        """
+        checkpoint_seq = 0
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'rb') as f:
+                state = pickle.load(f)
+            checkpoint_seq = state["seq"]
+            self.next_row = state.get("next_row", 0)
+            index = faiss.deserialize_index(state["index"])
+            if "metadata" in state:
+                # Checkpoint del formato anterior (metadatos en lista): migrar a SQLite
+                self.metadata.add_many([(meta, row, None, "") for row, meta in enumerate(state["metadata"])])
+            if not isinstance(index, (faiss.IndexIDMap, faiss.IndexIVF)):
+                index = self._from_positional(index)
+            self.index = index
+        self.seq = checkpoint_seq
+
+        replayed = 0
+        paths = [path for _, path in self._log_segments()]
+        if os.path.exists(self.log_path):
+            paths.append(self.log_path)
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Última línea truncada por un corte: se descarta
+                        continue
+                    if record["seq"] <= self.seq:
+                        continue
+                    self._replay(record)
+                    self.seq = record["seq"]
+                    replayed += 1
+        self._ops_since_checkpoint = replayed
+        if replayed:
+            print(f"🔁 VectorStore: {replayed} operación(es) reproducidas desde el log.")
+
+    def _replay(self, record: dict):
+        op = record["op"]
+        if op == "add":
+            if "passages" in record:
+                passages = [
+                    dict(p, vector=np.frombuffer(base64.b64decode(p["vector"]), dtype='float32'))
+                    for p in record["passages"]
+                ]
+            else:
+                # Registro de formato anterior: un vector por documento
+                passages = [{"vector": np.frombuffer(base64.b64decode(record["vector"]), dtype='float32')}]
+            self._apply_add(record["meta"], passages, record["row"], record.get("text", ""))
+        elif op == "replace":
+            passages = [
+                dict(p, vector=np.frombuffer(base64.b64decode(p["vector"]), dtype='float32'))
+                for p in record["passages"]
+            ]
+            self._apply_replace(record["id"], passages, record["row"], record.get("text", ""), record["tier"])
+        elif op == "delete":
+            self._apply_delete(record["id"])
+        elif op == "clear":
+            self._apply_clear()
+
+    def _migrate_legacy(self):
+        """
+        Importa el formato anterior (faiss_index.bin + metadata.pkl) y escribe el primer checkpoint.
+        """
+        print("📦 Migrando índice FAISS y metadata.pkl a SQLite + log...")
+        index = faiss.read_index(self.index_path)
         with open(self.metadata_path, 'rb') as f:
-            self.metadata = pickle.load(f)
+            legacy_metadata = pickle.load(f)
+        # La posición en la lista era la fila FAISS
+        self.metadata.add_many([(meta, row, None, "") for row, meta in enumerate(legacy_metadata)])
+        self.index = self._from_positional(index)
+        self._log_file = open(self.log_path, "a", encoding="utf-8")
+        self.checkpoint()
+        self._log_file.close()
+
+    def _from_positional(self, index):
+        """
+        Convierte un índice de formato anterior (sin ids: la posición era la fila)
+        a uno con ids estables, y copia a SQLite los vectores que falten.
+        """
+        n = index.ntotal
+        vectors = index.reconstruct_n(0, n) if n else np.empty((0, self.dimension), dtype='float32')
+        if n and self.metadata.stored_vector_count() < n:
+            self.metadata.put_vectors({row: vectors[row] for row in range(n)})
+            print(f"📦 VectorStore: {n} vectores copiados a SQLite.")
+        return build_index("flat", self.dimension, vectors, np.arange(n, dtype='int64'))
+
+    def _sync_with_metadata(self):
+        """
+        Tras cargar: quita del índice los ids que ya no son pasajes vivos (bajas y
+        purgas posteriores al checkpoint), agrega los pasajes vivos que falten
+        (reindexado sin checkpoint) y recalcula los contadores.
+        """
+        live = self.metadata.live_rows()
+        present = index_ids(self.index)
+        self._drop_from_index(np.setdiff1d(present, live))
+        missing, vectors = self.metadata.live_vectors(self.dimension, rows=np.setdiff1d(live, present))
+        if len(missing):
+            self.index.add_with_ids(vectors, missing)
+        self._deleted_docs = self.metadata.count(include_deleted=True) - self.metadata.count()
+        self.next_row = max(self.next_row, self.metadata.next_vector_row())
+
+    def close(self):
+        """
+        Escribe un checkpoint final y cierra el log (apagado ordenado).
+        """
+        # Esperar una reconstrucción en curso y no permitir nuevas
+        self._rebuild_lock.acquire()
+        self.checkpoint()
+        with self._lock:
+            self._log_file.close()
+            self.metadata.close()
+
+def _run_benchmark(sizes=(1_000, 10_000, 100_000), samples=20):
+    """
+    Tiempo de ingesta por documento con un corpus ya cargado de N documentos:
+    reescritura completa por mutación (formato anterior) contra log incremental.
+    """
+    import shutil
+    import tempfile
+    import time
+
+    rng = np.random.default_rng(0)
+    dimension = 768
+    for n in sizes:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            store = VectorStore(
+                index_path=os.path.join(tmp_dir, "legacy.bin"), metadata_path=os.path.join(tmp_dir, "legacy.pkl"),
+                checkpoint_path=os.path.join(tmp_dir, "store.ckpt"), log_path=os.path.join(tmp_dir, "store.log"),
+                metadata_db_path=os.path.join(tmp_dir, "metadata.sqlite3"), checkpoint_every=10**9,
+                index_type="flat"
+            )
+            corpus = [
+                {"id": f"doc-{i}", "filename": f"doc-{i}.pdf", "path": f"/tmp/doc-{i}.pdf",
+                 "category": "Factura", "summary": "Resumen de prueba " * 10, "deleted": False}
+                for i in range(n)
+            ]
+            vectors = rng.random((n, dimension), dtype=np.float32)
+            store.index.add_with_ids(vectors, np.arange(n, dtype='int64'))
+            store.metadata.add_many([(meta, row, [{"vector": vectors[row]}], "") for row, meta in enumerate(corpus)])
+            store.next_row = n
+            store.checkpoint()
+
+            def new_doc(i):
+                return rng.random(dimension, dtype=np.float32), {
+                    "id": f"new-{i}", "filename": f"new-{i}.pdf", "path": f"/tmp/new-{i}.pdf",
+                    "category": "Factura", "summary": "Resumen", "deleted": False
+                }
+
+            # Antes: add + faiss.write_index + pickle.dump de todo el corpus
+            legacy_index = faiss.IndexFlatL2(dimension)
+            legacy_index.add(vectors)
+            start = time.perf_counter()
+            for i in range(samples):
+                vector, meta = new_doc(i)
+                legacy_index.add(vector.reshape(1, -1))
+                corpus.append(meta)
+                faiss.write_index(legacy_index, store.index_path)
+                with open(store.metadata_path, 'wb') as f:
+                    pickle.dump(corpus, f)
+            before = (time.perf_counter() - start) / samples
+
+            # Después: add_document con un registro en el log
+            start = time.perf_counter()
+            for i in range(samples, samples * 2):
+                vector, meta = new_doc(i)
+                store.add_document(meta, [{"vector": vector}])
+            after = (time.perf_counter() - start) / samples
+
+            store.close()
+            print(f"N={n:>7}: reescritura completa {before * 1000:9.2f} ms/doc | log incremental {after * 1000:7.2f} ms/doc")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
 if __name__ == "__main__":
-    # Test logic
-    pass
+    import sys
+    if "--bench" in sys.argv:
+        _run_benchmark()
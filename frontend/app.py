@@ -1,6 +1,7 @@
 import streamlit as st
 import requests
 import os
+import json
 import time
 import pdfplumber
 from PIL import Image
@@ -9,6 +10,30 @@ from PIL import Image
 # URL de API Backend
 API_URL = os.getenv("API_URL", "http://localhost:8000")
 
+def stream_events(path, payload):
+    """
+    Llama a un endpoint NDJSON del backend y entrega cada evento en cuanto llega.
+    """
+    with requests.post(f"{API_URL}{path}", json=payload, stream=True) as res:
+        if res.status_code != 200:
+            raise RuntimeError(res.text)
+        for line in res.iter_lines():
+            if line:
+                yield json.loads(line)
+
+def document_text(doc_id):
+    """
+    Texto completo de un documento. Si solo tiene el análisis rápido, el backend
+    espera su transcripción completa. Se guarda en la sesión para no pedirlo en cada recarga.
+    """
+    texts = st.session_state.setdefault('document_texts', {})
+    if doc_id not in texts:
+        res = requests.get(f"{API_URL}/documents/{doc_id}/text")
+        if res.status_code != 200:
+            raise RuntimeError(res.text)
+        texts[doc_id] = res.json()["text"]
+    return texts[doc_id]
+
 st.set_page_config(
     page_title="Análisis Multimodal de Archivos",
     page_icon="🧠",
@@ -135,6 +160,13 @@ with st.sidebar:
                     st.caption(f"Categoría: {meta.get('category', 'N/A')}")
                     st.write(f"**Resumen:** {meta.get('summary', '')[:150]}...")
             
+            elif item.get('distance') is None:
+                # Solo coincidencia por palabras clave (BM25)
+                with st.expander(f"{meta['filename']}"):
+                    st.markdown("**Coincidencia por Palabras Clave**")
+                    st.caption(f"Categoría: {meta.get('category', 'N/A')}")
+                    st.write(f"**Resumen:** {meta.get('summary', '')[:150]}...")
+
             else:
                 # Modo Legado (Distancia L2)
                 score = item['distance']
@@ -176,20 +208,14 @@ with st.sidebar:
                             # Llamar endpoint de exportación
                             exp_res = requests.post(f"{API_URL}/export_comparison_excel", json=comp_data)
                             if exp_res.status_code == 200:
-                                excel_path = exp_res.json().get("excel_path")
-                                if excel_path and os.path.exists(excel_path):
-                                    with open(excel_path, "rb") as f:
-                                        excel_bytes = f.read()
-                                    
-                                    st.download_button(
-                                        label="💾 Descargar .xlsx",
-                                        data=excel_bytes,
-                                        file_name="comparacion_inteligente.xlsx",
-                                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                        key="btn_final_dl_excel"
-                                    )
-                                else:
-                                    st.error("Archivo no encontrado.")
+                                # El backend devuelve el .xlsx en la respuesta (no comparte disco)
+                                st.download_button(
+                                    label="💾 Descargar .xlsx",
+                                    data=exp_res.content,
+                                    file_name="comparacion_inteligente.xlsx",
+                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                    key="btn_final_dl_excel"
+                                )
                             else:
                                 st.error("Error generando Excel.")
                         except Exception as e:
@@ -208,18 +234,26 @@ with st.sidebar:
             if len(selected_for_comp) < 2:
                 st.warning("Necesitas al menos 2.")
             else:
-                with st.spinner("Gemini está comparando y estructurando datos..."):
-                    try:
-                        # Enviar filenames como doc_ids (backend lo maneja)
-                        res = requests.post(f"{API_URL}/compare", json={"doc_ids": selected_for_comp})
-                        if res.status_code == 200:
-                            comp_data = res.json().get("comparison")
-                            # comp_data ahora es un DICT (JSON)
-                            show_comparison_dialog(comp_data)
-                        else:
-                            st.error(f"Error: {res.text}")
-                    except Exception as e:
-                        st.error(f"Fallo conexión: {e}")
+                progress = st.empty()
+                progress.caption("Gemini está comparando y estructurando datos...")
+                try:
+                    # Enviar filenames como doc_ids (backend lo maneja); la respuesta llega por trozos
+                    received = ""
+                    comp_data = None
+                    for event in stream_events("/compare/stream", {"doc_ids": selected_for_comp}):
+                        if event["type"] == "delta":
+                            received += event["text"]
+                            progress.code(received[-600:], language="json")
+                        elif event["type"] == "done":
+                            comp_data = event.get("comparison")
+                        elif event["type"] == "error":
+                            st.error(f"Error: {event['detail']}")
+                    progress.empty()
+                    if comp_data:
+                        # comp_data ahora es un DICT (JSON)
+                        show_comparison_dialog(comp_data)
+                except Exception as e:
+                    st.error(f"Fallo conexión: {e}")
     except:
         st.caption("Cargando lista...")
 
@@ -334,6 +368,20 @@ with st.sidebar:
                     else:
                         st.warning("Por favor, selecciona al menos un archivo.")
                 
+                if st.button("📥 Exportar lista (Excel)", use_container_width=True):
+                    with st.spinner("Generando archivo..."):
+                        exp_res = requests.get(f"{API_URL}/documents/export")
+                        if exp_res.status_code == 200:
+                            st.download_button(
+                                label="💾 Descargar .xlsx",
+                                data=exp_res.content,
+                                file_name="documentos.xlsx",
+                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                key="btn_dl_docs_excel"
+                            )
+                        else:
+                            st.error("Error generando Excel.")
+
                 # List details below
                 with st.expander("Ver detalles de todos"):
                     for i, doc in enumerate(docs):
@@ -344,6 +392,7 @@ with st.sidebar:
                         </div>
                         <div style="font-size: 0.85em; color: #aaa; margin-bottom: 5px; display: flex; align-items: center; gap: 4px;">
                             <span style="position: relative; top: -2px;">📂</span> <span>{doc.get('category', 'N/A')}</span>
+                            <span>{"· ⏳ transcripción completa pendiente" if doc.get('tier') == 'quick' else ""}</span>
                         </div>
                         """, unsafe_allow_html=True)
                         st.info(doc.get('summary', 'Sin resumen disponible.'))
@@ -457,26 +506,49 @@ with col1:
                 if 'batch_results' not in st.session_state:
                     st.session_state['batch_results'] = []
                 
-                for i, uploaded_file in enumerate(uploaded_files):
-                    status_text.text(f"Procesando {uploaded_file.name} ({i+1}/{len(uploaded_files)})...")
-                    
-                    # 2. Analyze
+                # 1. Encolar todos los archivos (el backend responde de inmediato con un job_id)
+                pending_jobs = {}
+                for uploaded_file in uploaded_files:
                     try:
                         uploaded_file.seek(0)
                         files = {"file": (uploaded_file.name, uploaded_file, uploaded_file.type)}
                         response = requests.post(f"{API_URL}/analyze", files=files)
                         
-                        if response.status_code == 200:
-                            data = response.json()
-                            st.session_state['analysis_result'] = data # Legacy support for logic checks
-                            st.session_state['batch_results'].append(data) # Agregando a lista
-                            st.session_state['processed_files'].add(uploaded_file.name) # MARCAR COMO PROCESADO
+                        if response.status_code == 200 and response.json().get("job_id"):
+                            pending_jobs[response.json()["job_id"]] = uploaded_file.name
                         else:
                             st.error(f"Error en {uploaded_file.name}: {response.text}")
                     except Exception as e:
                         st.error(f"Error conectando: {e}")
-                    
-                    progress_bar.progress((i + 1) / len(uploaded_files))
+
+                # 2. Consultar el estado de los trabajos hasta que terminen
+                progress_by_job = {job_id: 0.0 for job_id in pending_jobs}
+                while pending_jobs:
+                    for job_id, name in list(pending_jobs.items()):
+                        try:
+                            job = requests.get(f"{API_URL}/jobs/{job_id}").json()
+                        except Exception as e:
+                            st.error(f"Error conectando: {e}")
+                            del pending_jobs[job_id]
+                            continue
+
+                        progress_by_job[job_id] = job.get("progress", 0.0)
+                        if job.get("status") == "done":
+                            data = job.get("result") or {}
+                            st.session_state['analysis_result'] = data # Legacy support for logic checks
+                            st.session_state['batch_results'].append(data) # Agregando a lista
+                            st.session_state['processed_files'].add(name) # MARCAR COMO PROCESADO
+                            del pending_jobs[job_id]
+                        elif job.get("status") == "error":
+                            st.error(f"Error en {name}: {job.get('error')}")
+                            del pending_jobs[job_id]
+                        else:
+                            status_text.text(f"Procesando {name} ({job.get('stage')})...")
+
+                    if progress_by_job:
+                        progress_bar.progress(sum(progress_by_job.values()) / len(progress_by_job))
+                    if pending_jobs:
+                        time.sleep(1)
                 
                 status_text.text("¡Proceso completado!")
                 time.sleep(1)
@@ -515,7 +587,15 @@ with col2:
                     category = res.get('category', 'N/A')
                     confidence = res.get('category_score', 0)
                     summary_text = res.get('summary')
-                    full_text = res.get('full_text') or res.get('text_preview', '')
+                    doc_id = res.get('id')
+                    full_text = st.session_state.get('document_texts', {}).get(doc_id)
+                    text_error = None
+                    # Nivel rápido: la transcripción puede tardar, se pide bajo demanda
+                    if full_text is None and doc_id and res.get('tier') != 'quick':
+                        try:
+                            full_text = document_text(doc_id)
+                        except Exception as e:
+                            text_error = str(e)
                     
                     # Layout Compacto
                     c1, c2 = st.columns([1, 2])
@@ -538,15 +618,24 @@ with col2:
                                  try:
                                      ares = requests.post(f"{API_URL}/generate_audio", json={"text": summary_text})
                                      if ares.status_code == 200:
-                                         apath = ares.json().get('audio_path')
-                                         st.audio(apath)
+                                         # El MP3 llega en la respuesta (el backend lo guarda en caché)
+                                         st.audio(ares.content, format="audio/mpeg")
                                      else:
                                          st.error("Error audio")
                                  except:
                                      st.error("Error conexión")
 
                     with ac2:
-                        st.download_button("Texto", data=full_text, file_name=f"{doc_filename}.txt", key=f"btn_dl_{idx}")
+                        if full_text is not None:
+                            st.download_button("Texto", data=full_text, file_name=f"{doc_filename}.txt", key=f"btn_dl_{idx}")
+                        elif doc_id and st.button("Texto", key=f"btn_text_{idx}"):
+                            with st.spinner("Transcribiendo documento completo..."):
+                                try:
+                                    document_text(doc_id)
+                                except Exception as e:
+                                    text_error = str(e)
+                            if not text_error:
+                                st.rerun()
                     
                     with ac3:
                         with st.popover("Chat"):
@@ -567,22 +656,41 @@ with col2:
                              if real_id:
                                  q = st.text_input("Pregunta:", key=f"chat_input_{idx}")
                                  if q:
-                                     with st.spinner("Pensando..."):
-                                         cres = requests.post(f"{API_URL}/chat_document", json={"doc_id": real_id, "query": q})
-                                         if cres.status_code == 200:
-                                             st.markdown(cres.json().get('answer'))
-                                         else:
-                                             st.error("Error")
+                                     answer_box = st.empty()
+                                     answer_box.caption("Pensando...")
+                                     answer, spans = "", []
+                                     try:
+                                         # La respuesta se pinta a medida que llega
+                                         for event in stream_events("/chat_document/stream", {"doc_id": real_id, "query": q}):
+                                             if event["type"] == "transcribing":
+                                                 answer_box.caption("Transcribiendo el documento completo...")
+                                             elif event["type"] == "passages":
+                                                 spans = [f"{p['start']}–{p['end']}" for p in event["passages"] if p.get('start') is not None]
+                                             elif event["type"] == "delta":
+                                                 answer += event["text"]
+                                                 answer_box.markdown(answer + "▌")
+                                             elif event["type"] == "error":
+                                                 st.error(f"Error: {event['detail']}")
+                                         answer_box.markdown(answer)
+                                         if spans:
+                                             st.caption(f"Basado en {len(spans)} fragmento(s), caracteres: {', '.join(spans)}")
+                                     except Exception:
+                                         st.error("Error")
                              else:
                                  st.warning("ID no encontrado para chat")
 
                     # Vista de Texto Completo con Tabs
                     with st.expander("Ver texto extraído completo"):
-                        tab1, tab2 = st.tabs(["Vista Renderizada", "Código Markdown"])
-                        with tab1:
-                            st.markdown(full_text)
-                        with tab2:
-                            st.text_area("Copiar Texto:", value=full_text, height=300, key=f"text_area_{idx}")
+                        if text_error:
+                            st.error(f"Error al obtener el texto: {text_error}")
+                        elif full_text is None:
+                            st.caption("⏳ Transcripción completa pendiente: pulsa «Texto» para obtenerla.")
+                        else:
+                            tab1, tab2 = st.tabs(["Vista Renderizada", "Código Markdown"])
+                            with tab1:
+                                st.markdown(full_text)
+                            with tab2:
+                                st.text_area("Copiar Texto:", value=full_text, height=300, key=f"text_area_{idx}")
 
                     st.markdown("---")
 